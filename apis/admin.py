@@ -0,0 +1,23 @@
+import functools
+import hmac
+
+from flask import current_app, request
+
+
+ADMIN_KEY_HEADER = 'X-Admin-Key'
+
+
+def admin_only(view):
+    """Answer 403 FORBIDDEN unless the request sends the ADMIN_API_KEY of the config in X-Admin-Key
+
+    Guards the maintenance routes that scan or lock whole tables. They are disabled while ADMIN_API_KEY
+    is not set.
+    """
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        admin_key = current_app.config.get('ADMIN_API_KEY')
+        sent_key = request.headers.get(ADMIN_KEY_HEADER)
+        if not admin_key or sent_key is None or not hmac.compare_digest(sent_key.encode(), admin_key.encode()):
+            return {'message':'FORBIDDEN'}, 403
+        return view(*args, **kwargs)
+    return wrapper
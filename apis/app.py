@@ -1,26 +1,76 @@
 from flask import Flask, request
-from flasgger import Swagger
+from werkzeug.middleware.proxy_fix import ProxyFix
 
 from apis.models.model import db
 from apis.healthcheck import healthcheck_blueprint
+from apis.metrics import metrics_blueprint
 from apis.vessels_endpoint import vessels_blueprint
 from apis.equipments_endpoint import equipments_blueprint
+from apis.vessel_cache import init_vessel_cache
+from apis.response_cache import init_response_cache
+from apis.instrumentation import init_instrumentation
+from apis.single_flight import init_single_flight
+from apis.load_control import init_load_control
+from apis.read_replicas import init_read_replicas
+from apis.readiness import init_readiness_probes
+from apis.idempotency import init_idempotency
+from apis.write_behind import init_insert_batcher
+from apis.docs import register_lazy_swagger
+from apis.startup_profile import startup_profile_command, timed
+from apis.fleet_stats import check_statistics_command
 
 
 def create_app(app_name='VESSELS', test_config=False, production_conf=False):
-    app = Flask(app_name)
-    swagger = Swagger(app)
-    if test_config:
-        app.config.from_object('config.TestConfig')
-    else:
-        app.config.from_object('config.RunConfig')
+    timings = {}
+    with timed(timings, 'config'):
+        app = Flask(app_name)
+        if test_config:
+            app.config.from_object('config.TestConfig')
+        elif production_conf:
+            app.config.from_object('config.ProductionConfig')
+        else:
+            app.config.from_object('config.RunConfig')
+
+    hops = app.config.get('PROXY_FIX_HOPS')
+    if hops:
+        # remote_addr, and so the rate limit buckets, is the client seen by the trusted proxies
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=hops, x_proto=hops, x_host=hops)
+
+    with timed(timings, 'swagger'):
+        if app.config.get('LAZY_SWAGGER'):
+            register_lazy_swagger(app)
+        else:
+            from flasgger import Swagger
+            swagger = Swagger(app)
 
     # Register api blueprints
-    app.register_blueprint(healthcheck_blueprint)
-    app.register_blueprint(vessels_blueprint, url_prefix='/vessel')
-    app.register_blueprint(equipments_blueprint, url_prefix='/equipment')
+    with timed(timings, 'blueprints'):
+        app.register_blueprint(healthcheck_blueprint)
+        app.register_blueprint(metrics_blueprint)
+        app.register_blueprint(vessels_blueprint, url_prefix='/vessel')
+        app.register_blueprint(equipments_blueprint, url_prefix='/equipment')
+
+    with timed(timings, 'database'):
+        db.init_app(app)
+        init_load_control(app)
+        init_read_replicas(app)
+        init_readiness_probes(app)
+    with timed(timings, 'vessel_cache'):
+        init_vessel_cache(app)
+    with timed(timings, 'response_cache'):
+        init_response_cache(app)
+    with timed(timings, 'single_flight'):
+        init_single_flight(app)
+    with timed(timings, 'idempotency'):
+        init_idempotency(app)
+    with timed(timings, 'insert_batcher'):
+        init_insert_batcher(app)
+    with timed(timings, 'instrumentation'):
+        init_instrumentation(app)
 
-    db.init_app(app)
+    app.cli.add_command(startup_profile_command)
+    app.cli.add_command(check_statistics_command)
+    app.extensions['startup_timings'] = timings
 
     return app
 
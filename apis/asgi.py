@@ -0,0 +1,410 @@
+"""ASGI version of the api with async handlers and a pooled async database driver
+
+Serves the healthcheck, insert_vessel, bulk_insert (vessels and equipments), insert_equipment,
+update_equipment_status and active_equipments routes. The other routes of the Flask app (search,
+changes, statistics, transitions, status_history, active_at, insert_status, cache_stats, metrics,
+live, ready and the apidocs) are only served by the Flask app, and so is WRITE_BEHIND_MODE; a
+ndjson bulk body is read whole instead of streamed. The operations themselves are the ones of the Flask blueprints
+(apis.operations), run on the sync side of the async connection, and so are the validation, the
+caches, the encodings, the rate limits and the Idempotency-Key claims; only the request parsing
+and the responses are written for Starlette here. The reads go to the primary, there is no replica routing nor request
+coalescing in this mode.
+
+    uvicorn --factory apis.asgi:create_asgi_app --host 0.0.0.0 --port 5000
+
+Behind a proxy, add --proxy-headers --forwarded-allow-ips=<proxy addresses> so the client address
+of the rate limits is the one the proxy reports (PROXY_FIX_HOPS of the Flask app).
+"""
+import functools
+import json
+
+from sqlalchemy import select
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
+from sqlalchemy.ext.asyncio import create_async_engine
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse, PlainTextResponse, Response, StreamingResponse
+from starlette.routing import Route
+from werkzeug.datastructures import MIMEAccept
+from werkzeug.http import parse_accept_header
+
+import config
+from apis.encoding import JSON, negotiate_media_type
+from apis.idempotency import (IDEMPOTENCY_HEADER, IDEMPOTENCY_KEY_LENGTH, IDEMPOTENCY_LOCK_SECONDS,
+                              IDEMPOTENCY_PURGE_INTERVAL, body_fingerprint, claim_key, create_idempotency_store,
+                              purge_expired_keys, release_key, store_key_response, stored_entry)
+from apis.load_control import API_KEY_HEADER, admit, create_load_shedder, create_rate_limiter
+from apis.models.vessel import vessel
+from apis.operations import (bulk_equipment_results, bulk_vessel_result, deactivate_equipments, fill_active_equipments,
+                             insert_equipment_chunk, insert_equipments, insert_vessel_code, insert_vessel_codes,
+                             read_active_equipments, status_update_result, valid_vessel_codes)
+from apis.queries import active_equipments_select, equipments_json
+from apis.response_cache import active_equipments_key, create_response_cache, invalidate_vessels
+from apis.utils import BULK_CHUNK_SIZE, chunks
+from apis.validation import parse_active_equipments_args, validate_equipment, validate_status_codes, validate_vessel
+from apis.vessel_cache import (VESSEL_CACHE_NEGATIVE_TTL, VESSEL_CACHE_SIZE, VesselCache, lookup_vessel_id,
+                               lookup_vessel_ids)
+
+
+ASYNC_DRIVERS = {'postgresql':'postgresql+asyncpg', 'sqlite':'sqlite+aiosqlite'}
+ASYNC_POOL_SIZE = 20
+ASYNC_MAX_OVERFLOW = 30
+STREAM_BATCH_SIZE = 1000
+UPDATE_CHUNK_SIZE = 10000
+
+
+def async_database_url(url):
+    """Swap the driver of a database url for its async counterpart"""
+    scheme, rest = url.split('://', 1)
+    return ASYNC_DRIVERS.get(scheme.split('+')[0], scheme) + '://' + rest
+
+
+def message(text, status_code, headers=None):
+    return JSONResponse({'message':text}, status_code=status_code, headers=headers)
+
+
+async def read_json(request):
+    try:
+        return await request.json()
+    except ValueError:
+        return None
+
+
+async def read_bulk_items(request, key):
+    """Return the items of a bulk request, from a json array (or an object holding it in key) or a ndjson body"""
+    if request.headers.get('content-type', '').split(';')[0].strip() in ('application/x-ndjson', 'application/jsonl'):
+        items = []
+        for line in (await request.body()).splitlines():
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                items.append(json.loads(line))
+            except ValueError:
+                # Not valid json, it is reported as WRONG_FORMAT
+                items.append(line.decode(errors='replace'))
+        return items
+
+    req_json = await read_json(request)
+    if isinstance(req_json, dict):
+        req_json = req_json.get(key)
+    if not isinstance(req_json, list):
+        raise ValueError(f'the body must be a list of {key}')
+    return req_json
+
+
+def bulk_chunk_size(request):
+    return request.app.state.settings.get('BULK_CHUNK_SIZE', BULK_CHUNK_SIZE)
+
+
+def client_id(request):
+    return request.headers.get(API_KEY_HEADER) or (request.client.host if request.client else None)
+
+
+def limited(endpoint):
+    """Apply the rate limit and load shedding of the Flask endpoint of the same route to a handler"""
+    def decorator(handler):
+        @functools.wraps(handler)
+        async def wrapper(request):
+            state = request.app.state
+            refusal = admit(state.rate_limiter, state.load_shedder, client_id(request), endpoint)
+            if refusal:
+                text, status_code, retry_after = refusal
+                return message(text, status_code, {'Retry-After':retry_after})
+            try:
+                return await handler(request)
+            finally:
+                if state.load_shedder:
+                    state.load_shedder.leave()
+        return wrapper
+    return decorator
+
+
+def _replay(store, fingerprint, entry):
+    stored_fingerprint, status_code, body = entry
+    if stored_fingerprint != fingerprint:
+        return message('IDEMPOTENCY_KEY_REUSED', 422)
+    store.count('replays')
+    return Response(body, status_code=status_code, media_type=JSON, headers={'Idempotent-Replayed':'true'})
+
+
+def idempotent(endpoint):
+    """Make a write handler safe to retry with an Idempotency-Key header
+
+    Same flow as apis.idempotency.idempotent on the same idempotency_keys table and keys, so a
+    retry is replayed whichever front end ran the first request. Each step commits on its own,
+    the claim before the handler runs and the response after it.
+    """
+    def decorator(handler):
+        @functools.wraps(handler)
+        async def wrapper(request):
+            header = request.headers.get(IDEMPOTENCY_HEADER)
+            if header is None:
+                return await handler(request)
+            if not header or len(header) > IDEMPOTENCY_KEY_LENGTH:
+                return message('WRONG_FORMAT', 400)
+
+            state = request.app.state
+            store = state.idempotency_store
+            key = f'{endpoint}:{header}'
+            fingerprint = body_fingerprint(await read_json(request))
+            entry = store.get(key)
+            if entry is not None:
+                return _replay(store, fingerprint, entry)
+
+            if store.purge_due(state.settings.get('IDEMPOTENCY_PURGE_INTERVAL', IDEMPOTENCY_PURGE_INTERVAL)):
+                async with state.engine.begin() as connection:
+                    await connection.run_sync(purge_expired_keys)
+            async with state.engine.begin() as connection:
+                row = await connection.run_sync(
+                    claim_key, key, fingerprint, store.ttl,
+                    state.settings.get('IDEMPOTENCY_LOCK_SECONDS', IDEMPOTENCY_LOCK_SECONDS))
+            if row is not None:
+                if row.status_code is None:
+                    store.count('in_progress')
+                    return message('IN_PROGRESS', 409, {'Retry-After':'1'})
+                return _replay(store, fingerprint, stored_entry(store, key, row))
+
+            try:
+                response = await handler(request)
+            except BaseException:
+                async with state.engine.begin() as connection:
+                    await connection.run_sync(release_key, key)
+                raise
+            async with state.engine.begin() as connection:
+                if response.status_code >= 500:
+                    await connection.run_sync(release_key, key)
+                    return response
+                body = response.body.decode()
+                await connection.run_sync(store_key_response, key, response.status_code, body)
+            store.set(key, (fingerprint, response.status_code, body))
+            return response
+        return wrapper
+    return decorator
+
+
+def cached_equipments_response(request, etag, body, media_type):
+    """Build the response for a cached body, answering If-None-Match with 304"""
+    if_none_match = [tag.strip().lstrip('W/').strip('"') for tag in request.headers.get('if-none-match', '').split(',')]
+    headers = {'ETag':f'"{etag}"', 'Vary':'Accept'}
+    if etag in if_none_match or '*' in if_none_match:
+        return Response(status_code=304, headers=headers)
+    return Response(body, media_type=media_type, headers=headers)
+
+
+async def healthcheck(request):
+    return PlainTextResponse('OK')
+
+
+@limited('vessels.insert_vessel')
+@idempotent('vessels.insert_vessel')
+async def insert_vessel(request):
+    req_json = await read_json(request)
+    error = validate_vessel(req_json)
+    if error:
+        return message(error, 400)
+
+    code = req_json['code']
+    try:
+        async with request.app.state.engine.begin() as connection:
+            vessel_id = await connection.run_sync(insert_vessel_code, code)
+    except IntegrityError:
+        # The unique constraint on the code replaces the check before the insert
+        return message('FAIL', 409)
+
+    request.app.state.vessel_cache.set(code, vessel_id)
+    return message('OK', 201)
+
+
+@limited('vessels.bulk_insert_vessel')
+async def bulk_insert_vessel(request):
+    req_json = await read_json(request)
+    if isinstance(req_json, dict):
+        req_json = req_json.get('code')
+    if not req_json:
+        return message('MISSING_PARAMETER', 400)
+
+    if type(req_json) != list:
+        return message('WRONG_FORMAT', 400)
+
+    valid_codes = valid_vessel_codes(req_json)
+    created = set()
+    for chunk in chunks(valid_codes, bulk_chunk_size(request)):
+        while True:
+            try:
+                async with request.app.state.engine.begin() as connection:
+                    created_codes = await connection.run_sync(insert_vessel_codes, chunk)
+                break
+            except IntegrityError:
+                # A concurrent request inserted some of the codes after the read, classify the chunk again
+                continue
+        for code in created_codes:
+            request.app.state.vessel_cache.invalidate(code)
+        created.update(created_codes)
+
+    return JSONResponse(bulk_vessel_result(req_json, valid_codes, created), status_code=201)
+
+
+@limited('equipments.insert_equipment')
+@idempotent('equipments.insert_equipment')
+async def insert_equipment(request):
+    req_json = await read_json(request)
+    error = validate_equipment(req_json)
+    if error:
+        return message(error, 400)
+
+    try:
+        async with request.app.state.engine.begin() as connection:
+            vessel_id = await connection.run_sync(lookup_vessel_id, request.app.state.vessel_cache, req_json['vessel_code'])
+            if vessel_id is None:
+                return message('NO_VESSEL', 409)
+            await connection.run_sync(insert_equipments, [{'vessel_id':vessel_id, 'code':req_json['code'],
+                                                           'name':req_json['name'], 'location':req_json['location'],
+                                                           'active':True}])
+    except IntegrityError:
+        return message('REPEATED_CODE', 409)
+
+    invalidate_vessels(request.app.state.response_cache, [vessel_id])
+    return message('OK', 201)
+
+
+def _insert_equipment_chunk(connection, cache, chunk, seen_codes):
+    return insert_equipment_chunk(connection, chunk, seen_codes, lambda codes: lookup_vessel_ids(connection, cache, codes))
+
+
+@limited('equipments.bulk_insert_equipment')
+async def bulk_insert_equipment(request):
+    try:
+        items = await read_bulk_items(request, 'equipments')
+    except ValueError:
+        return message('WRONG_FORMAT', 400)
+    if not items:
+        return message('MISSING_PARAMETER', 400)
+
+    state = request.app.state
+    seen_codes = set()
+    results = []
+    inserted = 0
+    for chunk in chunks(items, bulk_chunk_size(request)):
+        for attempt in range(len(chunk) + 1):
+            try:
+                async with state.engine.begin() as connection:
+                    statuses, rows = await connection.run_sync(_insert_equipment_chunk, state.vessel_cache, chunk, seen_codes)
+                break
+            except IntegrityError:
+                # Same retry as the Flask endpoint, each conflict makes at least one more code known
+                if attempt == len(chunk):
+                    raise
+                seen_codes.difference_update(item.get('code') for item in chunk if isinstance(item, dict))
+        invalidate_vessels(state.response_cache, {row['vessel_id'] for row in rows})
+        inserted += bulk_equipment_results(chunk, statuses, results)
+
+    return JSONResponse({'message':'OK', 'inserted':inserted, 'results':results}, status_code=201)
+
+
+@limited('equipments.update_equipment_status')
+async def update_equipment_status(request):
+    error, codes = validate_status_codes(await read_json(request))
+    if error:
+        return message(error, 400)
+
+    async with request.app.state.engine.connect() as connection:
+        transaction = await connection.begin()
+        statuses, vessel_ids = await connection.run_sync(
+            deactivate_equipments, codes, request.app.state.settings.get('UPDATE_CHUNK_SIZE', UPDATE_CHUNK_SIZE))
+        if all(status == 'unknown' for status in statuses.values()):
+            await transaction.rollback()
+            return message('NO_CODE', 409)
+        await transaction.commit()
+
+    invalidate_vessels(request.app.state.response_cache, vessel_ids)
+    return JSONResponse(status_update_result(codes, statuses), status_code=201)
+
+
+async def _stream_equipments(engine, equipments_query):
+    """Yield the equipments json document in pieces, reading the rows from a server side cursor"""
+    async with engine.connect() as connection:
+        result = await connection.stream(equipments_query)
+        yield '{"equipments":['
+        separator = ''
+        async for rows in result.partitions(STREAM_BATCH_SIZE):
+            yield separator + ','.join(json.dumps(item) for item in equipments_json(rows))
+            separator = ','
+        yield ']}'
+
+
+@limited('equipments.active_equipment')
+async def active_equipments(request):
+    error, vessel_code, limit, after_code, stream = parse_active_equipments_args(request.query_params)
+    if error:
+        return message(error, 400)
+
+    engine = request.app.state.engine
+    cache = request.app.state.response_cache
+    media_type = negotiate_media_type(parse_accept_header(request.headers.get('accept'), MIMEAccept))
+    async with engine.connect() as connection:
+        vessel_id = await connection.run_sync(lookup_vessel_id, request.app.state.vessel_cache, vessel_code)
+        if vessel_id is None:
+            return message('NO_VESSEL', 409)
+
+        if stream:
+            equipments_query = active_equipments_select(vessel_id, limit, after_code, ordered=True)
+            return StreamingResponse(_stream_equipments(engine, equipments_query), media_type=JSON)
+
+        if cache and not (limit or after_code):
+            cached = cache.get(active_equipments_key(vessel_id, media_type))
+            if cached is None:
+                cached = await connection.run_sync(fill_active_equipments, cache, vessel_id, media_type)
+            return cached_equipments_response(request, *cached, media_type)
+
+        body = await connection.run_sync(read_active_equipments, vessel_id, media_type, limit, after_code)
+    return Response(body, media_type=media_type, headers={'Vary':'Accept'})
+
+
+def create_asgi_app(test_config=False):
+    config_object = config.TestConfig if test_config else config.RunConfig
+    settings = {key:getattr(config_object, key) for key in dir(config_object) if key.isupper()}
+
+    url = async_database_url(settings['SQLALCHEMY_DATABASE_URI'])
+    engine_options = {}
+    if url.startswith('postgresql'):
+        engine_options = {'pool_size':settings.get('ASYNC_POOL_SIZE', ASYNC_POOL_SIZE),
+                          'max_overflow':settings.get('ASYNC_MAX_OVERFLOW', ASYNC_MAX_OVERFLOW), 'pool_pre_ping':True}
+
+    app = Starlette(routes=[
+        Route('/', healthcheck, methods=['GET']),
+        Route('/vessel/insert_vessel', insert_vessel, methods=['POST']),
+        Route('/vessel/bulk_insert', bulk_insert_vessel, methods=['POST']),
+        Route('/equipment/insert_equipment', insert_equipment, methods=['POST']),
+        Route('/equipment/bulk_insert', bulk_insert_equipment, methods=['POST']),
+        Route('/equipment/update_equipment_status', update_equipment_status, methods=['PUT']),
+        Route('/equipment/active_equipments', active_equipments, methods=['GET']),
+    ])
+    app.state.settings = settings
+    app.state.engine = create_async_engine(url, **engine_options)
+    app.state.vessel_cache = VesselCache(maxsize=settings.get('VESSEL_CACHE_SIZE', VESSEL_CACHE_SIZE),
+                                         negative_ttl=settings.get('VESSEL_CACHE_NEGATIVE_TTL', VESSEL_CACHE_NEGATIVE_TTL))
+    app.state.response_cache = create_response_cache(settings)
+    app.state.rate_limiter = create_rate_limiter(settings)
+    app.state.load_shedder = create_load_shedder(settings)
+    app.state.idempotency_store = create_idempotency_store(settings)
+
+    @app.on_event('startup')
+    async def warm_vessel_cache():
+        if not settings.get('VESSEL_CACHE_WARM', True):
+            return
+        cache = app.state.vessel_cache
+        try:
+            async with app.state.engine.connect() as connection:
+                result = await connection.execute(select(vessel.code, vessel.id).order_by(vessel.id).limit(cache.maxsize))
+                for code, vessel_id in result:
+                    cache.set(code, vessel_id)
+                cache.warmed = True
+        except SQLAlchemyError:
+            # The database may not be created yet (e.g. while running migrations)
+            pass
+
+    @app.on_event('shutdown')
+    async def close_pool():
+        await app.state.engine.dispose()
+
+    return app
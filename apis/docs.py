@@ -0,0 +1,39 @@
+import threading
+
+from flask import Flask, request
+
+
+SWAGGER_RULES = ('/apidocs/', '/apispec_1.json', '/flasgger_static/<path:filename>')
+
+
+def register_lazy_swagger(app):
+    """Serve the swagger documentation of app, building it only when it is first requested
+
+    flasgger and the parsing of the docstrings are left out of the startup, the first
+    request to /apidocs builds a documentation app with the same routes and the swagger
+    requests are dispatched to it.
+    """
+    state = {}
+    lock = threading.Lock()
+
+    def docs_app():
+        with lock:
+            if 'app' not in state:
+                from flasgger import Swagger
+
+                docs = Flask(app.name)
+                docs.config.update(app.config)
+                for rule in app.url_map.iter_rules():
+                    if rule.endpoint not in ('static', 'swagger_docs'):
+                        docs.add_url_rule(rule.rule, rule.endpoint, app.view_functions[rule.endpoint], methods=rule.methods)
+                Swagger(docs)
+                state['app'] = docs
+            return state['app']
+
+    def swagger_docs(**kwargs):
+        docs = docs_app()
+        with docs.request_context(request.environ):
+            return docs.full_dispatch_request()
+
+    for rule in SWAGGER_RULES:
+        app.add_url_rule(rule, 'swagger_docs', swagger_docs)
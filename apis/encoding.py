@@ -0,0 +1,102 @@
+import gzip
+import json
+
+from flask import current_app, request
+
+from apis.queries import equipments_columns, equipments_json
+
+try:
+    import msgpack
+except ImportError:  # pragma: no cover - msgpack is optional
+    msgpack = None
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover - brotli is optional
+    brotli = None
+
+
+JSON = 'application/json'
+COLUMNAR_JSON = 'application/vnd.vessels.columnar+json'
+MSGPACK = 'application/msgpack'
+COLUMNAR_MSGPACK = 'application/vnd.vessels.columnar+msgpack'
+
+# Short names of the media types, used in the response cache keys
+MEDIA_TYPE_NAMES = {JSON:'json', COLUMNAR_JSON:'columnar', MSGPACK:'msgpack', COLUMNAR_MSGPACK:'columnar-msgpack'}
+MEDIA_TYPE_ALIASES = {'application/x-msgpack':MSGPACK}
+
+COMPRESSION_MIN_SIZE = 1024
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 4
+
+
+def available_media_types():
+    """Media types the equipment listings can be encoded with, json first so it wins */*"""
+    media_types = [JSON, COLUMNAR_JSON]
+    if msgpack is not None:
+        media_types += [MSGPACK, 'application/x-msgpack', COLUMNAR_MSGPACK]
+    return media_types
+
+
+def negotiate_media_type(accept):
+    """Return the media type to answer an Accept header with, json when nothing else matches"""
+    media_type = accept.best_match(available_media_types(), default=JSON)
+    return MEDIA_TYPE_ALIASES.get(media_type, media_type)
+
+
+def encode_equipments(rows, media_type, **extra):
+    """Serialize the (code, name, location) rows and the extra top level keys as media_type"""
+    if media_type in (COLUMNAR_JSON, COLUMNAR_MSGPACK):
+        document = {'equipments':equipments_columns(rows)}
+    else:
+        document = {'equipments':equipments_json(rows)}
+    document.update(extra)
+
+    if media_type in (MSGPACK, COLUMNAR_MSGPACK):
+        return msgpack.packb(document)
+    if media_type == COLUMNAR_JSON:
+        return json.dumps(document, separators=(',', ':')).encode()
+    return json.dumps(document).encode()
+
+
+def compress(body, encoding):
+    if encoding == 'br':
+        return brotli.compress(body, quality=BROTLI_QUALITY)
+    return gzip.compress(body, compresslevel=GZIP_LEVEL)
+
+
+def response_encoding(size):
+    """Return the best encoding the client accepts for a body of size bytes, None to send it as it is"""
+    min_size = current_app.config.get('COMPRESSION_MIN_SIZE', COMPRESSION_MIN_SIZE)
+    if min_size is None or size < min_size:
+        return None
+    return request.accept_encodings.best_match(['br', 'gzip'] if brotli is not None else ['gzip'])
+
+
+def mark_compressed(response, encoding):
+    response.headers['Content-Encoding'] = encoding
+    etag, weak = response.get_etag()
+    if etag:
+        # The compressed body is only semantically equivalent to the one the ETag was computed for
+        response.set_etag(etag, weak=True)
+
+
+def compress_response(response):
+    """Compress bodies of at least COMPRESSION_MIN_SIZE bytes with the best encoding the client accepts
+
+    Register it as an after_request handler. A None COMPRESSION_MIN_SIZE disables it, streamed
+    responses are always sent as they are, and the cached responses are compressed by the view.
+    """
+    if (current_app.config.get('COMPRESSION_MIN_SIZE', COMPRESSION_MIN_SIZE) is None or response.status_code != 200
+            or response.is_streamed or response.direct_passthrough or 'Content-Encoding' in response.headers):
+        return response
+
+    response.vary.add('Accept-Encoding')
+    body = response.get_data()
+    encoding = response_encoding(len(body))
+    if encoding is None:
+        return response
+
+    response.set_data(compress(body, encoding))
+    mark_compressed(response, encoding)
+    return response
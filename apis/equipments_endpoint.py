@@ -1,15 +1,44 @@
-from flask import Blueprint, request, jsonify
-from sqlalchemy import func, extract, and_
+import json
+from datetime import datetime
+
+from flask import Blueprint, Response, current_app, request, jsonify, stream_with_context
+from sqlalchemy import func, extract, and_, select
+from sqlalchemy.exc import IntegrityError
 
 from apis.models.equipment import equipment
-from apis.models.vessel import vessel
+from apis.models.equipment_status_event import equipment_status_event
 from apis.models.model import db
+from apis.queries import (active_equipments_select, changes_high_water_select, changes_json,
+                          changes_select, equipments_json, search_json, search_select)
+from apis.utils import bulk_chunk_size, chunks, dialect_name, update_from_values
+from apis.validation import (parse_active_at_args, parse_active_equipments_args, parse_changes_args, parse_search_args,
+                            parse_status_history_args, validate_equipment, validate_status_codes,
+                            validate_transition)
+from apis.vessel_cache import get_vessel_id, get_vessel_ids
+from apis.response_cache import active_equipments_key, cached_response, invalidate_active_equipments, response_cache
+from apis.encoding import compress_response, negotiate_media_type
+from apis.single_flight import single_flight
+from apis.admin import admin_only
+from apis.idempotency import idempotent
+from apis.read_replicas import primary, read_target
+from apis.write_behind import WRITE_BEHIND_WAIT_TIMEOUT, insert_batcher
+from apis.operations import (bulk_equipment_results, deactivate_equipments, fill_active_equipments, insert_equipment_chunk,
+                             insert_equipments, read_active_equipments, status_update_result)
+from apis.status_history import (active_at_select, record_status_events, transitions_json,
+                                 transitions_select)
+from apis.fleet_stats import (CounterDeltas, apply_counter_deltas, check_counters, location_statistics,
+                              vessel_statistics)
 
 
 equipments_blueprint = Blueprint('equipments', __name__)
+equipments_blueprint.after_request(compress_response)
+
+STREAM_BATCH_SIZE = 1000
+UPDATE_CHUNK_SIZE = 10000
 
 
 @equipments_blueprint.route('/insert_equipment', methods=['POST'])
+@idempotent
 def insert_equipment():
     """Insert a new equipment
         ---
@@ -30,6 +59,11 @@ def insert_equipment():
               in: body
               type: string
               required: true
+            - name: Idempotency-Key
+              in: header
+              type: string
+              required: false
+              description: unique key of the request, the retries sent with the same key and body get the response of the first one without inserting again
         responses:
           201:
             description: returns OK if the equipment was correctly inserted
@@ -39,36 +73,184 @@ def insert_equipment():
             description: returns WRONG_FORMAT if any parameter are sent in the wrong format
           409:
             description: returns REPEATED_CODE if the equipment code is already in the system
+          202:
+            description: returns ACCEPTED and the id to follow in insert_status when WRITE_BEHIND_MODE is async
           409:
             description: returns NO_VESSEL if the vessel code is not already in the system
+          500:
+            description: returns FAILED if the group commit of the equipment failed (WRITE_BEHIND_MODE only)
+          409:
+            description: returns IN_PROGRESS if the request with the same Idempotency-Key is still running
+          422:
+            description: returns IDEMPOTENCY_KEY_REUSED if the Idempotency-Key was sent before with another body
     """
     req_json = request.get_json()
-    if not req_json or not req_json.get('vessel_code') or not req_json.get('code') or not req_json.get('name') or not req_json.get('location'):
-        return {'message':'MISSING_PARAMETER'}, 400
+    error = validate_equipment(req_json)
+    if error:
+        return {'message':error}, 400
     
     vessel_code = req_json.get('vessel_code')
     code = req_json.get('code')
     name = req_json.get('name')
     location = req_json.get('location')
     
-    if type(vessel_code) != str or type(code) != str or type(name) != str or type(location) != str:
-        return {'message':'WRONG_FORMAT'}, 400
-    
-    vessel_query = db.session.query(vessel.id).filter(vessel.code==vessel_code)
-    query_results = db.session.execute(vessel_query).all()
-    if not len(query_results):
+    vessel_id = get_vessel_id(vessel_code)
+    if vessel_id is None:
         return {'message':'NO_VESSEL'}, 409
     
+    batcher = insert_batcher()
+    if batcher:
+        return _queue_equipment(batcher, {'vessel_id':vessel_id, 'code':code, 'name':name, 'location':location, 'active':True})
+
     equipment_in_the_system = db.session.query(equipment.id).filter(equipment.code==code).count()
     if equipment_in_the_system:
         return {'message':'REPEATED_CODE'}, 409
 
-    equipment_obj = equipment(vessel_id=query_results[0][0], code=code, name=name, location=location, active=True)
-    db.session.add(equipment_obj)
+    insert_equipments(db.session, [{'vessel_id':vessel_id, 'code':code, 'name':name, 'location':location, 'active':True}])
     db.session.commit()
+    invalidate_active_equipments([vessel_id])
 
     return {'message':'OK'}, 201
 
+def _ticket_response(ticket):
+    if ticket.status == 'OK':
+        return {'message':'OK'}, 201
+    if ticket.status == 'REPEATED_CODE':
+        return {'message':'REPEATED_CODE'}, 409
+    return {'message':ticket.status}, 500
+
+def _queue_equipment(batcher, row):
+    """Hand a validated equipment to the write behind queue
+
+    In the wait mode the response is sent after the group commit, in the async mode (or when the commit
+    takes longer than WRITE_BEHIND_WAIT_TIMEOUT) 202 is sent with the id to follow the insert in insert_status.
+    """
+    ticket = batcher.submit(row)
+    if ticket is None:
+        return {'message':'REPEATED_CODE'}, 409
+
+    if current_app.config.get('WRITE_BEHIND_MODE') == 'wait':
+        if ticket.done.wait(current_app.config.get('WRITE_BEHIND_WAIT_TIMEOUT', WRITE_BEHIND_WAIT_TIMEOUT)):
+            return _ticket_response(ticket)
+    return {'message':'ACCEPTED', 'id':ticket.id}, 202
+
+@equipments_blueprint.route('/insert_status', methods=['GET'])
+def insert_status():
+    """Return the status of an insert accepted by the write behind queue
+        ---
+        parameters:
+            - name: id
+              in: query
+              type: string
+              required: true
+        responses:
+          200:
+            description: returns PENDING while the insert is queued, then OK, REPEATED_CODE or FAILED
+          400:
+            description: returns MISSING_PARAMETER if the id is not sent
+          404:
+            description: returns NO_INSERT if the id is unknown or its result expired
+    """
+    ticket_id = request.args.get('id')
+    if not ticket_id:
+        return {'message':'MISSING_PARAMETER'}, 400
+
+    batcher = insert_batcher()
+    status = batcher.result(ticket_id) if batcher else None
+    if status is None:
+        return {'message':'NO_INSERT'}, 404
+    return {'message':status}, 200
+
+def _read_bulk_items(key='equipments'):
+    """Yield the items of a bulk request, from a json array (or an object holding it in key) or a ndjson stream"""
+    if request.mimetype in ('application/x-ndjson', 'application/jsonl'):
+        for line in request.stream:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield json.loads(line)
+            except ValueError:
+                # Not valid json, it is reported as WRONG_FORMAT
+                yield line
+        return
+
+    req_json = request.get_json(silent=True)
+    if isinstance(req_json, dict):
+        req_json = req_json.get(key)
+    if not isinstance(req_json, list):
+        raise ValueError(f'the body must be a list of {key}')
+    yield from req_json
+
+def _insert_equipment_chunk(chunk, seen_codes):
+    """Validate and insert a chunk of equipments with set based queries
+
+    Returns the status of each item of the chunk, in order.
+    """
+    statuses, rows = insert_equipment_chunk(db.session, chunk, seen_codes, get_vessel_ids)
+    db.session.commit()
+    invalidate_active_equipments(row['vessel_id'] for row in rows)
+    batcher = insert_batcher()
+    if batcher:
+        batcher.remember(row['code'] for row in rows)
+    return statuses
+
+@equipments_blueprint.route('/bulk_insert', methods=['POST'])
+def bulk_insert_equipment():
+    """Insert a list of equipments
+        Accepts a json list (or an object with an equipments key holding the list) or a
+        ndjson stream (Content-Type application/x-ndjson), one equipment per line. Each
+        equipment has the same parameters as insert_equipment.
+        ---
+        parameters:
+            - name: equipments
+              in: body
+              type: array
+              required: true
+              items:
+                type: object
+                properties:
+                  vessel_code:
+                    type: string
+                  code:
+                    type: string
+                  name:
+                    type: string
+                  location:
+                    type: string
+        responses:
+          201:
+            description: returns OK with a results list holding, for each equipment in the order it was sent, its index, code and the message insert_equipment would return (OK, MISSING_PARAMETER, WRONG_FORMAT, NO_VESSEL or REPEATED_CODE)
+          400:
+            description: returns MISSING_PARAMETER if no equipment is sent
+          400:
+            description: returns WRONG_FORMAT if the body is not a list of equipments
+    """
+    seen_codes = set()
+    results = []
+    inserted = 0
+    try:
+        for chunk in chunks(_read_bulk_items(), bulk_chunk_size()):
+            for attempt in range(len(chunk) + 1):
+                try:
+                    statuses = _insert_equipment_chunk(chunk, seen_codes)
+                    break
+                except IntegrityError:
+                    # A concurrent insert took some of the codes, check the chunk again. Each conflict
+                    # makes at least one more code known, so any other error is raised after len(chunk)
+                    db.session.rollback()
+                    if attempt == len(chunk):
+                        raise
+                    seen_codes.difference_update(item.get('code') for item in chunk if isinstance(item, dict))
+            inserted += bulk_equipment_results(chunk, statuses, results)
+    except ValueError:
+        return {'message':'WRONG_FORMAT'}, 400
+
+    if not results:
+        return {'message':'MISSING_PARAMETER'}, 400
+
+    return {'message':'OK', 'inserted':inserted, 'results':results}, 201
+
 @equipments_blueprint.route('/update_equipment_status', methods=['PUT'])
 def update_equipment_status():
     """Set a equipment or a list of those to inactive
@@ -80,7 +262,7 @@ def update_equipment_status():
               required: true
         responses:
           201:
-            description: returns OK if the equipments were correctly updated
+            description: returns OK if the equipments were correctly updated, with the deactivated, already_inactive and unknown lists of codes
           400:
             description: returns MISSING_PARAMETER if any parameter is not sent
           400:
@@ -88,26 +270,171 @@ def update_equipment_status():
           409:
             description: returns NO_CODE if the equipment code is not already in the system
     """
-    req_json = request.get_json()
-    if not req_json or not req_json.get('code'):
-        return {'message':'MISSING_PARAMETER'}, 400
-    
-    code = req_json.get('code')
-    
-    if type(code) != str and type(code) != list:
-        return {'message':'WRONG_FORMAT'}, 400
+    error, codes = validate_status_codes(request.get_json())
+    if error:
+        return {'message':error}, 400
 
-    if type(code) == str:
-        code = [code]
-    
-    equipment_in_the_system = db.session.query(equipment.id).filter(equipment.code.in_(code)).count()
-    if not equipment_in_the_system:
+    statuses, vessel_ids = deactivate_equipments(db.session, codes,
+                                                 current_app.config.get('UPDATE_CHUNK_SIZE', UPDATE_CHUNK_SIZE))
+    if all(status == 'unknown' for status in statuses.values()):
+        db.session.rollback()
         return {'message':'NO_CODE'}, 409
 
-    update_equipments = db.session.query(equipment).filter(equipment.code.in_(code)).update({'active':False})
     db.session.commit()
+    invalidate_active_equipments(vessel_ids)
+    return status_update_result(codes, statuses), 201
 
-    return {'message':'OK'}, 201
+def _transition_chunk(chunk, changed_at, deltas, vessel_ids):
+    """Apply a chunk of valid transitions of distinct codes with one statement per operation
+
+    Returns the status of each item of the chunk, in order. The counter changes are added to deltas and
+    the vessels whose equipments changed to vessel_ids.
+    """
+    # Locked in code order, so concurrent transitions can not deadlock and nothing changes the rows read here
+    current_query = select(equipment.code, equipment.vessel_id, equipment.location, equipment.active) \
+        .where(equipment.code.in_([item['code'] for item in chunk])).order_by(equipment.code).with_for_update()
+    found = {code:(vessel_id, location, bool(active))
+             for code, vessel_id, location, active in db.session.execute(current_query).all()}
+    target_vessel_ids = get_vessel_ids({item['vessel_code'] for item in chunk if item['operation'] == 'relocate'})
+
+    statuses = []
+    activated, deactivated, relocated, moved = [], [], [], []
+    events = []
+    for item in chunk:
+        code, operation = item['code'], item['operation']
+        if code not in found:
+            statuses.append('NO_CODE')
+            continue
+        vessel_id, location, active = found[code]
+        counts = (1, 0) if active else (0, 1)
+        if operation in ('activate', 'deactivate'):
+            target = operation == 'activate'
+            if active == target:
+                statuses.append('UNCHANGED')
+                continue
+            (activated if target else deactivated).append(code)
+            deltas.add(vessel_id, location, active=1 if target else -1, inactive=-1 if target else 1)
+            events.append({'vessel_id':vessel_id, 'code':code, 'active':target, 'previous_active':active,
+                           'changed_at':changed_at})
+            vessel_ids.add(vessel_id)
+        elif operation == 'relocate':
+            target = target_vessel_ids.get(item['vessel_code'])
+            if target is None:
+                statuses.append('NO_VESSEL')
+                continue
+            if target == vessel_id:
+                statuses.append('UNCHANGED')
+                continue
+            relocated.append((code, target))
+            deltas.add(vessel_id, location, -counts[0], -counts[1])
+            deltas.add(target, location, *counts)
+            # The equipment leaves the history of one vessel and enters the history of the other
+            events.append({'vessel_id':vessel_id, 'code':code, 'active':None, 'previous_active':active,
+                           'changed_at':changed_at})
+            events.append({'vessel_id':target, 'code':code, 'active':active, 'previous_active':None,
+                           'changed_at':changed_at})
+            vessel_ids.update((vessel_id, target))
+        else:
+            if item['location'] == location:
+                statuses.append('UNCHANGED')
+                continue
+            moved.append((code, item['location']))
+            deltas.add(vessel_id, location, -counts[0], -counts[1])
+            deltas.add(vessel_id, item['location'], *counts)
+            vessel_ids.add(vessel_id)
+        statuses.append('OK')
+
+    for codes, active in ((activated, True), (deactivated, False)):
+        if codes:
+            db.session.execute(equipment.__table__.update().where(equipment.code.in_(codes)).values(active=active))
+    update_from_values(equipment.__table__, equipment.code, equipment.vessel_id, relocated)
+    update_from_values(equipment.__table__, equipment.code, equipment.location, moved)
+    record_status_events(events)
+    return statuses
+
+@equipments_blueprint.route('/transitions', methods=['PUT'])
+def equipment_transitions():
+    """Apply a list of status transitions to the equipments in a single transaction
+        Accepts a json list (or an object with a transitions key holding the list) or a ndjson
+        stream (Content-Type application/x-ndjson), one transition per line. Each code can be
+        sent once per request.
+        ---
+        parameters:
+            - name: transitions
+              in: body
+              type: array
+              required: true
+              items:
+                type: object
+                properties:
+                  code:
+                    type: string
+                  operation:
+                    type: string
+                    enum: [activate, deactivate, relocate, change_location]
+                  vessel_code:
+                    type: string
+                    description: the vessel the equipment moves to, required by relocate
+                  location:
+                    type: string
+                    description: the new location of the equipment, required by change_location
+        responses:
+          201:
+            description: returns OK with the number of applied transitions and a results list holding, for each transition in the order it was sent, its index, code, operation and message (OK, UNCHANGED if the equipment was already in that state, MISSING_PARAMETER, WRONG_FORMAT, NO_CODE, NO_VESSEL or REPEATED_CODE if the code was already sent)
+          400:
+            description: returns MISSING_PARAMETER if no transition is sent
+          400:
+            description: returns WRONG_FORMAT if the body is not a list of transitions
+    """
+    seen_codes = set()
+    results = []
+    vessel_ids = set()
+    deltas = CounterDeltas()
+    changed_at = datetime.utcnow()
+    try:
+        for chunk in chunks(_read_bulk_items('transitions'), current_app.config.get('UPDATE_CHUNK_SIZE', UPDATE_CHUNK_SIZE)):
+            statuses = [validate_transition(item) for item in chunk]
+            valid = []
+            for position, item in enumerate(chunk):
+                if statuses[position] is None:
+                    if item['code'] in seen_codes:
+                        statuses[position] = 'REPEATED_CODE'
+                    else:
+                        seen_codes.add(item['code'])
+                        valid.append(position)
+            if valid:
+                for position, status in zip(valid, _transition_chunk([chunk[position] for position in valid], changed_at,
+                                                                     deltas, vessel_ids)):
+                    statuses[position] = status
+            for item, status in zip(chunk, statuses):
+                results.append({'index':len(results), 'code':item.get('code') if isinstance(item, dict) else None,
+                                'operation':item.get('operation') if isinstance(item, dict) else None, 'message':status})
+    except ValueError:
+        db.session.rollback()
+        return {'message':'WRONG_FORMAT'}, 400
+
+    if not results:
+        return {'message':'MISSING_PARAMETER'}, 400
+
+    apply_counter_deltas(deltas)
+    db.session.commit()
+    invalidate_active_equipments(vessel_ids)
+    return {'message':'OK', 'applied':sum(result['message'] == 'OK' for result in results), 'results':results}, 201
+
+def _stream_equipments(equipments_query):
+    """Yield the equipments json document in pieces, reading the rows from a server side cursor"""
+    result = db.session.execute(equipments_query.execution_options(stream_results=True))
+    yield '{"equipments":['
+    separator = ''
+    for rows in result.partitions(STREAM_BATCH_SIZE):
+        yield separator + ','.join(json.dumps(item) for item in equipments_json(rows))
+        separator = ','
+    yield ']}'
+
+def _coalesced(key, read):
+    """Share read() with the identical requests of the worker that arrive at the same time"""
+    flights = single_flight()
+    return flights.do(key, read) if flights else read()
 
 @equipments_blueprint.route('/active_equipments', methods=['GET'])
 def active_equipment():
@@ -118,9 +445,36 @@ def active_equipment():
               in: query
               type: string
               required: true
+            - name: limit
+              in: query
+              type: integer
+              required: false
+              description: maximum number of equipments to return, ordered by code
+            - name: after_code
+              in: query
+              type: string
+              required: false
+              description: return only equipments with a code after this one, use the next_after_code of the previous page
+            - name: stream
+              in: query
+              type: boolean
+              required: false
+              description: stream the list from a server side cursor instead of building it in memory, always sent as json
+            - name: Accept
+              in: header
+              type: string
+              required: false
+              description: application/json (default), application/vnd.vessels.columnar+json for one list per field, application/msgpack or application/vnd.vessels.columnar+msgpack
+            - name: Accept-Encoding
+              in: header
+              type: string
+              required: false
+              description: br or gzip to compress lists larger than COMPRESSION_MIN_SIZE bytes
         responses:
           200:
-            description: returns a json with equipments key and a list of equipments
+            description: returns a json with equipments key and a list of equipments, when limit is sent next_after_code holds the cursor of the next page or null on the last one. The columnar encodings hold a code, name and location list under the equipments key
+          304:
+            description: returned when the If-None-Match header matches the ETag of the cached list
           400:
             description: returns MISSING_PARAMETER if the vessel_code is not sent
           400:
@@ -128,23 +482,320 @@ def active_equipment():
           409:
             description: returns NO_VESSEL if the vessel is not already in the system
     """
-    req_args = request.args
-    if not req_args or not req_args.get('vessel_code'):
-        return {'message':'MISSING_PARAMETER'}, 400
+    error, vessel_code, limit, after_code, stream = parse_active_equipments_args(request.args)
+    if error:
+        return {'message':error}, 400
     
-    vessel_code = req_args.get('vessel_code')
-    
-    vessel_query = db.session.query(vessel.id).filter(vessel.code==vessel_code)
-    query_results = db.session.execute(vessel_query).all()
-    if not len(query_results):
+    vessel_id = get_vessel_id(vessel_code)
+    if vessel_id is None:
         return {'message':'NO_VESSEL'}, 409
     
-    equipments = db.session.query(equipment).filter(equipment.vessel_id==query_results[0][0]).filter(equipment.active==True).all()
+    if stream:
+        equipments_query = active_equipments_select(vessel_id, limit, after_code, ordered=True)
+        return Response(stream_with_context(_stream_equipments(equipments_query)), mimetype='application/json')
+
+    media_type = negotiate_media_type(request.accept_mimetypes)
+    cache = response_cache()
+    if cache and not (limit or after_code):
+        cache_key = active_equipments_key(vessel_id, media_type)
+        cached = cache.get(cache_key)
+        if cached is None:
+            def read():
+                # Filled from the primary, a replica behind the write that bumped the generation would cache stale rows
+                with primary():
+                    return fill_active_equipments(db.session, cache, vessel_id, media_type)
+            cached = _coalesced(('active_equipments', vessel_id, media_type), read)
+        response = cached_response(*cached, mimetype=media_type, key=cache_key)
+        response.vary.add('Accept')
+        return response
+
+    def read():
+        return read_active_equipments(db.session, vessel_id, media_type, limit, after_code)
+
+    body = _coalesced(('active_equipments', read_target(), vessel_id, media_type, limit, after_code), read)
+    response = Response(body, mimetype=media_type)
+    response.vary.add('Accept')
+    return response
+
+
+@equipments_blueprint.route('/search', methods=['GET'])
+def search_equipment():
+    """Search the equipments of the fleet
+        ---
+        parameters:
+            - name: vessel_code
+              in: query
+              type: array
+              items:
+                type: string
+              collectionFormat: multi
+              required: false
+              description: only equipments of these vessels, repeat the parameter or separate the codes by commas
+            - name: code_prefix
+              in: query
+              type: string
+              required: false
+              description: only equipments whose code starts with this prefix
+            - name: name
+              in: query
+              type: string
+              required: false
+              description: only equipments whose name contains this text, case insensitive
+            - name: name_prefix
+              in: query
+              type: string
+              required: false
+              description: only equipments whose name starts with this text, case insensitive
+            - name: location
+              in: query
+              type: string
+              required: false
+              description: only equipments in this location
+            - name: active
+              in: query
+              type: boolean
+              required: false
+              description: only active (true) or inactive (false) equipments
+            - name: limit
+              in: query
+              type: integer
+              required: false
+              description: maximum number of equipments to return, ordered by code, 100 by default and at most 1000
+            - name: after_code
+              in: query
+              type: string
+              required: false
+              description: return only equipments with a code after this one, use the next_after_code of the previous page
+        responses:
+          200:
+            description: returns a json with equipments key and a list of equipments with their vessel_code, code, name, location and active, next_after_code holds the cursor of the next page or null on the last one
+          400:
+            description: returns WRONG_FORMAT if any parameter are sent in the wrong format
+          409:
+            description: returns NO_VESSEL if none of the vessel codes are in the system
+    """
+    error, filters, limit, after_code = parse_search_args(request.args)
+    if error:
+        return {'message':error}, 400
+
+    vessel_ids = None
+    if 'vessel_codes' in filters:
+        vessel_ids = list(get_vessel_ids(filters.pop('vessel_codes')).values())
+        if not vessel_ids:
+            return {'message':'NO_VESSEL'}, 409
+
+    equipments = db.session.execute(search_select(vessel_ids, limit=limit, after_code=after_code, **filters)).all()
+    return {'equipments':search_json(equipments),
+            'next_after_code':equipments[-1][1] if len(equipments) == limit else None}, 200
+
+
+def _stream_changes(changes_query, next_since):
+    """Yield the changes json document in pieces, reading the rows from a server side cursor"""
+    result = db.session.execute(changes_query.execution_options(stream_results=True))
+    yield '{"next_since":%d,"changes":[' % next_since
+    separator = ''
+    for rows in result.partitions(STREAM_BATCH_SIZE):
+        yield separator + ','.join(json.dumps(item) for item in changes_json(rows))
+        separator = ','
+    yield ']}'
+
+@equipments_blueprint.route('/changes', methods=['GET'])
+def equipment_changes():
+    """Return the equipments inserted or updated after a change version, to keep a mirror in sync
+        ---
+        parameters:
+            - name: since
+              in: query
+              type: integer
+              required: false
+              description: next_since of the previous call, 0 (the default) returns every equipment
+        responses:
+          200:
+            description: returns a json streamed in chunks with the changes key, a list of equipments with their vessel_code, code, name, location, active and version ordered by version, and next_since, the since of the next call
+          400:
+            description: returns WRONG_FORMAT if since is not a non negative integer
+    """
+    error, since = parse_changes_args(request.args)
+    if error:
+        return {'message':error}, 400
+
+    # Versions from the high water up may belong to transactions still running, they are left to the next call
+    high_water = db.session.execute(changes_high_water_select(dialect_name())).scalar()
+    changes_query = changes_select(since, high_water)
+    return Response(stream_with_context(_stream_changes(changes_query, max(since, high_water - 1))),
+                    mimetype='application/json')
+
+@equipments_blueprint.route('/active_at', methods=['GET'])
+def equipments_active_at():
+    """Return the equipments that were active on a vessel at a past time, from the status history
+        ---
+        parameters:
+            - name: vessel_code
+              in: query
+              type: string
+              required: true
+            - name: at
+              in: query
+              type: string
+              format: date-time
+              required: true
+              description: ISO 8601 timestamp, UTC when it has no offset
+        responses:
+          200:
+            description: returns a json with the vessel_code, at and the equipments key, a list of the equipments active at that time with their current name and location, ordered by code
+          400:
+            description: returns MISSING_PARAMETER if the vessel_code or at are not sent
+          400:
+            description: returns WRONG_FORMAT if at is not an ISO 8601 timestamp
+          409:
+            description: returns NO_VESSEL if the vessel is not already in the system
+    """
+    error, vessel_code, at = parse_active_at_args(request.args)
+    if error:
+        return {'message':error}, 400
+
+    vessel_id = get_vessel_id(vessel_code)
+    if vessel_id is None:
+        return {'message':'NO_VESSEL'}, 409
+
+    equipments = db.session.execute(active_at_select(vessel_id, at)).all()
+    return {'vessel_code':vessel_code, 'at':at.isoformat() + 'Z', 'equipments':equipments_json(equipments)}, 200
+
+@equipments_blueprint.route('/status_history', methods=['GET'])
+def equipment_status_history():
+    """Return the status transitions of the equipments of a vessel over a time range
+        ---
+        parameters:
+            - name: vessel_code
+              in: query
+              type: string
+              required: true
+            - name: since
+              in: query
+              type: string
+              format: date-time
+              required: false
+              description: only transitions at or after this ISO 8601 timestamp, UTC when it has no offset
+            - name: until
+              in: query
+              type: string
+              format: date-time
+              required: false
+              description: only transitions before this ISO 8601 timestamp
+            - name: code
+              in: query
+              type: string
+              required: false
+              description: only the transitions of this equipment
+            - name: limit
+              in: query
+              type: integer
+              required: false
+              description: maximum number of transitions to return, 1000 by default and at most 10000
+            - name: after_id
+              in: query
+              type: integer
+              required: false
+              description: return the transitions after this one, use the next_after_id of the previous page
+        responses:
+          200:
+            description: returns a json with the transitions key, a list of the id, code, active, previous_active and changed_at of each status change ordered by time (previous_active is null when the equipment was inserted), and next_after_id, the cursor of the next page or null on the last one
+          400:
+            description: returns MISSING_PARAMETER if the vessel_code is not sent
+          400:
+            description: returns WRONG_FORMAT if any parameter are sent in the wrong format or after_id is not a transition of the vessel
+          409:
+            description: returns NO_VESSEL if the vessel is not already in the system
+    """
+    error, vessel_code, since, until, code, limit, after_id = parse_status_history_args(request.args)
+    if error:
+        return {'message':error}, 400
 
-    equipment_json = {'equipments':[]}
+    vessel_id = get_vessel_id(vessel_code)
+    if vessel_id is None:
+        return {'message':'NO_VESSEL'}, 409
 
-    for equipment_obj in equipments:
-        equipment_json['equipments'].append({'code':equipment_obj.code, 'name':equipment_obj.name, 'location':equipment_obj.location})
+    after = None
+    if after_id is not None:
+        after_query = select(equipment_status_event.changed_at).where(equipment_status_event.id==after_id) \
+            .where(equipment_status_event.vessel_id==vessel_id)
+        after_changed_at = db.session.execute(after_query).scalar()
+        if after_changed_at is None:
+            return {'message':'WRONG_FORMAT'}, 400
+        after = (after_changed_at, after_id)
 
-    return equipment_json, 200
+    transitions = db.session.execute(transitions_select(vessel_id, since, until, code, limit, after)).all()
+    return {'transitions':transitions_json(transitions),
+            'next_after_id':transitions[-1][0] if len(transitions) == limit else None}, 200
 
+@equipments_blueprint.route('/statistics', methods=['GET'])
+def fleet_statistics():
+    """Return the number of active and inactive equipments of each vessel and of each location
+        ---
+        parameters:
+            - name: vessel_code
+              in: query
+              type: array
+              items:
+                type: string
+              collectionFormat: multi
+              required: false
+              description: only these vessels, repeat the parameter or separate the codes by commas
+        responses:
+          200:
+            description: returns a json with the vessels list (vessel_code, active, inactive), the locations list (location, active, inactive) and the total active and inactive
+          409:
+            description: returns NO_VESSEL if none of the vessel codes are in the system
+    """
+    vessel_ids = None
+    vessel_codes = [code for value in request.args.getlist('vessel_code') for code in value.split(',') if code]
+    if vessel_codes:
+        vessel_ids = list(get_vessel_ids(vessel_codes).values())
+        if not vessel_ids:
+            return {'message':'NO_VESSEL'}, 409
+
+    vessels = [{'vessel_code':code, 'active':int(active), 'inactive':int(inactive)}
+               for code, active, inactive in vessel_statistics(vessel_ids)]
+    locations = [{'location':location, 'active':int(active), 'inactive':int(inactive)}
+                 for location, active, inactive in location_statistics(vessel_ids)]
+    return {'vessels':vessels, 'locations':locations,
+            'total':{'active':sum(item['active'] for item in vessels), 'inactive':sum(item['inactive'] for item in vessels)}}, 200
+
+@equipments_blueprint.route('/statistics/check', methods=['GET'])
+@admin_only
+def check_statistics():
+    """Compare the statistics counters with the equipments and report the drift
+        Scans the whole equipments table, it requires the X-Admin-Key header.
+        ---
+        parameters:
+            - name: X-Admin-Key
+              in: header
+              type: string
+              required: true
+        responses:
+          200:
+            description: returns a json with the drift list, the counted and actual active and inactive of each vessel_id and location that differ
+          403:
+            description: returns FORBIDDEN if the X-Admin-Key header does not match ADMIN_API_KEY, or it is not configured
+    """
+    return {'drift':check_counters()}, 200
+
+@equipments_blueprint.route('/statistics/rebuild', methods=['PUT'])
+@admin_only
+def rebuild_statistics():
+    """Rebuild the statistics counters from the equipments
+        Locks the counters against every write while the equipments are counted, it requires the
+        X-Admin-Key header. Prefer flask check-statistics --repair.
+        ---
+        parameters:
+            - name: X-Admin-Key
+              in: header
+              type: string
+              required: true
+        responses:
+          200:
+            description: returns OK and the drift that was corrected
+          403:
+            description: returns FORBIDDEN if the X-Admin-Key header does not match ADMIN_API_KEY, or it is not configured
+    """
+    return {'message':'OK', 'drift':check_counters(repair=True)}, 200
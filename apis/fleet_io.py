@@ -0,0 +1,324 @@
+"""Import and export of vessels and equipments from CSV or Parquet files
+
+The files are read and written in chunks of --chunk-size rows so the memory stays bounded whatever
+their size. The commands are registered in manage.py:
+
+    flask import-vessels vessels.csv
+    flask import-equipments equipments.parquet --rejects rejected.csv
+    flask export-snapshot fleet.parquet --active-only
+"""
+import io
+import os
+from datetime import datetime
+
+import click
+from flask.cli import with_appcontext
+from flask_sqlalchemy import get_debug_queries
+from sqlalchemy import Boolean, Column, Integer, MetaData, String, Table, cast, func, literal, null, select, text
+from sqlalchemy.dialects import sqlite
+
+from apis.models.equipment import change_version, equipment
+from apis.models.equipment_counter import equipment_counter
+from apis.models.equipment_status_event import equipment_status_event
+from apis.models.vessel import vessel
+from apis.models.model import db
+from apis.response_cache import invalidate_active_equipments
+from apis.queries import changes_high_water_select
+from apis.utils import dialect_name, insert_ignoring_conflicts
+
+
+IMPORT_CHUNK_SIZE = 100000
+EXPORT_CHUNK_SIZE = 100000
+EQUIPMENT_COLUMNS = ('vessel_code', 'code', 'name', 'location')
+SNAPSHOT_COLUMNS = ('vessel_code', 'code', 'name', 'location', 'active', 'version')
+TRUE_VALUES = ('1', 'true', 't', 'yes')
+FALSE_VALUES = ('0', 'false', 'f', 'no')
+
+# Each chunk is loaded here first, then moved to equipments with one INSERT ... SELECT joined with vessels
+equipment_import = Table('equipment_import', MetaData(),
+                         Column('vessel_code', String(8)),
+                         Column('code', String(8)),
+                         Column('name', String(256)),
+                         Column('location', String(256)),
+                         Column('active', Boolean),
+                         prefixes=['TEMPORARY'])
+
+# Inserts the staged chunk, skipping the codes already in the system, and adds it to the history and the counters
+# (postgresql only)
+MOVE_IMPORT_STATEMENT = text("""
+    WITH inserted AS (
+        INSERT INTO equipments (vessel_id, code, name, location, active, version)
+        SELECT vessels.id, equipment_import.code, equipment_import.name, equipment_import.location,
+               equipment_import.active, txid_current()
+        FROM equipment_import JOIN vessels ON vessels.code = equipment_import.vessel_code
+        ON CONFLICT (code) DO NOTHING
+        RETURNING vessel_id, code, location, active
+    ),
+    events AS (
+        INSERT INTO equipment_status_events (vessel_id, code, active, previous_active, changed_at)
+        SELECT vessel_id, code, active, NULL, CAST(:changed_at AS timestamp) FROM inserted
+    ),
+    counted AS (
+        INSERT INTO equipment_counters (vessel_id, location, active_count, inactive_count)
+        SELECT vessel_id, location, SUM(CASE WHEN active THEN 1 ELSE 0 END), SUM(CASE WHEN active THEN 0 ELSE 1 END)
+        FROM inserted GROUP BY vessel_id, location ORDER BY vessel_id, location
+        ON CONFLICT (vessel_id, location) DO UPDATE
+        SET active_count = equipment_counters.active_count + excluded.active_count,
+            inactive_count = equipment_counters.inactive_count + excluded.inactive_count
+    )
+    SELECT vessel_id, COUNT(*) FROM inserted GROUP BY vessel_id
+""")
+
+
+def detect_format(path, file_format=None):
+    """csv or parquet, from --format or the extension of path"""
+    file_format = file_format or os.path.splitext(path)[1].lstrip('.').lower()
+    if file_format not in ('csv', 'parquet'):
+        raise click.BadParameter(f'unknown format of {path}, use --format csv or parquet')
+    return file_format
+
+
+def read_chunks(path, chunk_size, file_format=None):
+    """Yield the rows of a CSV or Parquet file as DataFrames of at most chunk_size rows, every column as str"""
+    import pandas
+
+    if detect_format(path, file_format) == 'csv':
+        yield from pandas.read_csv(path, chunksize=chunk_size, dtype=str, keep_default_na=False)
+        return
+
+    import pyarrow.parquet
+    for batch in pyarrow.parquet.ParquetFile(path).iter_batches(batch_size=chunk_size):
+        frame = batch.to_pandas()
+        for column in frame.columns:
+            frame[column] = frame[column].astype(str).where(frame[column].notna(), '')
+        yield frame
+
+
+def _invalid_text(column, length):
+    """Mask of the values of a str column that are empty or longer than length"""
+    sizes = column.str.len()
+    return (sizes == 0) | (sizes > length)
+
+
+def validate_equipment_frame(frame):
+    """Validate a chunk of equipments column by column
+
+    Returns the valid rows, with active parsed to bool (True when the column is not in the file), and
+    a Series with the error message of each rejected row.
+    """
+    import pandas
+
+    missing = [column for column in EQUIPMENT_COLUMNS if column not in frame.columns]
+    if missing:
+        raise click.ClickException(f"missing columns: {', '.join(missing)}")
+
+    errors = pandas.Series(None, index=frame.index, dtype=object)
+    for column, length in (('vessel_code', vessel.code.type.length), ('code', equipment.code.type.length),
+                           ('name', equipment.name.type.length), ('location', equipment.location.type.length)):
+        errors = errors.mask(errors.isna() & _invalid_text(frame[column], length), f'WRONG_FORMAT {column}')
+
+    if 'active' in frame.columns:
+        active = frame['active'].str.lower()
+        errors = errors.mask(errors.isna() & ~active.isin(TRUE_VALUES + FALSE_VALUES), 'WRONG_FORMAT active')
+        active = active.isin(TRUE_VALUES)
+    else:
+        active = pandas.Series(True, index=frame.index)
+    errors = errors.mask(errors.isna() & frame['code'].duplicated(), 'REPEATED_CODE')
+
+    valid = frame.loc[errors.isna(), list(EQUIPMENT_COLUMNS)].copy()
+    valid['active'] = active[errors.isna()].astype(bool)
+    return valid, errors.dropna()
+
+
+def _stage_chunk(connection, valid):
+    if connection.dialect.name == 'postgresql':
+        buffer = io.StringIO()
+        valid.to_csv(buffer, index=False, header=False)
+        buffer.seek(0)
+        with connection.connection.cursor() as cursor:
+            cursor.copy_expert('COPY equipment_import (vessel_code, code, name, location, active) FROM STDIN WITH (FORMAT csv)',
+                               buffer)
+    else:
+        connection.execute(equipment_import.insert(), valid.to_dict('records'))
+
+
+def _move_chunk(connection):
+    """Move the staged chunk to equipments and the counters, return the number of equipments inserted and their vessel ids"""
+    if connection.dialect.name == 'postgresql':
+        inserted = dict(connection.execute(MOVE_IMPORT_STATEMENT, {'changed_at':datetime.utcnow()}).all())
+        connection.execute(equipment_import.delete())
+        return sum(inserted.values()), set(inserted)
+
+    # SQLite serializes the writers, the codes already in the system can be dropped before the insert
+    # A correlated EXISTS probes the unique index, IN (SELECT ...) would materialize every code of the table
+    known = select(equipment.id).where(equipment.code==equipment_import.c.code).exists()
+    connection.execute(equipment_import.delete().where(known))
+    vessel_ids = set(connection.execute(
+        select(vessel.id).distinct().select_from(equipment_import.join(vessel, vessel.code==equipment_import.c.vessel_code))
+    ).scalars())
+    staged = select(vessel.id, equipment_import.c.code, equipment_import.c.name, equipment_import.c.location,
+                    equipment_import.c.active, change_version()) \
+        .select_from(equipment_import.join(vessel, vessel.code==equipment_import.c.vessel_code))
+    inserted = connection.execute(equipment.__table__.insert().from_select(
+        ['vessel_id', 'code', 'name', 'location', 'active', 'version'], staged)).rowcount
+    events = select(vessel.id, equipment_import.c.code, equipment_import.c.active, null(), literal(datetime.utcnow())) \
+        .select_from(equipment_import.join(vessel, vessel.code==equipment_import.c.vessel_code))
+    connection.execute(equipment_status_event.__table__.insert().from_select(
+        ['vessel_id', 'code', 'active', 'previous_active', 'changed_at'], events))
+
+    # The WHERE is required by SQLite to tell the ON CONFLICT of the INSERT from a join constraint
+    counted = select(vessel.id, equipment_import.c.location, func.sum(cast(equipment_import.c.active, Integer)),
+                     func.sum(1 - cast(equipment_import.c.active, Integer))) \
+        .select_from(equipment_import.join(vessel, vessel.code==equipment_import.c.vessel_code)) \
+        .where(text('true')).group_by(vessel.id, equipment_import.c.location)
+    statement = sqlite.insert(equipment_counter.__table__) \
+        .from_select(['vessel_id', 'location', 'active_count', 'inactive_count'], counted)
+    connection.execute(statement.on_conflict_do_update(
+        index_elements=[equipment_counter.vessel_id, equipment_counter.location],
+        set_={'active_count':equipment_counter.active_count + statement.excluded.active_count,
+              'inactive_count':equipment_counter.inactive_count + statement.excluded.inactive_count}))
+    connection.execute(equipment_import.delete())
+    return inserted, vessel_ids
+
+
+def _forget_recorded_queries():
+    # With DEBUG Flask-SQLAlchemy keeps every statement and its parameters until the app context ends,
+    # which is the whole command, so the staged rows of each chunk would never be freed
+    del get_debug_queries()[:]
+
+
+def _report_rejects(rejects, frame, errors, offset, rejects_file):
+    """Append the rejected rows to the rejects CSV, numbered from 1 as in the imported file"""
+    if rejects_file is None or errors.empty:
+        return
+    rejected = frame.loc[errors.index].copy()
+    rejected.insert(0, 'row', rejected.index - frame.index[0] + offset + 1)
+    rejected['message'] = errors
+    rejected.to_csv(rejects_file, index=False, header=rejects['header'])
+    rejects['header'] = False
+
+
+@click.command('import-equipments')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--format', 'file_format', type=click.Choice(['csv', 'parquet']), help='format of the file, by default from its extension')
+@click.option('--chunk-size', type=int, default=IMPORT_CHUNK_SIZE, show_default=True, help='rows loaded by each transaction')
+@click.option('--rejects', type=click.Path(dir_okay=False, writable=True), help='write the rejected rows and the reason to this CSV')
+@with_appcontext
+def import_equipments_command(path, file_format, chunk_size, rejects):
+    """Import the equipments of a CSV or Parquet file with vessel_code, code, name, location and optionally active
+
+    Rows with a code already in the system are skipped, so an interrupted import can be run again.
+    """
+    totals = {'read':0, 'rejected':0, 'no_vessel':0, 'repeated_code':0, 'inserted':0}
+    rejects_state = {'header':True}
+    rejects_file = open(rejects, 'w', newline='') if rejects else None
+    try:
+        with db.engine.connect() as connection:
+            equipment_import.create(connection)
+            for frame in read_chunks(path, chunk_size, file_format):
+                valid, errors = validate_equipment_frame(frame)
+                _report_rejects(rejects_state, frame, errors, totals['read'], rejects_file)
+
+                with connection.begin():
+                    _stage_chunk(connection, valid)
+                    known_vessels = connection.execute(
+                        select(func.count()).select_from(equipment_import.join(vessel, vessel.code==equipment_import.c.vessel_code))
+                    ).scalar()
+                    inserted, vessel_ids = _move_chunk(connection)
+                # The workers sharing a file response cache stop serving the lists from before the chunk
+                invalidate_active_equipments(vessel_ids)
+
+                totals['read'] += len(frame)
+                totals['rejected'] += len(errors)
+                totals['no_vessel'] += len(valid) - known_vessels
+                totals['repeated_code'] += known_vessels - inserted
+                totals['inserted'] += inserted
+                _forget_recorded_queries()
+                click.echo(f"{totals['read']} rows read, {totals['inserted']} inserted")
+    finally:
+        if rejects_file:
+            rejects_file.close()
+
+    click.echo(', '.join(f'{name} {count}' for name, count in totals.items()))
+
+
+@click.command('import-vessels')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--format', 'file_format', type=click.Choice(['csv', 'parquet']), help='format of the file, by default from its extension')
+@click.option('--chunk-size', type=int, default=IMPORT_CHUNK_SIZE, show_default=True, help='rows loaded by each transaction')
+@with_appcontext
+def import_vessels_command(path, file_format, chunk_size):
+    """Import the vessels of a CSV or Parquet file with a code column, the codes already in the system are skipped"""
+    totals = {'read':0, 'rejected':0, 'inserted':0}
+    with db.engine.connect() as connection:
+        for frame in read_chunks(path, chunk_size, file_format):
+            if 'code' not in frame.columns:
+                raise click.ClickException('missing columns: code')
+            codes = frame['code']
+            invalid = _invalid_text(codes, vessel.code.type.length)
+            codes = codes[~invalid].drop_duplicates().tolist()
+
+            with connection.begin():
+                existing = connection.execute(select(func.count()).select_from(vessel).where(vessel.code.in_(codes))).scalar() if codes else 0
+                if codes:
+                    connection.execute(insert_ignoring_conflicts(vessel.__table__, ['code']), [{'code':code} for code in codes])
+
+            totals['read'] += len(frame)
+            totals['rejected'] += int(invalid.sum())
+            totals['inserted'] += len(codes) - existing
+            _forget_recorded_queries()
+    click.echo(', '.join(f'{name} {count}' for name, count in totals.items()))
+
+
+@click.command('export-snapshot')
+@click.argument('path', type=click.Path(dir_okay=False, writable=True))
+@click.option('--format', 'file_format', type=click.Choice(['csv', 'parquet']), help='format of the file, by default from its extension')
+@click.option('--chunk-size', type=int, default=EXPORT_CHUNK_SIZE, show_default=True, help='rows fetched from the cursor at a time')
+@click.option('--active-only', is_flag=True, help='export only the active equipments')
+@with_appcontext
+def export_snapshot_command(path, file_format, chunk_size, active_only):
+    """Export every equipment with its vessel code, reading them from a server side cursor
+
+    The version column is the change version of each row. A mirror loaded from the snapshot follows
+    /equipment/changes from the since printed at the end (and kept as next_since in the parquet
+    metadata), the high water of the snapshot as /equipment/changes computes it. The highest
+    exported version is not a resume point: on postgresql a transaction running during the export
+    commits later with a lower version.
+    """
+    import pandas
+
+    file_format = detect_format(path, file_format)
+    query = select(vessel.code, equipment.code, equipment.name, equipment.location, equipment.active, equipment.version) \
+        .join(vessel, vessel.id==equipment.vessel_id).order_by(equipment.id)
+    if active_only:
+        query = query.where(equipment.active==True)
+
+    exported = 0
+    with db.engine.connect() as connection:
+        dialect = dialect_name(connection)
+        if dialect == 'postgresql':
+            # The high water and the rows are read from the same snapshot
+            connection = connection.execution_options(isolation_level='REPEATABLE READ')
+        transaction = connection.begin()
+        next_since = connection.execute(changes_high_water_select(dialect)).scalar() - 1
+        result = connection.execution_options(stream_results=True).execute(query)
+        with open(path, 'wb') as output_file:
+            if file_format == 'csv':
+                output_file.write((','.join(SNAPSHOT_COLUMNS) + '\n').encode())
+                for rows in result.partitions(chunk_size):
+                    output_file.write(pandas.DataFrame(rows, columns=SNAPSHOT_COLUMNS).to_csv(index=False, header=False).encode())
+                    exported += len(rows)
+            else:
+                import pyarrow
+                import pyarrow.parquet
+                schema = pyarrow.schema([('vessel_code', pyarrow.string()), ('code', pyarrow.string()),
+                                         ('name', pyarrow.string()), ('location', pyarrow.string()),
+                                         ('active', pyarrow.bool_()), ('version', pyarrow.int64())],
+                                        metadata={'next_since':str(next_since)})
+                with pyarrow.parquet.ParquetWriter(output_file, schema) as writer:
+                    for rows in result.partitions(chunk_size):
+                        frame = pandas.DataFrame(rows, columns=SNAPSHOT_COLUMNS)
+                        writer.write_table(pyarrow.Table.from_pandas(frame, schema=schema, preserve_index=False))
+                        exported += len(rows)
+        transaction.rollback()
+    click.echo(f'{exported} equipments exported, follow /equipment/changes from since={next_since}')
@@ -0,0 +1,131 @@
+import click
+from flask.cli import with_appcontext
+from sqlalchemy import case, func, select, text
+from sqlalchemy.dialects import postgresql, sqlite
+
+from apis.models.equipment import equipment
+from apis.models.equipment_counter import equipment_counter
+from apis.models.vessel import vessel
+from apis.models.model import db
+from apis.utils import dialect_name
+
+
+class CounterDeltas(object):
+    """Changes to the equipment counters made by a transaction, by vessel and location"""
+
+    def __init__(self):
+        self._deltas = {}
+
+    def add(self, vessel_id, location, active=0, inactive=0):
+        delta = self._deltas.setdefault((vessel_id, location), [0, 0])
+        delta[0] += active
+        delta[1] += inactive
+
+    def rows(self):
+        # Sorted so concurrent transactions lock the counter rows in the same order and never deadlock
+        return [{'vessel_id':vessel_id, 'location':location, 'active_count':active, 'inactive_count':inactive}
+                for (vessel_id, location), (active, inactive) in sorted(self._deltas.items()) if active or inactive]
+
+
+def counters_upsert(dialect):
+    """Return the statement adding the rows of CounterDeltas to the counters, creating the missing ones"""
+    insert = postgresql.insert if dialect == 'postgresql' else sqlite.insert
+    statement = insert(equipment_counter.__table__)
+    return statement.on_conflict_do_update(
+        index_elements=[equipment_counter.vessel_id, equipment_counter.location],
+        set_={'active_count':equipment_counter.active_count + statement.excluded.active_count,
+              'inactive_count':equipment_counter.inactive_count + statement.excluded.inactive_count})
+
+
+def apply_counter_deltas(deltas, connection=None):
+    """Add the deltas to the counters in the running transaction of connection, the session by default"""
+    connection = db.session if connection is None else connection
+    rows = deltas.rows()
+    if rows:
+        connection.execute(counters_upsert(dialect_name(connection)), rows)
+
+
+def inserted_deltas(rows):
+    """CounterDeltas of inserting the equipment rows (dicts with vessel_id, location and active)"""
+    deltas = CounterDeltas()
+    for row in rows:
+        deltas.add(row['vessel_id'], row['location'], active=1 if row['active'] else 0, inactive=0 if row['active'] else 1)
+    return deltas
+
+
+def vessel_statistics(vessel_ids=None):
+    """Return (vessel code, active, inactive) of every vessel, or of vessel_ids, ordered by code"""
+    query = select(vessel.code, func.coalesce(func.sum(equipment_counter.active_count), 0),
+                   func.coalesce(func.sum(equipment_counter.inactive_count), 0)) \
+        .select_from(vessel).outerjoin(equipment_counter, equipment_counter.vessel_id==vessel.id) \
+        .group_by(vessel.code).order_by(vessel.code)
+    if vessel_ids is not None:
+        query = query.where(vessel.id.in_(vessel_ids))
+    return db.session.execute(query).all()
+
+
+def location_statistics(vessel_ids=None):
+    """Return (location, active, inactive) of every location, ordered by location"""
+    query = select(equipment_counter.location, func.sum(equipment_counter.active_count),
+                   func.sum(equipment_counter.inactive_count)) \
+        .group_by(equipment_counter.location).order_by(equipment_counter.location)
+    if vessel_ids is not None:
+        query = query.where(equipment_counter.vessel_id.in_(vessel_ids))
+    return db.session.execute(query).all()
+
+
+def actual_counters_select():
+    """Count the equipments of each vessel and location from the equipments table"""
+    return select(equipment.vessel_id, equipment.location,
+                  func.sum(case((equipment.active==True, 1), else_=0)),
+                  func.sum(case((equipment.active==True, 0), else_=1))) \
+        .group_by(equipment.vessel_id, equipment.location)
+
+
+def check_counters(repair=False):
+    """Compare the counters with the equipments table and return the drift of each vessel and location
+
+    With repair the counters are rebuilt from the table in the same transaction. On postgresql the
+    counters are locked first, so the writes that commit meanwhile are added on top of the rebuilt values.
+    """
+    if repair and dialect_name() == 'postgresql':
+        db.session.execute(text('LOCK TABLE equipment_counters IN EXCLUSIVE MODE'))
+
+    actual = {(vessel_id, location):(int(active), int(inactive))
+              for vessel_id, location, active, inactive in db.session.execute(actual_counters_select())}
+    counters_query = select(equipment_counter.vessel_id, equipment_counter.location,
+                            equipment_counter.active_count, equipment_counter.inactive_count)
+    counted = {(vessel_id, location):(active, inactive)
+               for vessel_id, location, active, inactive in db.session.execute(counters_query)}
+
+    drift = []
+    for key in sorted(set(actual) | set(counted)):
+        expected = actual.get(key, (0, 0))
+        found = counted.get(key, (0, 0))
+        if expected != found:
+            drift.append({'vessel_id':key[0], 'location':key[1], 'active':found[0], 'inactive':found[1],
+                          'actual_active':expected[0], 'actual_inactive':expected[1]})
+
+    if repair:
+        if drift:
+            db.session.execute(equipment_counter.__table__.delete())
+            rows = [{'vessel_id':vessel_id, 'location':location, 'active_count':active, 'inactive_count':inactive}
+                    for (vessel_id, location), (active, inactive) in sorted(actual.items())]
+            if rows:
+                db.session.execute(equipment_counter.__table__.insert(), rows)
+        db.session.commit()
+    else:
+        db.session.rollback()
+    return drift
+
+
+@click.command('check-statistics')
+@click.option('--repair', is_flag=True, help='rebuild the counters from the equipments table')
+@with_appcontext
+def check_statistics_command(repair):
+    """Report the drift of the fleet statistics counters from the equipments table"""
+    drift = check_counters(repair=repair)
+    for item in drift:
+        click.echo(f"vessel {item['vessel_id']} {item['location']}: active {item['active']} (actual {item['actual_active']}), "
+                   f"inactive {item['inactive']} (actual {item['actual_inactive']})")
+    click.echo(f"{len(drift)} counters drifted" + (', rebuilt' if repair and drift else ''))
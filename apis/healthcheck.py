@@ -1,4 +1,12 @@
-from flask import Blueprint
+from flask import Blueprint, current_app
+
+from apis.models.model import db
+from apis.vessel_cache import vessel_cache
+from apis.response_cache import response_cache
+from apis.single_flight import single_flight
+from apis.read_replicas import PRIMARY, read_replicas
+from apis.readiness import pool_status, readiness_probes
+from apis.idempotency import idempotency_store
 
 healthcheck_blueprint = Blueprint('healthcheck', __name__)
 
@@ -14,3 +22,57 @@ def healthcheck():
     """
     return 'OK', 200
 
+
+@healthcheck_blueprint.route('/live', methods=['GET'])
+def liveness():
+
+    """Checks if the worker is running, without touching the database
+        ---
+        responses:
+          200:
+            description: OK while the worker answers requests
+    """
+    return {'message':'OK'}, 200
+
+
+@healthcheck_blueprint.route('/ready', methods=['GET'])
+def readiness():
+
+    """Checks if the worker can serve requests: its database answers and its pool has a free connection
+        ---
+        responses:
+          200:
+            description: returns OK with, for the primary and each replica, the pool connections and the last probe (ok, latency_ms, last_success_seconds_ago), and the state of the caches. The probe result is reused for READINESS_PROBE_INTERVAL seconds
+          503:
+            description: returns NOT_READY with the same details when the primary probe fails or its pool is exhausted, a failing replica is only reported
+    """
+    targets = [PRIMARY] + (read_replicas().bind_keys if read_replicas() else [])
+    databases = {}
+    for target in targets:
+        engine = db.get_engine(current_app, bind=None if target == PRIMARY else target)
+        pool = pool_status(engine)
+        # A probe on an exhausted pool would wait for a connection, the last result is reported instead
+        probe = readiness_probes().probe(target)
+        databases[target] = {'pool':pool, 'probe':probe.result() if pool['exhausted'] else probe.check(engine)}
+
+    primary = databases[PRIMARY]
+    ready = primary['probe']['ok'] and not primary['pool']['exhausted']
+    cache = response_cache()
+    caches = {'vessel_cache':{'warm':vessel_cache().warmed, 'size':len(vessel_cache())},
+              'response_cache':cache.stats() if cache else None}
+    return {'message':'OK' if ready else 'NOT_READY', 'databases':databases, 'caches':caches}, 200 if ready else 503
+
+
+@healthcheck_blueprint.route('/cache_stats', methods=['GET'])
+def cache_stats():
+
+    """Return the hit, miss and eviction counters of the in process caches and the coalesced requests
+        ---
+        responses:
+          200:
+            description: returns a json with the counters of each cache, single_flight holds the reads made (flights) and the requests that shared another one (coalesced), idempotency the retries answered with a stored response (replays)
+    """
+    cache = response_cache()
+    flights = single_flight()
+    return {'vessel_cache':vessel_cache().stats(), 'response_cache':cache.stats() if cache else None,
+            'single_flight':flights.stats() if flights else None, 'idempotency':idempotency_store().stats()}, 200
@@ -0,0 +1,225 @@
+import functools
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+from flask import Response, current_app, request
+from sqlalchemy import and_, or_, select
+
+from apis.models.idempotency_key import idempotency_key
+from apis.models.model import db
+from apis.utils import dialect_name, insert_ignoring_conflicts
+
+
+IDEMPOTENCY_HEADER = 'Idempotency-Key'
+IDEMPOTENCY_KEY_LENGTH = 255
+IDEMPOTENCY_TTL_SECONDS = 86400
+IDEMPOTENCY_CACHE_SIZE = 10000
+# A request that has not stored its response after this long is taken as lost (e.g. its worker died)
+IDEMPOTENCY_LOCK_SECONDS = 60
+IDEMPOTENCY_PURGE_INTERVAL = 60
+
+
+class IdempotencyStore(object):
+    """Bounded LRU of the stored responses of the worker, in front of the idempotency_keys table
+
+    The entries are (fingerprint, status_code, body) and expire ttl seconds after being stored.
+    """
+
+    def __init__(self, maxsize=IDEMPOTENCY_CACHE_SIZE, ttl=IDEMPOTENCY_TTL_SECONDS):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.replays = 0
+        self.in_progress = 0
+        self.last_purge = time.monotonic()
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[1] < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, entry, ttl=None):
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._entries[key] = (entry, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def count(self, counter):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def purge_due(self, interval=IDEMPOTENCY_PURGE_INTERVAL):
+        """True once every interval seconds, for the worker that should delete the expired rows"""
+        with self._lock:
+            if time.monotonic() - self.last_purge < interval:
+                return False
+            self.last_purge = time.monotonic()
+            return True
+
+    def stats(self):
+        with self._lock:
+            return {'size':len(self._entries), 'maxsize':self.maxsize, 'hits':self.hits, 'replays':self.replays,
+                    'in_progress':self.in_progress}
+
+
+def create_idempotency_store(settings):
+    return IdempotencyStore(maxsize=settings.get('IDEMPOTENCY_CACHE_SIZE', IDEMPOTENCY_CACHE_SIZE),
+                            ttl=settings.get('IDEMPOTENCY_TTL_SECONDS', IDEMPOTENCY_TTL_SECONDS))
+
+
+def init_idempotency(app):
+    store = create_idempotency_store(app.config)
+    app.extensions['idempotency_store'] = store
+    return store
+
+
+def idempotency_store():
+    return current_app.extensions['idempotency_store']
+
+
+def body_fingerprint(body):
+    """Hash of a json body, the retries of a request must send the same one with the same key"""
+    return hashlib.sha256(json.dumps(body, sort_keys=True).encode()).hexdigest()
+
+
+def request_fingerprint():
+    return body_fingerprint(request.get_json(silent=True))
+
+
+def claim_key(connection, key, fingerprint, ttl, lock_seconds=IDEMPOTENCY_LOCK_SECONDS):
+    """Register the request as the one running for key and return None, or the row of the request that already has it
+
+    The claim is written on connection, the caller commits it before running the request.
+    """
+    now = datetime.utcnow()
+    values = {'fingerprint':fingerprint, 'status_code':None, 'response':None, 'created_at':now,
+              'expires_at':now + timedelta(seconds=ttl)}
+    table = idempotency_key.__table__
+    claimed = connection.execute(insert_ignoring_conflicts(table, ['key'], dialect_name(connection))
+                                 .values(key=key, **values)).rowcount
+    if not claimed:
+        # Expired keys and requests that never stored their response can be taken over
+        lost = now - timedelta(seconds=lock_seconds)
+        claimed = connection.execute(table.update().where(and_(
+            idempotency_key.key==key,
+            or_(idempotency_key.expires_at < now, and_(idempotency_key.status_code.is_(None), idempotency_key.created_at < lost))
+        )).values(**values)).rowcount
+    if claimed:
+        return None
+    return connection.execute(select(idempotency_key.fingerprint, idempotency_key.status_code, idempotency_key.response,
+                                     idempotency_key.expires_at).where(idempotency_key.key==key)).first()
+
+
+def release_key(connection, key):
+    connection.execute(idempotency_key.__table__.delete().where(idempotency_key.key==key))
+
+
+def store_key_response(connection, key, status_code, body):
+    connection.execute(idempotency_key.__table__.update().where(idempotency_key.key==key)
+                       .values(status_code=status_code, response=body))
+
+
+def purge_expired_keys(connection):
+    connection.execute(idempotency_key.__table__.delete().where(idempotency_key.expires_at < datetime.utcnow()))
+
+
+def stored_entry(store, key, row):
+    """Cache the stored response of row in store and return its (fingerprint, status_code, body) entry"""
+    entry = (row.fingerprint, row.status_code, row.response)
+    store.set(key, entry, ttl=(row.expires_at - datetime.utcnow()).total_seconds())
+    return entry
+
+
+def _claim(key, fingerprint, ttl):
+    row = claim_key(db.session, key, fingerprint, ttl,
+                    current_app.config.get('IDEMPOTENCY_LOCK_SECONDS', IDEMPOTENCY_LOCK_SECONDS))
+    if row is None:
+        db.session.commit()
+    else:
+        db.session.rollback()
+    return row
+
+
+def _release(key):
+    db.session.rollback()
+    release_key(db.session, key)
+    db.session.commit()
+
+
+def _purge_expired(store):
+    if store.purge_due(current_app.config.get('IDEMPOTENCY_PURGE_INTERVAL', IDEMPOTENCY_PURGE_INTERVAL)):
+        purge_expired_keys(db.session)
+        db.session.commit()
+
+
+def _replay(store, fingerprint, entry):
+    stored_fingerprint, status_code, body = entry
+    if stored_fingerprint != fingerprint:
+        return {'message':'IDEMPOTENCY_KEY_REUSED'}, 422
+    store.count('replays')
+    response = Response(body, status=status_code, mimetype='application/json')
+    response.headers['Idempotent-Replayed'] = 'true'
+    return response
+
+
+def idempotent(view):
+    """Make a write view safe to retry with an Idempotency-Key header
+
+    The first request with a key runs the view and stores its response, the retries with the same
+    key and body get the stored response without running it again, for IDEMPOTENCY_TTL_SECONDS. A
+    retry arriving while the first request is still running is answered with 409 IN_PROGRESS. The
+    5xx responses are not stored, the request can be retried with the same key.
+    """
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        header = request.headers.get(IDEMPOTENCY_HEADER)
+        if header is None:
+            return view(*args, **kwargs)
+        if not header or len(header) > IDEMPOTENCY_KEY_LENGTH:
+            return {'message':'WRONG_FORMAT'}, 400
+
+        store = idempotency_store()
+        key = f'{request.endpoint}:{header}'
+        fingerprint = request_fingerprint()
+        entry = store.get(key)
+        if entry is not None:
+            return _replay(store, fingerprint, entry)
+
+        _purge_expired(store)
+        row = _claim(key, fingerprint, store.ttl)
+        if row is not None:
+            if row.status_code is None:
+                store.count('in_progress')
+                return {'message':'IN_PROGRESS'}, 409, {'Retry-After':'1'}
+            return _replay(store, fingerprint, stored_entry(store, key, row))
+
+        try:
+            response = current_app.make_response(view(*args, **kwargs))
+        except BaseException:
+            _release(key)
+            raise
+        if response.status_code >= 500:
+            _release(key)
+            return response
+
+        body = response.get_data(as_text=True)
+        store_key_response(db.session, key, response.status_code, body)
+        db.session.commit()
+        store.set(key, (fingerprint, response.status_code, body))
+        return response
+    return wrapper
@@ -0,0 +1,247 @@
+import bisect
+import fcntl
+import functools
+import hashlib
+import mmap
+import os
+import struct
+import threading
+import time
+
+from flask import current_app, g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from apis.load_control import LOCK_STRIPES
+
+
+# Upper bounds of the histogram buckets, the last bucket (+Inf) is implicit
+SECONDS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERIES_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+METRICS_SLOTS = 1024
+SERIES_KEY_SIZE = 128
+SERIES_MAX_BUCKETS = 16
+
+
+class MemorySeries(object):
+    """Bucket counts and sum of each histogram series, in the memory of the worker"""
+
+    def __init__(self):
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def add(self, key, position, value, size):
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * size, 0.0]
+            series[0][position] += 1
+            series[1] += value
+
+    def read(self):
+        """Return a dict of key -> (bucket counts, sum)"""
+        with self._lock:
+            return {key:(list(counts), total) for key, (counts, total) in self._series.items()}
+
+
+class SharedSeries(object):
+    """Bucket counts and sum of each histogram series in a memory mapped file shared by the worker processes
+
+    The file holds a fixed table of slots (key hash, key, bucket counts, sum) found by linear probing
+    from the key hash and locked like the SharedBuckets of apis.load_control. The series that do not
+    fit in the table once it is full are not recorded.
+    """
+    SLOT = struct.Struct(f'<Q{SERIES_KEY_SIZE}s{SERIES_MAX_BUCKETS}Qd')
+
+    def __init__(self, path, slots=METRICS_SLOTS):
+        self.path = path
+        self.slots = slots
+        size = slots * self.SLOT.size
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        if os.fstat(self._fd).st_size < size:
+            os.ftruncate(self._fd, size)
+        self._map = mmap.mmap(self._fd, size)
+        self._locks = [threading.Lock() for _ in range(LOCK_STRIPES)]
+
+    def _locked(self, slot, update):
+        offset = slot * self.SLOT.size
+        with self._locks[slot % LOCK_STRIPES]:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX, self.SLOT.size, offset)
+            try:
+                return update(offset)
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN, self.SLOT.size, offset)
+
+    def add(self, key, position, value, size):
+        encoded = key.encode()[:SERIES_KEY_SIZE]
+        # Zero marks an empty slot
+        digest = int.from_bytes(hashlib.blake2b(encoded, digest_size=8).digest(), 'little') or 1
+
+        def update(offset):
+            stored, stored_key, *counts, total = self.SLOT.unpack_from(self._map, offset)
+            if stored == 0:
+                stored, stored_key, counts, total = digest, encoded, [0] * SERIES_MAX_BUCKETS, 0.0
+            elif stored != digest:
+                return False
+            counts[position] += 1
+            self.SLOT.pack_into(self._map, offset, stored, stored_key, *counts, total + value)
+            return True
+
+        start = digest % self.slots
+        for probe in range(self.slots):
+            if self._locked((start + probe) % self.slots, update):
+                return
+
+    def read(self):
+        """Return a dict of key -> (bucket counts, sum)"""
+        series = {}
+        for slot in range(self.slots):
+            stored, stored_key, *counts, total = self._locked(slot, lambda offset: self.SLOT.unpack_from(self._map, offset))
+            if stored:
+                series[stored_key.rstrip(b'\0').decode()] = (counts, total)
+        return series
+
+
+class Histogram(object):
+    """Prometheus style histogram with one series per label value, kept in series (MemorySeries or SharedSeries)"""
+
+    def __init__(self, name, description, label, buckets, series=None):
+        self.name = name
+        self.description = description
+        self.label = label
+        self.buckets = buckets
+        self.series = series if series is not None else MemorySeries()
+        self._prefix = f'{name}|'
+
+    def observe(self, label_value, value):
+        position = bisect.bisect_left(self.buckets, value)
+        self.series.add(self._prefix + label_value, position, value, len(self.buckets) + 1)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.description}', f'# TYPE {self.name} histogram']
+        series = {key[len(self._prefix):]:(counts[:len(self.buckets) + 1], total)
+                  for key, (counts, total) in self.series.read().items() if key.startswith(self._prefix)}
+        for label_value, (counts, total) in sorted(series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{{{self.label}="{label_value}",le="{bound}"}} {cumulative}')
+            lines.append(f'{self.name}_sum{{{self.label}="{label_value}"}} {total}')
+            lines.append(f'{self.name}_count{{{self.label}="{label_value}"}} {cumulative}')
+        return lines
+
+
+class RequestMetrics(object):
+    """Aggregated timings of the requests, by endpoint, in one series store shared by the histograms"""
+
+    def __init__(self, series=None):
+        series = series if series is not None else MemorySeries()
+        self.duration = Histogram('http_request_duration_seconds', 'Total time to handle the request',
+                                  'endpoint', SECONDS_BUCKETS, series)
+        self.db_time = Histogram('http_request_db_seconds', 'Time spent running SQL statements',
+                                 'endpoint', SECONDS_BUCKETS, series)
+        self.serialization = Histogram('http_request_serialization_seconds', 'Time spent building the response body',
+                                       'endpoint', SECONDS_BUCKETS, series)
+        self.queries = Histogram('http_request_db_queries', 'SQL statements run by the request',
+                                 'endpoint', QUERIES_BUCKETS, series)
+
+    def observe(self, endpoint, duration, db_time, serialization, queries):
+        self.duration.observe(endpoint, duration)
+        self.db_time.observe(endpoint, db_time)
+        self.serialization.observe(endpoint, serialization)
+        self.queries.observe(endpoint, queries)
+
+    def render(self):
+        lines = []
+        for histogram in (self.duration, self.db_time, self.serialization, self.queries):
+            lines.extend(histogram.render())
+        return lines
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context() and 'request_start' in g:
+        conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    query_start = conn.info.get('query_start')
+    if query_start and has_request_context() and 'request_start' in g:
+        g.db_time += time.perf_counter() - query_start.pop()
+        g.db_queries += 1
+
+
+@event.listens_for(Engine, 'handle_error')
+def _handle_error(context):
+    # after_cursor_execute does not run for a failed statement, its start would be taken by the next one
+    connection = context.connection
+    query_start = connection.info.get('query_start') if connection is not None else None
+    if query_start:
+        started = query_start.pop()
+        if has_request_context() and 'request_start' in g:
+            g.db_time += time.perf_counter() - started
+            g.db_queries += 1
+
+
+def _mark_view_end(view):
+    """Record when the view returned, what runs after that until after_request is the serialization"""
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        try:
+            return view(*args, **kwargs)
+        finally:
+            g.view_end = time.perf_counter()
+    return wrapper
+
+
+def _start_timer():
+    g.request_start = time.perf_counter()
+    g.db_time = 0.0
+    g.db_queries = 0
+
+
+def _record_timings(response):
+    if 'request_start' not in g:
+        return response
+    metrics = current_app.extensions['request_metrics']
+    endpoint = request.endpoint or 'not_found'
+    if response.is_streamed:
+        # The body, and its statements, are produced after this hook; observed once it is sent
+        timings = g._get_current_object()
+
+        def observe_streamed():
+            now = time.perf_counter()
+            metrics.observe(endpoint, now - timings.request_start, timings.db_time,
+                            now - timings.get('view_end', now), timings.db_queries)
+        response.call_on_close(observe_streamed)
+        return response
+
+    now = time.perf_counter()
+    duration = now - g.request_start
+    serialization = now - g.get('view_end', now)
+
+    metrics.observe(endpoint, duration, g.db_time, serialization, g.db_queries)
+    response.headers.add('Server-Timing', f'db;dur={g.db_time * 1000:.3f};desc="{g.db_queries} queries", '
+                                          f'ser;dur={serialization * 1000:.3f}, total;dur={duration * 1000:.3f}')
+    return response
+
+
+def init_instrumentation(app):
+    """Time every request of app when INSTRUMENTATION_ENABLED is set
+
+    Must run after the blueprints are registered so their views are wrapped. With METRICS_FILE the
+    histograms are kept in that file, mapped by every worker of the host, so /metrics reports all
+    of them whichever worker answers it. The streamed responses are observed when they are closed
+    and get no Server-Timing header, it is sent before their body is produced.
+    """
+    path = app.config.get('METRICS_FILE')
+    app.extensions['request_metrics'] = RequestMetrics(SharedSeries(path, app.config.get('METRICS_SLOTS', METRICS_SLOTS))
+                                                       if path else None)
+    if not app.config.get('INSTRUMENTATION_ENABLED', False):
+        return
+
+    for endpoint, view in app.view_functions.items():
+        app.view_functions[endpoint] = _mark_view_end(view)
+    app.before_request(_start_timer)
+    app.after_request(_record_timings)
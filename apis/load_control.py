@@ -0,0 +1,285 @@
+import fcntl
+import hashlib
+import math
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+from collections import Counter, OrderedDict
+
+from flask import current_app, g, request
+from sqlalchemy.pool import QueuePool
+
+
+RATE_LIMIT_BACKEND = None
+RATE_LIMIT_SLOTS = 65536
+RATE_LIMIT_MEMORY_SIZE = 100000
+LOCK_STRIPES = 64
+# Only the api routes are limited, the health checks and metrics must keep answering
+LIMITED_BLUEPRINTS = ('vessels', 'equipments')
+API_KEY_HEADER = 'X-API-Key'
+# Seconds for the pool wait average to halve when no connection is requested
+POOL_WAIT_HALF_LIFE = 1.0
+POOL_WAIT_WEIGHT = 0.2
+
+
+def _take(tokens, updated, rate, burst, now):
+    """Refill a token bucket and take a token from it, return (allowed, tokens left, seconds until the next token)"""
+    tokens = min(burst, tokens + max(0.0, now - updated) * rate)
+    if tokens >= 1:
+        return True, tokens - 1, 0.0
+    return False, tokens, (1 - tokens) / rate
+
+
+class MemoryBuckets(object):
+    """Token buckets of one worker, locked by stripes so the threads seldom wait for each other"""
+
+    def __init__(self, maxsize=RATE_LIMIT_MEMORY_SIZE):
+        self.maxsize = maxsize
+        self._buckets = OrderedDict()
+        self._locks = [threading.Lock() for _ in range(LOCK_STRIPES)]
+        self._sweep_lock = threading.Lock()
+
+    def take(self, key, rate, burst, now):
+        with self._locks[hash(key) % LOCK_STRIPES]:
+            tokens, updated = self._buckets.get(key, (burst, now))
+            allowed, tokens, retry_after = _take(tokens, updated, rate, burst, now)
+            self._buckets[key] = (tokens, now)
+            self._buckets.move_to_end(key)
+        if len(self._buckets) > self.maxsize:
+            self._sweep()
+        return allowed, retry_after
+
+    def _sweep(self):
+        # The buckets used least recently go first, a client coming back starts with a full bucket
+        if not self._sweep_lock.acquire(blocking=False):
+            return
+        try:
+            for lock in self._locks:
+                lock.acquire()
+            try:
+                for _ in range(len(self._buckets) - self.maxsize // 2):
+                    self._buckets.popitem(last=False)
+            finally:
+                for lock in self._locks:
+                    lock.release()
+        finally:
+            self._sweep_lock.release()
+
+
+class SharedBuckets(object):
+    """Token buckets in a memory mapped file shared by the worker processes
+
+    The file holds a fixed table of slots (key hash, tokens, last update) addressed by the key hash,
+    each slot is locked on its own with fcntl (between processes) and a striped lock (between the
+    threads of a process). Two keys falling in the same slot replace each other's bucket, the table
+    is sized so this only happens with far more clients than RATE_LIMIT_SLOTS.
+    """
+    SLOT = struct.Struct('<Qdd')
+
+    def __init__(self, path, slots=RATE_LIMIT_SLOTS):
+        self.path = path
+        self.slots = slots
+        size = slots * self.SLOT.size
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        if os.fstat(self._fd).st_size < size:
+            os.ftruncate(self._fd, size)
+        self._map = mmap.mmap(self._fd, size)
+        self._locks = [threading.Lock() for _ in range(LOCK_STRIPES)]
+
+    def take(self, key, rate, burst, now):
+        # Zero marks an empty slot
+        digest = int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), 'little') or 1
+        slot = digest % self.slots
+        offset = slot * self.SLOT.size
+        with self._locks[slot % LOCK_STRIPES]:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX, self.SLOT.size, offset)
+            try:
+                stored, tokens, updated = self.SLOT.unpack_from(self._map, offset)
+                if stored != digest:
+                    tokens, updated = burst, now
+                allowed, tokens, retry_after = _take(tokens, updated, rate, burst, now)
+                self.SLOT.pack_into(self._map, offset, digest, tokens, now)
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN, self.SLOT.size, offset)
+        return allowed, retry_after
+
+
+class RateLimiter(object):
+    """Token bucket of each client per route, limits maps an endpoint to its (requests per second, burst)"""
+
+    def __init__(self, buckets, limits, default=None):
+        self.buckets = buckets
+        self.limits = limits
+        self.default = default
+        self.limited = Counter()
+        self._lock = threading.Lock()
+
+    def check(self, client, endpoint):
+        """Return None when the request is allowed or the seconds the client should wait"""
+        limit = self.limits.get(endpoint, self.default)
+        if not limit:
+            return None
+        rate, burst = limit
+        # The wall clock is shared by the processes using SharedBuckets
+        allowed, retry_after = self.buckets.take(f'{client}|{endpoint}', rate, burst, time.time())
+        if allowed:
+            return None
+        with self._lock:
+            self.limited[endpoint] += 1
+        return retry_after
+
+    def stats(self):
+        with self._lock:
+            return dict(self.limited)
+
+
+class LoadShedder(object):
+    """Refuses requests while the worker has too many in flight or waits too long for a database connection
+
+    The pool wait is an average of the waits of the recent checkouts that decays while no connection
+    is requested, so the shedding stops by itself once the pressure is gone.
+    """
+
+    def __init__(self, max_in_flight=None, max_pool_wait_ms=None, half_life=POOL_WAIT_HALF_LIFE):
+        self.max_in_flight = max_in_flight
+        self.max_pool_wait_ms = max_pool_wait_ms
+        self.half_life = half_life
+        self.in_flight = 0
+        self.shed = Counter()
+        self._pool_wait = 0.0
+        self._pool_wait_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _decayed_pool_wait(self, now):
+        return self._pool_wait * 0.5 ** ((now - self._pool_wait_at) / self.half_life)
+
+    def observe_pool_wait(self, seconds):
+        now = time.monotonic()
+        with self._lock:
+            self._pool_wait = self._decayed_pool_wait(now) * (1 - POOL_WAIT_WEIGHT) + seconds * 1000 * POOL_WAIT_WEIGHT
+            self._pool_wait_at = now
+
+    def pool_wait_ms(self):
+        with self._lock:
+            return self._decayed_pool_wait(time.monotonic())
+
+    def enter(self):
+        """Count the request in flight and return None, or return why it is refused"""
+        with self._lock:
+            if self.max_in_flight and self.in_flight >= self.max_in_flight:
+                reason = 'in_flight'
+            elif self.max_pool_wait_ms and self._decayed_pool_wait(time.monotonic()) > self.max_pool_wait_ms:
+                reason = 'pool_wait'
+            else:
+                self.in_flight += 1
+                return None
+            self.shed[reason] += 1
+            return reason
+
+    def leave(self):
+        with self._lock:
+            self.in_flight -= 1
+
+    def stats(self):
+        with self._lock:
+            return {'in_flight':self.in_flight, 'pool_wait_ms':round(self._decayed_pool_wait(time.monotonic()), 3),
+                    'shed':dict(self.shed)}
+
+
+def timed_pool_class(shedder):
+    """QueuePool reporting to shedder how long each checkout waited, kept when the engine recreates its pool"""
+    class TimedQueuePool(QueuePool):
+        def connect(self):
+            start = time.perf_counter()
+            try:
+                return QueuePool.connect(self)
+            finally:
+                shedder.observe_pool_wait(time.perf_counter() - start)
+    return TimedQueuePool
+
+
+def create_rate_limiter(settings):
+    """Create the rate limiter configured by RATE_LIMIT_BACKEND in settings, None disables it"""
+    backend_name = settings.get('RATE_LIMIT_BACKEND', RATE_LIMIT_BACKEND)
+    if backend_name == 'memory':
+        buckets = MemoryBuckets()
+    elif backend_name == 'shared':
+        buckets = SharedBuckets(settings.get('RATE_LIMIT_FILE') or os.path.join(tempfile.gettempdir(), 'vessels_rate_limits'),
+                                slots=settings.get('RATE_LIMIT_SLOTS', RATE_LIMIT_SLOTS))
+    elif not backend_name:
+        return None
+    else:
+        raise ValueError(f'Unknown RATE_LIMIT_BACKEND {backend_name}')
+    return RateLimiter(buckets, settings.get('RATE_LIMITS') or {}, settings.get('RATE_LIMIT_DEFAULT'))
+
+
+def create_load_shedder(settings):
+    """Create the load shedder configured by LOAD_SHED_MAX_IN_FLIGHT and LOAD_SHED_MAX_POOL_WAIT_MS, None disables it"""
+    if settings.get('LOAD_SHED_MAX_IN_FLIGHT') or settings.get('LOAD_SHED_MAX_POOL_WAIT_MS'):
+        return LoadShedder(settings.get('LOAD_SHED_MAX_IN_FLIGHT'), settings.get('LOAD_SHED_MAX_POOL_WAIT_MS'))
+    return None
+
+
+def admit(limiter, shedder, client, endpoint):
+    """Return None when the request can run, counting it in flight, or the (message, status code, Retry-After) refusing it"""
+    if limiter:
+        retry_after = limiter.check(client, endpoint)
+        if retry_after is not None:
+            return 'RATE_LIMITED', 429, str(math.ceil(retry_after))
+    if shedder and shedder.enter():
+        return 'OVERLOADED', 503, str(math.ceil(shedder.half_life))
+    return None
+
+
+def init_load_control(app):
+    """Set up the rate limiting and load shedding of the api routes
+
+    Must run before the engine is first used, the pool wait is measured by its pool class.
+    """
+    limiter = create_rate_limiter(app.config)
+    shedder = create_load_shedder(app.config)
+    if shedder:
+        # SQLite opens a connection per checkout, there is no pool to wait for
+        if app.config.get('LOAD_SHED_MAX_POOL_WAIT_MS') and not app.config['SQLALCHEMY_DATABASE_URI'].startswith('sqlite'):
+            engine_options = dict(app.config.get('SQLALCHEMY_ENGINE_OPTIONS') or {})
+            engine_options['poolclass'] = timed_pool_class(shedder)
+            app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options
+
+    app.extensions['rate_limiter'] = limiter
+    app.extensions['load_shedder'] = shedder
+    if limiter or shedder:
+        app.before_request(_admit_request)
+        app.teardown_request(_leave_request)
+
+
+def rate_limiter():
+    return current_app.extensions.get('rate_limiter')
+
+
+def load_shedder():
+    return current_app.extensions.get('load_shedder')
+
+
+def client_id():
+    return request.headers.get(API_KEY_HEADER) or request.remote_addr
+
+
+def _admit_request():
+    if request.blueprint not in LIMITED_BLUEPRINTS:
+        return None
+
+    refusal = admit(rate_limiter(), load_shedder(), client_id(), request.endpoint)
+    if refusal:
+        message, status_code, retry_after = refusal
+        return {'message':message}, status_code, {'Retry-After':retry_after}
+    if load_shedder():
+        g.in_flight = True
+    return None
+
+
+def _leave_request(error):
+    if g.pop('in_flight', False):
+        load_shedder().leave()
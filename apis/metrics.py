@@ -0,0 +1,62 @@
+from flask import Blueprint, Response, current_app
+
+from apis.vessel_cache import vessel_cache
+from apis.response_cache import response_cache
+from apis.single_flight import single_flight
+from apis.read_replicas import read_replicas
+from apis.load_control import load_shedder, rate_limiter
+
+metrics_blueprint = Blueprint('metrics', __name__)
+
+
+def _counter_lines(name, description, values, label='cache'):
+    lines = [f'# HELP {name} {description}', f'# TYPE {name} counter']
+    lines.extend(f'{name}{{{label}="{key}"}} {value}' for key, value in values.items())
+    return lines
+
+
+@metrics_blueprint.route('/metrics', methods=['GET'])
+def metrics():
+
+    """Return the request timings and cache counters in the Prometheus text format
+        ---
+        responses:
+          200:
+            description: the metrics in the Prometheus text exposition format
+    """
+    caches = {'vessel':vessel_cache().stats()}
+    if response_cache():
+        caches['response'] = response_cache().stats()
+
+    lines = current_app.extensions['request_metrics'].render()
+    lines.extend(_counter_lines('cache_hits_total', 'Lookups answered by the cache',
+                                {cache:stats['hits'] for cache, stats in caches.items()}))
+    lines.extend(_counter_lines('cache_misses_total', 'Lookups that missed the cache',
+                                {cache:stats['misses'] for cache, stats in caches.items()}))
+    lines.extend(_counter_lines('cache_evictions_total', 'Entries evicted to keep the cache bounded',
+                                {'vessel':caches['vessel']['evictions']}))
+    if 'response' in caches:
+        lines.extend(_counter_lines('cache_invalidations_total', 'Entries invalidated by writes',
+                                    {'response':caches['response']['invalidations']}))
+    if single_flight():
+        flights = single_flight().stats()
+        lines.extend(['# HELP single_flight_reads_total Reads made for the coalesced requests',
+                      '# TYPE single_flight_reads_total counter', f"single_flight_reads_total {flights['flights']}",
+                      '# HELP single_flight_coalesced_total Requests answered by the read of another request',
+                      '# TYPE single_flight_coalesced_total counter', f"single_flight_coalesced_total {flights['coalesced']}"])
+    if read_replicas():
+        lines.extend(_counter_lines('db_reads_total', 'Read only requests sent to each database',
+                                    read_replicas().stats(), label='target'))
+    if rate_limiter():
+        lines.extend(_counter_lines('rate_limited_total', 'Requests refused by the rate limit of their client',
+                                    rate_limiter().stats(), label='endpoint'))
+    if load_shedder():
+        shedding = load_shedder().stats()
+        lines.extend(_counter_lines('load_shed_total', 'Requests refused while the worker was overloaded',
+                                    shedding['shed'], label='reason'))
+        lines.extend(['# HELP in_flight_requests Requests of the api routes being handled by the worker',
+                      '# TYPE in_flight_requests gauge', f"in_flight_requests {shedding['in_flight']}",
+                      '# HELP db_pool_wait_ms Recent average wait for a database connection',
+                      '# TYPE db_pool_wait_ms gauge', f"db_pool_wait_ms {shedding['pool_wait_ms']}"])
+
+    return Response('\n'.join(lines) + '\n', mimetype='text/plain; version=0.0.4')
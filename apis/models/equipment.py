@@ -1,13 +1,57 @@
+from sqlalchemy import DDL, BigInteger, event
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.functions import FunctionElement
+
 from apis.models.model import db
 
 
+class change_version(FunctionElement):
+    """Version stamped on the equipments written by the running transaction
+
+    On postgresql it is the id of the transaction, so every version below the xmin of a snapshot
+    belongs to a transaction that already finished (see apis.queries.changes_high_water). SQLite
+    serializes the writers, there it is one more than the highest version in the table.
+    """
+    type = BigInteger()
+    inherit_cache = True
+
+
+@compiles(change_version)
+def _compile_change_version(element, compiler, **kwargs):
+    return '(SELECT COALESCE(MAX(version), 0) + 1 FROM equipments)'
+
+
+@compiles(change_version, 'postgresql')
+def _compile_change_version_postgresql(element, compiler, **kwargs):
+    return 'txid_current()'
+
+
 class equipment(db.Model):
     __tablename__ = 'equipments'
+    __table_args__ = (
+        # Serves active_equipments: the active rows of a vessel, already ordered by code for the keyset pagination
+        db.Index('ix_equipments_active_vessel_id_code', 'vessel_id', 'code',
+                 postgresql_where=db.text('active'), sqlite_where=db.text('active')),
+        # Serve the search filters: LIKE 'prefix%' on code (the unique index can not be used for LIKE outside the
+        # C collation), ILIKE '%text%' and 'text%' on name through trigrams, and location ordered by code
+        db.Index('ix_equipments_code_pattern', 'code', postgresql_ops={'code':'varchar_pattern_ops'}),
+        db.Index('ix_equipments_name_trgm', 'name', postgresql_using='gin', postgresql_ops={'name':'gin_trgm_ops'}),
+        db.Index('ix_equipments_location_code', 'location', 'code'),
+        # Serves the change feed: the rows written after a version, in version order
+        db.Index('ix_equipments_version', 'version'),
+    )
 
-    id = db.Column(db.BigInteger, primary_key=True)
-    vessel_id = db.Column(db.BigInteger, db.ForeignKey('vessels.id'))
+    # SQLite only autoincrements INTEGER primary keys
+    id = db.Column(db.BigInteger().with_variant(db.Integer, 'sqlite'), primary_key=True)
+    vessel_id = db.Column(db.BigInteger, db.ForeignKey('vessels.id'), index=True)
     name = db.Column(db.String(256))
     code = db.Column(db.String(8), unique=True)
     location = db.Column(db.String(256))
     active = db.Column(db.Boolean)
+    # Stamped by every INSERT and UPDATE built with SQLAlchemy, the raw statements must set it themselves
+    version = db.Column(db.BigInteger, default=change_version(), onupdate=change_version())
+
 
+# The trigram index needs the pg_trgm extension when the tables are created with create_all
+event.listen(equipment.__table__, 'before_create',
+             DDL('CREATE EXTENSION IF NOT EXISTS pg_trgm').execute_if(dialect='postgresql'))
@@ -0,0 +1,15 @@
+from apis.models.model import db
+
+
+class equipment_counter(db.Model):
+    """Number of active and inactive equipments of each vessel in each location
+
+    Kept up to date in the same transaction as the writes to the equipments (see apis.fleet_stats), so
+    the statistics are read from one row per vessel and location instead of from every equipment.
+    """
+    __tablename__ = 'equipment_counters'
+
+    vessel_id = db.Column(db.BigInteger, db.ForeignKey('vessels.id'), primary_key=True)
+    location = db.Column(db.String(256), primary_key=True)
+    active_count = db.Column(db.BigInteger, nullable=False, default=0)
+    inactive_count = db.Column(db.BigInteger, nullable=False, default=0)
@@ -0,0 +1,23 @@
+from apis.models.model import db
+
+
+class equipment_status_event(db.Model):
+    """Append only history of the status of the equipments of each vessel
+
+    One row is written in the same transaction as every insert and status change (see
+    apis.status_history). active is the status after the change and previous_active the one
+    before it, NULL when the equipment was not on the vessel.
+    """
+    __tablename__ = 'equipment_status_events'
+    __table_args__ = (
+        # Every history query is bounded by a vessel and a time range
+        db.Index('ix_equipment_status_events_vessel_id_changed_at', 'vessel_id', 'changed_at'),
+    )
+
+    # SQLite only autoincrements INTEGER primary keys
+    id = db.Column(db.BigInteger().with_variant(db.Integer, 'sqlite'), primary_key=True)
+    vessel_id = db.Column(db.BigInteger, db.ForeignKey('vessels.id'), nullable=False)
+    code = db.Column(db.String(8), nullable=False)
+    active = db.Column(db.Boolean)
+    previous_active = db.Column(db.Boolean)
+    changed_at = db.Column(db.DateTime, nullable=False)
@@ -0,0 +1,17 @@
+from apis.models.model import db
+
+
+class idempotency_key(db.Model):
+    """Response of a write sent with an Idempotency-Key header, replayed to the retries of the request
+
+    A row without status_code is a request still running (see apis.idempotency).
+    """
+    __tablename__ = 'idempotency_keys'
+
+    # <endpoint>:<Idempotency-Key header>
+    key = db.Column(db.String(320), primary_key=True)
+    fingerprint = db.Column(db.String(64), nullable=False)
+    status_code = db.Column(db.Integer)
+    response = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, nullable=False)
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
@@ -1,3 +1,26 @@
-from flask_sqlalchemy import SQLAlchemy
+from flask import g, has_app_context
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import orm
 
-db = SQLAlchemy()
+
+class RoutingSession(SignallingSession):
+    """Session that sends the statements of the read only requests to the replica picked for them
+
+    The replica engine is set in g by apis.read_replicas, everything else uses the primary.
+    """
+
+    def get_bind(self, mapper=None, clause=None):
+        if has_app_context() and not self._flushing:
+            engine = g.get('read_engine')
+            if engine is not None:
+                return engine
+        return SignallingSession.get_bind(self, mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+db = RoutingSQLAlchemy()
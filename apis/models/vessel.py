@@ -4,6 +4,7 @@ from apis.models.model import db
 class vessel(db.Model):
     __tablename__ = 'vessels'
 
-    id = db.Column(db.BigInteger, primary_key=True)
+    # SQLite only autoincrements INTEGER primary keys
+    id = db.Column(db.BigInteger().with_variant(db.Integer, 'sqlite'), primary_key=True)
     code = db.Column(db.String(8), unique=True)
 
@@ -0,0 +1,183 @@
+"""Operations of the api shared by the Flask blueprints and the ASGI app
+
+Each one runs on the connection it is given, the Flask session or the sync side of an async
+connection (AsyncConnection.run_sync), so both front ends write and read the same way and only
+differ in how they parse the request and send the response.
+"""
+from datetime import datetime
+
+from sqlalchemy import select
+
+from apis.encoding import JSON, encode_equipments
+from apis.fleet_stats import CounterDeltas, apply_counter_deltas, inserted_deltas
+from apis.models.equipment import equipment
+from apis.models.vessel import vessel
+from apis.queries import DEACTIVATE_STATEMENT, active_equipments_select
+from apis.response_cache import active_equipments_key
+from apis.status_history import inserted_events, record_status_events
+from apis.utils import chunks, dialect_name, insert_ignoring_conflicts
+from apis.validation import validate_equipment
+
+
+def insert_vessel_code(connection, code):
+    """Insert a vessel and return its id, raises IntegrityError if the code is already in the system"""
+    return connection.execute(vessel.__table__.insert().values(code=code)).inserted_primary_key[0]
+
+
+def valid_vessel_codes(codes):
+    """The distinct codes of a bulk vessel request insert_vessel would accept, in the order they were sent"""
+    max_length = vessel.code.type.length
+    return list(dict.fromkeys(code for code in codes if type(code) == str and code and len(code) <= max_length))
+
+
+def insert_vessel_codes(connection, codes):
+    """Insert the codes that are not in the system yet and return the created ones
+
+    On SQLite the existing codes are read before the insert, a code inserted concurrently in
+    between raises IntegrityError and the caller rolls back and classifies the chunk again.
+    """
+    if dialect_name(connection) == 'postgresql':
+        statement = insert_ignoring_conflicts(vessel.__table__, ['code'], 'postgresql').values([{'code':code} for code in codes])
+        return {row[0] for row in connection.execute(statement.returning(vessel.code)).all()}
+    existing = {row[0] for row in connection.execute(select(vessel.code).where(vessel.code.in_(codes))).all()}
+    created = [code for code in codes if code not in existing]
+    if created:
+        connection.execute(vessel.__table__.insert(), [{'code':code} for code in created])
+    return set(created)
+
+
+def bulk_vessel_result(codes, valid_codes, created):
+    """Body of the bulk_insert_vessel response, with the message insert_vessel would return for each code sent"""
+    results = []
+    reported = set()
+    valid = set(valid_codes)
+    for code in codes:
+        if type(code) != str or code not in valid:
+            message = 'WRONG_FORMAT'
+        elif code in created and code not in reported:
+            message = 'OK'
+            reported.add(code)
+        else:
+            message = 'FAIL'
+        results.append({'code':code, 'message':message})
+
+    existing = [code for code in valid_codes if code not in created]
+    return {'message':'OK', 'created':[code for code in valid_codes if code in created], 'existing':existing,
+            'results':results}
+
+
+def insert_equipments(connection, rows, changed_at=None):
+    """Insert the equipment rows along with their counters and status events"""
+    connection.execute(equipment.__table__.insert(), rows)
+    apply_counter_deltas(inserted_deltas(rows), connection)
+    record_status_events(inserted_events(rows, changed_at or datetime.utcnow()), connection)
+
+
+def insert_equipment_chunk(connection, chunk, seen_codes, vessel_ids_of):
+    """Validate and insert a chunk of a bulk equipment request with set based queries
+
+    vessel_ids_of maps a set of vessel codes to the ids of the ones in the system. Returns the
+    status of each item of the chunk, in order, and the inserted rows. A code inserted concurrently
+    after the read of the existing ones raises IntegrityError, the caller rolls back, drops the
+    codes of the chunk from seen_codes and classifies it again.
+    """
+    statuses = [validate_equipment(item) for item in chunk]
+    valid = [item for item, status in zip(chunk, statuses) if status is None]
+
+    vessel_ids = vessel_ids_of({item['vessel_code'] for item in valid})
+
+    codes = {item['code'] for item in valid}
+    known_codes = set()
+    if codes:
+        known_codes = {row[0] for row in connection.execute(select(equipment.code).where(equipment.code.in_(codes))).all()}
+
+    rows = []
+    for position, item in enumerate(chunk):
+        if statuses[position] is not None:
+            continue
+        if item['vessel_code'] not in vessel_ids:
+            statuses[position] = 'NO_VESSEL'
+        elif item['code'] in known_codes or item['code'] in seen_codes:
+            statuses[position] = 'REPEATED_CODE'
+        else:
+            statuses[position] = 'OK'
+            seen_codes.add(item['code'])
+            rows.append({'vessel_id':vessel_ids[item['vessel_code']], 'code':item['code'], 'name':item['name'],
+                         'location':item['location'], 'active':True})
+
+    if rows:
+        insert_equipments(connection, rows)
+    return statuses, rows
+
+
+def bulk_equipment_results(chunk, statuses, results):
+    """Append the result of each item of a bulk equipment chunk to results and return how many were inserted"""
+    for item, status in zip(chunk, statuses):
+        code = item.get('code') if isinstance(item, dict) else None
+        results.append({'index':len(results), 'code':code, 'message':status})
+    return statuses.count('OK')
+
+
+def deactivate_chunk(connection, codes, changed_at):
+    """Set the codes to inactive, recording the status events, and return (code, vessel_id, location, deactivated, known) for each one"""
+    if dialect_name(connection) == 'postgresql':
+        # Update, record and classify the whole chunk in a single round trip
+        return connection.execute(DEACTIVATE_STATEMENT, {'codes':codes, 'changed_at':changed_at}).all()
+
+    equipments_query = select(equipment.code, equipment.vessel_id, equipment.location, equipment.active) \
+        .where(equipment.code.in_(codes))
+    found = {code:(vessel_id, location, active) for code, vessel_id, location, active in connection.execute(equipments_query).all()}
+    to_deactivate = [code for code, (vessel_id, location, active) in found.items() if active]
+    if to_deactivate:
+        connection.execute(equipment.__table__.update().where(equipment.code.in_(to_deactivate)).values(active=False))
+        record_status_events([{'vessel_id':found[code][0], 'code':code, 'active':False, 'previous_active':True,
+                               'changed_at':changed_at} for code in to_deactivate], connection)
+    return [(code, *found[code][:2], bool(found[code][2]), True) if code in found else (code, None, None, False, False)
+            for code in codes]
+
+
+def deactivate_equipments(connection, codes, chunk_size, changed_at=None):
+    """Set the codes to inactive chunk by chunk and update the counters
+
+    Returns the status of each code (deactivated, already_inactive or unknown) and the ids of the
+    vessels whose active equipments changed.
+    """
+    changed_at = changed_at or datetime.utcnow()
+    statuses = {}
+    vessel_ids = set()
+    deltas = CounterDeltas()
+    for chunk in chunks(codes, chunk_size):
+        for item, vessel_id, location, deactivated, known in deactivate_chunk(connection, chunk, changed_at):
+            if deactivated:
+                statuses[item] = 'deactivated'
+                vessel_ids.add(vessel_id)
+                deltas.add(vessel_id, location, active=-1, inactive=1)
+            else:
+                statuses[item] = 'already_inactive' if known else 'unknown'
+    apply_counter_deltas(deltas, connection)
+    return statuses, vessel_ids
+
+
+def status_update_result(codes, statuses):
+    """Body of the update_equipment_status response, the codes grouped by status in the order they were sent"""
+    result = {'message':'OK', 'deactivated':[], 'already_inactive':[], 'unknown':[]}
+    for item in codes:
+        result[statuses[item]].append(item)
+    return result
+
+
+def read_active_equipments(connection, vessel_id, media_type=JSON, limit=None, after_code=None):
+    """Encode the active equipments of a vessel as media_type, with next_after_code when limit is sent"""
+    equipments = connection.execute(active_equipments_select(vessel_id, limit, after_code)).all()
+    extra = {}
+    if limit:
+        extra['next_after_code'] = equipments[-1][0] if len(equipments) == limit else None
+    return encode_equipments(equipments, media_type, **extra)
+
+
+def fill_active_equipments(connection, cache, vessel_id, media_type=JSON):
+    """Read the active equipments of a vessel into the response cache and return their (etag, body)"""
+    cache_key = active_equipments_key(vessel_id, media_type)
+    # Taken before the read, a write committed meanwhile bumps it and the entry is never served
+    generation = cache.generation(cache_key)
+    return cache.store(cache_key, generation, read_active_equipments(connection, vessel_id, media_type))
@@ -0,0 +1,112 @@
+from sqlalchemy import func, select, text
+
+from apis.models.equipment import equipment
+from apis.models.vessel import vessel
+
+
+# Sets a chunk of codes to inactive and classifies each of them in a single round trip (postgresql only)
+DEACTIVATE_STATEMENT = text("""
+    WITH requested AS (SELECT DISTINCT unnest(CAST(:codes AS varchar[])) AS code),
+    deactivated AS (
+        UPDATE equipments SET active = false, version = txid_current()
+        FROM requested
+        WHERE equipments.code = requested.code AND equipments.active
+        RETURNING equipments.code, equipments.vessel_id, equipments.location
+    ),
+    events AS (
+        INSERT INTO equipment_status_events (vessel_id, code, active, previous_active, changed_at)
+        SELECT vessel_id, code, false, true, CAST(:changed_at AS timestamp) FROM deactivated
+    )
+    SELECT requested.code, deactivated.vessel_id, deactivated.location, deactivated.code IS NOT NULL,
+           equipments.id IS NOT NULL
+    FROM requested
+    LEFT JOIN deactivated ON deactivated.code = requested.code
+    LEFT JOIN equipments ON equipments.code = requested.code
+""")
+
+
+def active_equipments_select(vessel_id, limit=None, after_code=None, ordered=False):
+    """Select the code, name and location of the active equipments of a vessel
+
+    With ordered, limit or after_code the rows are ordered by code, for the keyset pagination.
+    """
+    query = select(equipment.code, equipment.name, equipment.location) \
+        .where(equipment.vessel_id==vessel_id).where(equipment.active==True)
+    if ordered or limit or after_code:
+        query = query.order_by(equipment.code)
+    if after_code:
+        query = query.where(equipment.code > after_code)
+    if limit:
+        query = query.limit(limit)
+    return query
+
+
+def equipments_json(rows):
+    return [{'code':code, 'name':name, 'location':location} for code, name, location in rows]
+
+
+def equipments_columns(rows):
+    """Columnar form of the rows, one list per field instead of one object per equipment"""
+    codes, names, locations = (list(column) for column in zip(*rows)) if rows else ([], [], [])
+    return {'code':codes, 'name':names, 'location':locations}
+
+
+def escape_like(value, escape='/'):
+    """Escape the LIKE wildcards of a user supplied value"""
+    return value.replace(escape, escape * 2).replace('%', escape + '%').replace('_', escape + '_')
+
+
+def search_select(vessel_ids=None, code_prefix=None, name=None, name_prefix=None, location=None, active=None,
+                  limit=None, after_code=None):
+    """Select the vessel code, code, name, location and active of the equipments matching every filter given
+
+    The rows are ordered by code for the keyset pagination. The patterns are built here instead of with
+    startswith/contains so the database sees a constant prefix it can match against the indexes.
+    """
+    query = select(vessel.code, equipment.code, equipment.name, equipment.location, equipment.active) \
+        .join(vessel, vessel.id==equipment.vessel_id).order_by(equipment.code)
+    if vessel_ids is not None:
+        query = query.where(equipment.vessel_id.in_(vessel_ids))
+    if code_prefix:
+        query = query.where(equipment.code.like(escape_like(code_prefix) + '%', escape='/'))
+    if name:
+        query = query.where(equipment.name.ilike('%' + escape_like(name) + '%', escape='/'))
+    if name_prefix:
+        query = query.where(equipment.name.ilike(escape_like(name_prefix) + '%', escape='/'))
+    if location:
+        query = query.where(equipment.location==location)
+    if active is not None:
+        query = query.where(equipment.active==active)
+    if after_code:
+        query = query.where(equipment.code > after_code)
+    if limit:
+        query = query.limit(limit)
+    return query
+
+
+def search_json(rows):
+    return [{'vessel_code':vessel_code, 'code':code, 'name':name, 'location':location, 'active':active}
+            for vessel_code, code, name, location, active in rows]
+
+
+def changes_high_water_select(dialect_name):
+    """Select the first change version that may still be written by a running transaction
+
+    Every version below it is final, so a mirror that read them can continue from it minus one.
+    """
+    if dialect_name == 'postgresql':
+        return select(func.txid_snapshot_xmin(func.txid_current_snapshot()))
+    return select(func.coalesce(func.max(equipment.version), 0) + 1)
+
+
+def changes_select(since, high_water):
+    """Select the vessel code, code, name, location, active and version of the equipments changed after since"""
+    return select(vessel.code, equipment.code, equipment.name, equipment.location, equipment.active, equipment.version) \
+        .join(vessel, vessel.id==equipment.vessel_id) \
+        .where(equipment.version > since).where(equipment.version < high_water) \
+        .order_by(equipment.version, equipment.id)
+
+
+def changes_json(rows):
+    return [{'vessel_code':vessel_code, 'code':code, 'name':name, 'location':location, 'active':active, 'version':version}
+            for vessel_code, code, name, location, active, version in rows]
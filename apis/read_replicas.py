@@ -0,0 +1,143 @@
+import itertools
+import math
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from flask import current_app, g, has_app_context, request
+
+from apis.load_control import client_id
+from apis.models.model import db
+
+
+READ_YOUR_WRITES_SECONDS = 5.0
+PRIMARY_COOKIE = 'read_primary_until'
+READ_METHODS = ('GET', 'HEAD')
+PRIMARY = 'primary'
+STICKY_CLIENTS_SIZE = 100000
+
+
+class ReadReplicas(object):
+    """Round robin of the replicas serving the read only requests, with the reads sent to each one
+
+    Also keeps the clients that wrote lately (X-API-Key or address) with the time until which they
+    read from the primary, at most sticky_size of them.
+    """
+
+    def __init__(self, bind_keys, sticky_seconds=READ_YOUR_WRITES_SECONDS, sticky_size=STICKY_CLIENTS_SIZE):
+        self.bind_keys = bind_keys
+        self.sticky_seconds = sticky_seconds
+        self.sticky_size = sticky_size
+        self.reads = dict.fromkeys([PRIMARY] + bind_keys, 0)
+        self._next = itertools.cycle(bind_keys)
+        self._writers = OrderedDict()
+        self._lock = threading.Lock()
+
+    def choose(self):
+        with self._lock:
+            return next(self._next)
+
+    def stick(self, client, until):
+        with self._lock:
+            self._writers[client] = until
+            self._writers.move_to_end(client)
+            while len(self._writers) > self.sticky_size:
+                self._writers.popitem(last=False)
+
+    def sticky(self, client, now):
+        """Whether client wrote less than sticky_seconds ago"""
+        with self._lock:
+            until = self._writers.get(client)
+            if until is not None and until <= now:
+                del self._writers[client]
+                return False
+            return until is not None
+
+    def count(self, target):
+        with self._lock:
+            self.reads[target] += 1
+
+    def stats(self):
+        with self._lock:
+            return dict(self.reads)
+
+
+def init_read_replicas(app):
+    """Route the GET requests to the SQLALCHEMY_REPLICA_URIS databases, registered as the replica_<n> binds
+
+    A client that wrote is sent to the primary for READ_YOUR_WRITES_SECONDS after it, so it reads its
+    own writes whatever the lag of the replicas. It is recognized by the read_primary_until cookie
+    and, for the clients that drop cookies, by its X-API-Key or address in the worker that took the
+    write.
+    """
+    uris = app.config.get('SQLALCHEMY_REPLICA_URIS') or []
+    if not uris:
+        app.extensions['read_replicas'] = None
+        return None
+
+    binds = dict(app.config.get('SQLALCHEMY_BINDS') or {})
+    bind_keys = []
+    for number, uri in enumerate(uris):
+        bind_keys.append(f'replica_{number}')
+        binds[bind_keys[-1]] = uri
+    app.config['SQLALCHEMY_BINDS'] = binds
+
+    replicas = ReadReplicas(bind_keys, app.config.get('READ_YOUR_WRITES_SECONDS', READ_YOUR_WRITES_SECONDS))
+    app.extensions['read_replicas'] = replicas
+    app.before_request(_route_request)
+    app.after_request(_stick_writer_to_primary)
+    return replicas
+
+
+def read_replicas():
+    return current_app.extensions.get('read_replicas')
+
+
+def _reads_own_writes(replicas):
+    now = time.time()
+    try:
+        if float(request.cookies.get(PRIMARY_COOKIE)) > now:
+            return True
+    except (TypeError, ValueError):
+        pass
+    return replicas.sticky(client_id(), now)
+
+
+def _route_request():
+    replicas = read_replicas()
+    if request.method not in READ_METHODS:
+        return
+    if _reads_own_writes(replicas):
+        replicas.count(PRIMARY)
+        return
+    g.read_target = replicas.choose()
+    g.read_engine = db.get_engine(current_app, bind=g.read_target)
+    replicas.count(g.read_target)
+
+
+def _stick_writer_to_primary(response):
+    if request.method not in READ_METHODS and response.status_code < 400:
+        replicas = read_replicas()
+        until = time.time() + replicas.sticky_seconds
+        replicas.stick(client_id(), until)
+        response.set_cookie(PRIMARY_COOKIE, f'{until:.3f}', max_age=math.ceil(replicas.sticky_seconds), httponly=True)
+    return response
+
+
+def read_target():
+    """Name of the database the statements of the request go to, primary or replica_<n>"""
+    return g.get('read_target', PRIMARY) if has_app_context() else PRIMARY
+
+
+@contextmanager
+def primary():
+    """Send the statements run inside to the primary, e.g. to fill a cache that outlives the request"""
+    target = g.pop('read_target', None)
+    engine = g.pop('read_engine', None)
+    try:
+        yield
+    finally:
+        if engine is not None:
+            g.read_target = target
+            g.read_engine = engine
@@ -0,0 +1,103 @@
+import threading
+import time
+
+from flask import current_app
+from sqlalchemy import text
+from sqlalchemy.exc import SQLAlchemyError
+
+
+READINESS_PROBE_INTERVAL = 2.0
+
+
+class DatabaseProbe(object):
+    """Round trip to a database, run again at most every interval seconds
+
+    Only one thread probes at a time, the others answer with the last result instead of waiting,
+    so the readiness checks of the load balancer never pile up queries on the database.
+    """
+
+    def __init__(self, interval=READINESS_PROBE_INTERVAL):
+        self.interval = interval
+        self.probes = 0
+        self.ok = None
+        self.error = None
+        self.latency = None
+        self.checked_at = None
+        self.succeeded_at = None
+        self._lock = threading.Lock()
+
+    def _fresh(self):
+        return self.checked_at is not None and time.monotonic() - self.checked_at < self.interval
+
+    def check(self, engine):
+        """Return the result of the last probe, probing engine first when it is older than interval"""
+        # Until the first probe finishes there is no result to answer with, those requests wait for it
+        if not self._fresh() and self._lock.acquire(blocking=self.checked_at is None):
+            try:
+                if not self._fresh():
+                    self._probe(engine)
+            finally:
+                self._lock.release()
+        return self.result()
+
+    def _probe(self, engine):
+        start = time.perf_counter()
+        try:
+            with engine.connect() as connection:
+                connection.execute(text('SELECT 1'))
+        except SQLAlchemyError as error:
+            self.ok = False
+            self.error = type(error).__name__
+        else:
+            self.ok = True
+            self.error = None
+            self.latency = time.perf_counter() - start
+            self.succeeded_at = time.monotonic()
+        self.checked_at = time.monotonic()
+        self.probes += 1
+
+    def result(self):
+        now = time.monotonic()
+        return {'ok':self.ok, 'error':self.error,
+                'latency_ms':round(self.latency * 1000, 3) if self.latency is not None else None,
+                'last_success_seconds_ago':round(now - self.succeeded_at, 3) if self.succeeded_at is not None else None,
+                'checked_seconds_ago':round(now - self.checked_at, 3) if self.checked_at is not None else None}
+
+
+def pool_status(engine):
+    """Connections of the pool of engine, exhausted when a new checkout would have to wait for one"""
+    pool = engine.pool
+    status = {'class':type(pool).__name__}
+    for name, key in (('size', 'size'), ('checkedin', 'checked_in'), ('checkedout', 'checked_out'), ('overflow', 'overflow')):
+        counter = getattr(pool, name, None)
+        status[key] = counter() if callable(counter) else None
+    # QueuePool does not expose its max_overflow, a negative one means no limit
+    max_overflow = getattr(pool, '_max_overflow', None)
+    status['exhausted'] = bool(max_overflow is not None and max_overflow >= 0 and status['checked_out'] is not None
+                               and status['checked_out'] >= status['size'] + max_overflow)
+    return status
+
+
+class ReadinessProbes(object):
+    """The DatabaseProbe of each database of the app, by bind name"""
+
+    def __init__(self, interval=READINESS_PROBE_INTERVAL):
+        self.interval = interval
+        self._probes = {}
+        self._lock = threading.Lock()
+
+    def probe(self, target):
+        with self._lock:
+            if target not in self._probes:
+                self._probes[target] = DatabaseProbe(self.interval)
+            return self._probes[target]
+
+
+def init_readiness_probes(app):
+    probes = ReadinessProbes(app.config.get('READINESS_PROBE_INTERVAL', READINESS_PROBE_INTERVAL))
+    app.extensions['readiness_probes'] = probes
+    return probes
+
+
+def readiness_probes():
+    return current_app.extensions['readiness_probes']
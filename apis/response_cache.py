@@ -0,0 +1,239 @@
+import fcntl
+import hashlib
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+from flask import Response, current_app, request
+
+from apis.encoding import JSON, MEDIA_TYPE_NAMES, compress, mark_compressed, response_encoding
+
+
+RESPONSE_CACHE_BACKEND = 'memory'
+RESPONSE_CACHE_SIZE = 1000
+# The invalidations of the other processes (workers, CLI imports) never reach a memory backend, its entries
+# are only trusted for this long
+RESPONSE_CACHE_TTL_SECONDS = 60
+
+
+class MemoryBackend(object):
+    """Keeps the cached responses in a bounded LRU inside the process, for at most ttl seconds each"""
+
+    def __init__(self, maxsize=RESPONSE_CACHE_SIZE, ttl=RESPONSE_CACHE_TTL_SECONDS):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._generations = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            stored = self._entries.get(key)
+            if stored is None:
+                return None
+            entry, expires_at = stored
+            if self.ttl and expires_at < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry
+
+    def set(self, key, entry):
+        with self._lock:
+            self._entries[key] = (entry, time.monotonic() + (self.ttl or 0))
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def generation(self, key):
+        with self._lock:
+            return self._generations.get(key, 0)
+
+    def bump(self, key):
+        with self._lock:
+            self._generations[key] = self._generations.get(key, 0) + 1
+            self._entries.pop(key, None)
+
+
+class FileBackend(object):
+    """Keeps the cached responses in a directory shared by all the worker processes
+
+    Point it to a tmpfs directory (e.g. /dev/shm/vessels_cache) to keep it in shared memory.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key, suffix):
+        return os.path.join(self.directory, key + suffix)
+
+    def _write(self, path, data):
+        # Write to a temporary file and rename it so readers never see a partial file
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory)
+        with os.fdopen(fd, 'wb') as tmp_file:
+            tmp_file.write(data)
+        os.replace(tmp_path, path)
+
+    def get(self, key):
+        try:
+            with open(self._path(key, '.cache'), 'rb') as cache_file:
+                generation, etag, body = cache_file.read().split(b'\n', 2)
+        except (OSError, ValueError):
+            return None
+        return int(generation), etag.decode(), body
+
+    def set(self, key, entry):
+        generation, etag, body = entry
+        self._write(self._path(key, '.cache'), b'%d\n%s\n%s' % (generation, etag.encode(), body))
+
+    def generation(self, key):
+        try:
+            with open(self._path(key, '.gen'), 'rb') as generation_file:
+                return int(generation_file.read() or 0)
+        except (OSError, ValueError):
+            return 0
+
+    def bump(self, key):
+        # The generation file is replaced on each write, the workers serialize the increment on a lock file that stays
+        lock_fd = os.open(self._path(key, '.lock'), os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(lock_fd, fcntl.LOCK_EX)
+            self._write(self._path(key, '.gen'), b'%d' % (self.generation(key) + 1))
+        finally:
+            os.close(lock_fd)
+        try:
+            os.remove(self._path(key, '.cache'))
+        except OSError:
+            pass
+
+
+class ResponseCache(object):
+    """Read through cache of serialized json responses with their ETag
+
+    Every entry is stored with the generation of its key at the time the data was read,
+    invalidating a key bumps its generation so an entry computed concurrently with a
+    write is never served.
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.compressions = 0
+
+    def generation(self, key):
+        return self.backend.generation(key)
+
+    def get(self, key):
+        """Return the (etag, body) cached for key or None"""
+        entry = self.backend.get(key)
+        if entry is None or entry[0] != self.backend.generation(key):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry[1], entry[2]
+
+    def store(self, key, generation, body):
+        """Cache body, read at generation, and return its (etag, body)"""
+        etag = hashlib.sha1(body).hexdigest()
+        self.backend.set(key, (generation, etag, body))
+        return etag, body
+
+    def compressed(self, key, etag, body, encoding):
+        """Return body, the entry of key with etag, compressed with encoding, compressing each version only once
+
+        The compressed bodies are kept under their own key along with the ETag they were made from,
+        so they follow the invalidations of key without a generation of their own.
+        """
+        variant_key = f'{key}-{encoding}'
+        entry = self.backend.get(variant_key)
+        if entry is not None and entry[1] == etag:
+            return entry[2]
+        self.compressions += 1
+        compressed_body = compress(body, encoding)
+        self.backend.set(variant_key, (0, etag, compressed_body))
+        return compressed_body
+
+    def invalidate(self, *keys):
+        """Drop the entries of keys, all the representations of the same data count as one invalidation"""
+        self.invalidations += 1
+        for key in keys:
+            self.backend.bump(key)
+
+    def stats(self):
+        return {'backend':type(self.backend).__name__, 'hits':self.hits, 'misses':self.misses,
+                'invalidations':self.invalidations, 'compressions':self.compressions}
+
+
+def create_response_cache(settings):
+    """Create the response cache configured by RESPONSE_CACHE_BACKEND in settings, None disables it"""
+    backend_name = settings.get('RESPONSE_CACHE_BACKEND', RESPONSE_CACHE_BACKEND)
+    if backend_name == 'memory':
+        backend = MemoryBackend(maxsize=settings.get('RESPONSE_CACHE_SIZE', RESPONSE_CACHE_SIZE),
+                                ttl=settings.get('RESPONSE_CACHE_TTL_SECONDS', RESPONSE_CACHE_TTL_SECONDS))
+    elif backend_name == 'file':
+        backend = FileBackend(settings.get('RESPONSE_CACHE_DIR') or os.path.join(tempfile.gettempdir(), 'vessels_response_cache'))
+    elif not backend_name:
+        return None
+    else:
+        raise ValueError(f'Unknown RESPONSE_CACHE_BACKEND {backend_name}')
+    return ResponseCache(backend)
+
+
+def init_response_cache(app):
+    cache = create_response_cache(app.config)
+    app.extensions['response_cache'] = cache
+    return cache
+
+
+def response_cache():
+    return current_app.extensions.get('response_cache')
+
+
+def active_equipments_key(vessel_id, media_type=JSON):
+    if media_type == JSON:
+        return f'active_equipments-{vessel_id}'
+    return f'active_equipments-{vessel_id}-{MEDIA_TYPE_NAMES[media_type]}'
+
+
+def active_equipments_keys(vessel_id):
+    """Keys of every encoding of the active equipments list of a vessel"""
+    return [active_equipments_key(vessel_id, media_type) for media_type in MEDIA_TYPE_NAMES]
+
+
+def invalidate_vessels(cache, vessel_ids):
+    """Drop the active equipments lists of the vessels from cache, which may be None when caching is disabled"""
+    if cache:
+        for vessel_id in set(vessel_ids):
+            cache.invalidate(*active_equipments_keys(vessel_id))
+
+
+def invalidate_active_equipments(vessel_ids):
+    """Drop the cached active equipments lists of the vessels"""
+    invalidate_vessels(response_cache(), vessel_ids)
+
+
+def cached_response(etag, body, mimetype=JSON, key=None):
+    """Build the response for a cached body, answering If-None-Match with 304
+
+    The weak comparison also matches the weak ETag sent with the compressed bodies. With the key of
+    the entry the body is compressed through the cache, once for every client of that version.
+    """
+    if request.if_none_match.contains_weak(etag):
+        response = Response(status=304)
+        response.set_etag(etag)
+        return response
+
+    encoding = response_encoding(len(body)) if key is not None else None
+    if encoding is not None:
+        body = response_cache().compressed(key, etag, body, encoding)
+    response = Response(body, mimetype=mimetype)
+    response.set_etag(etag)
+    if encoding is not None:
+        response.vary.add('Accept-Encoding')
+        mark_compressed(response, encoding)
+    return response
@@ -0,0 +1,81 @@
+import threading
+
+from flask import current_app
+
+
+class _Flight(object):
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    """Coalesces the concurrent identical reads of a worker into one call
+
+    The requests for a key that arrive while no read of it has started share the next read. A read
+    only starts once the previous read of the same key finished, the requests arriving meanwhile
+    wait for the one after it instead of joining it. So every response comes from a read that started
+    after its request arrived and nothing a write committed before the request is missed.
+    """
+
+    def __init__(self):
+        self.flights = 0
+        self.coalesced = 0
+        self._pending = {}
+        # key -> [lock held while the key is read, number of flights waiting for it]
+        self._readers = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, function):
+        """Return function(), or the result of the call made for key by a request that arrived at the same time"""
+        with self._lock:
+            flight = self._pending.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._pending[key] = _Flight()
+                reader = self._readers.setdefault(key, [threading.Lock(), 0])
+                reader[1] += 1
+                self.flights += 1
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+
+        try:
+            with reader[0]:
+                # From here the requests for key wait for the next flight
+                with self._lock:
+                    del self._pending[key]
+                try:
+                    flight.result = function()
+                except BaseException as error:
+                    flight.error = error
+                    raise
+                finally:
+                    flight.done.set()
+        finally:
+            with self._lock:
+                reader[1] -= 1
+                if not reader[1]:
+                    del self._readers[key]
+        return flight.result
+
+    def stats(self):
+        with self._lock:
+            return {'flights':self.flights, 'coalesced':self.coalesced, 'in_flight':len(self._readers)}
+
+
+def init_single_flight(app):
+    """Create the request coalescing of the app, SINGLE_FLIGHT = False disables it"""
+    app.extensions['single_flight'] = SingleFlight() if app.config.get('SINGLE_FLIGHT', True) else None
+    return app.extensions['single_flight']
+
+
+def single_flight():
+    return current_app.extensions.get('single_flight')
@@ -0,0 +1,70 @@
+"""Import and startup time of each component of the app
+
+Run with `flask startup-profile`, it measures a fresh interpreter so nothing is already imported.
+"""
+import importlib
+import subprocess
+import sys
+import time
+from contextlib import contextmanager
+
+import click
+
+
+# Imported in this order, each one is charged only for what the previous ones did not import yet
+COMPONENTS = (
+    'flask',
+    'sqlalchemy',
+    'flask_sqlalchemy',
+    'apis.models.equipment',
+    'apis.models.vessel',
+    'apis.healthcheck',
+    'apis.metrics',
+    'apis.vessels_endpoint',
+    'apis.equipments_endpoint',
+    'apis.app',
+)
+
+
+@contextmanager
+def timed(timings, name):
+    """Add the seconds spent in the block to timings[name]"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[name] = timings.get(name, 0.0) + time.perf_counter() - start
+
+
+def profile(production=False):
+    """Import the components and create the app, returning the (step, seconds) of each stage"""
+    timings = {}
+    for component in COMPONENTS:
+        with timed(timings, f'import {component}'):
+            importlib.import_module(component)
+
+    from apis.app import create_app
+    app = create_app(production_conf=production)
+    for step, seconds in app.extensions['startup_timings'].items():
+        timings[f'create_app {step}'] = seconds
+    return timings
+
+
+@click.command('startup-profile')
+@click.option('--production', is_flag=True, help='profile create_app(production_conf=True)')
+def startup_profile_command(production):
+    """Report the import and startup time of each component of the app"""
+    start = time.perf_counter()
+    arguments = [sys.executable, '-m', 'apis.startup_profile'] + (['--production'] if production else [])
+    output = subprocess.run(arguments, check=True, capture_output=True, text=True).stdout
+    total = time.perf_counter() - start
+
+    for line in output.splitlines():
+        step, seconds = line.rsplit(' ', 1)
+        click.echo(f'{step:<40} {float(seconds) * 1000:8.1f}ms')
+    click.echo(f"{'total, with the interpreter start':<40} {total * 1000:8.1f}ms")
+
+
+if __name__ == '__main__':
+    for step, seconds in profile(production='--production' in sys.argv).items():
+        print(step, seconds)
@@ -0,0 +1,64 @@
+from sqlalchemy import and_, exists, func, or_, select, union_all
+
+from apis.models.equipment import equipment
+from apis.models.equipment_status_event import equipment_status_event
+from apis.models.model import db
+
+
+def inserted_events(rows, changed_at):
+    """Status events of inserting the equipment rows (dicts with vessel_id, code and active)"""
+    return [{'vessel_id':row['vessel_id'], 'code':row['code'], 'active':row['active'], 'previous_active':None,
+             'changed_at':changed_at} for row in rows]
+
+
+def record_status_events(events, connection=None):
+    """Append the events to the history in the running transaction of connection, the session by default"""
+    if events:
+        (db.session if connection is None else connection).execute(equipment_status_event.__table__.insert(), events)
+
+
+def active_at_select(vessel_id, at):
+    """Select the code, name and location of the equipments that were active on the vessel at a time, by code
+
+    The history is read backwards from the current state: an equipment without events after the time is
+    as it is now, the others were as their first event after it found them (previous_active). Only the
+    events of the vessel after the time are read, through the (vessel_id, changed_at) index.
+    """
+    events = equipment_status_event
+    later = select(events.code, events.previous_active,
+                   func.row_number().over(partition_by=events.code, order_by=(events.changed_at, events.id)).label('position')) \
+        .where(events.vessel_id==vessel_id).where(events.changed_at > at).cte('later')
+    unchanged = select(equipment.code).where(equipment.vessel_id==vessel_id).where(equipment.active==True) \
+        .where(~exists().where(later.c.code==equipment.code))
+    changed = select(later.c.code).where(later.c.position==1).where(later.c.previous_active==True)
+    codes = union_all(unchanged, changed).subquery()
+    return select(codes.c.code, equipment.name, equipment.location) \
+        .select_from(codes.outerjoin(equipment, equipment.code==codes.c.code)).order_by(codes.c.code)
+
+
+def transitions_select(vessel_id, since=None, until=None, code=None, limit=None, after=None):
+    """Select the status events of a vessel from since (included) to until (excluded), ordered by time
+
+    after is the (changed_at, id) of the last event of the previous page.
+    """
+    events = equipment_status_event
+    query = select(events.id, events.code, events.active, events.previous_active, events.changed_at) \
+        .where(events.vessel_id==vessel_id).order_by(events.changed_at, events.id)
+    if since is not None:
+        query = query.where(events.changed_at >= since)
+    if until is not None:
+        query = query.where(events.changed_at < until)
+    if code is not None:
+        query = query.where(events.code==code)
+    if after is not None:
+        # Written as a range on changed_at so the index bounds the scan
+        query = query.where(and_(events.changed_at >= after[0], or_(events.changed_at > after[0], events.id > after[1])))
+    if limit:
+        query = query.limit(limit)
+    return query
+
+
+def transitions_json(rows):
+    return [{'id':event_id, 'code':code, 'active':active, 'previous_active':previous_active,
+             'changed_at':changed_at.isoformat() + 'Z'}
+            for event_id, code, active, previous_active, changed_at in rows]
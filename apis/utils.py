@@ -0,0 +1,56 @@
+from flask import current_app
+from sqlalchemy import bindparam, column as sql_column, values as sql_values
+from sqlalchemy.dialects import postgresql, sqlite
+
+from apis.models.model import db
+
+
+BULK_CHUNK_SIZE = 1000
+
+
+def bulk_chunk_size():
+    """Number of rows each bulk statement handles"""
+    return current_app.config.get('BULK_CHUNK_SIZE', BULK_CHUNK_SIZE)
+
+
+def chunks(items, size):
+    """Split an iterable in lists of at most size items"""
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def dialect_name(connection=None):
+    """Name of the dialect of connection (a Connection or a Session), or of the engine of the app"""
+    # The session is the one of the app, its primary and replicas share the dialect of db.engine
+    if connection is None or not hasattr(connection, 'dialect'):
+        return db.engine.dialect.name
+    return connection.dialect.name
+
+
+def insert_ignoring_conflicts(table, index_elements, dialect=None):
+    """Return an INSERT for table that skips rows violating the unique index_elements"""
+    if (dialect or dialect_name()) == 'postgresql':
+        return postgresql.insert(table).on_conflict_do_nothing(index_elements=index_elements)
+    return sqlite.insert(table).on_conflict_do_nothing(index_elements=index_elements)
+
+
+def update_from_values(table, key, column, values):
+    """Set column to the value of each (key value, value) pair of values in a single UPDATE
+
+    On postgresql the pairs are joined as a VALUES list (UPDATE ... FROM), SQLite runs the UPDATE
+    once per pair in the same statement execution.
+    """
+    if not values:
+        return
+    if dialect_name() == 'postgresql':
+        requested = sql_values(sql_column('key', key.type), sql_column('value', column.type), name='requested').data(values)
+        db.session.execute(table.update().where(key==requested.c.key).values({column:requested.c.value}))
+        return
+    db.session.execute(table.update().where(key==bindparam('requested_key')).values({column:bindparam('requested_value')}),
+                       [{'requested_key':key_value, 'requested_value':value} for key_value, value in values])
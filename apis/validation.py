@@ -0,0 +1,175 @@
+from datetime import datetime, timezone
+
+from apis.models.equipment import equipment
+from apis.models.vessel import vessel
+
+
+EQUIPMENT_FIELDS = ('vessel_code', 'code', 'name', 'location')
+
+
+def is_number(value):
+    """Whether value is a non negative integer int() can parse, str.isdigit alone accepts digits like '²'"""
+    return value.isascii() and value.isdigit()
+
+
+def validate_vessel(req_json):
+    """Return the error message for a vessel payload or None if it is valid"""
+    if not isinstance(req_json, dict) or not req_json.get('code'):
+        return 'MISSING_PARAMETER'
+    if type(req_json['code']) != str or len(req_json['code']) > vessel.code.type.length:
+        return 'WRONG_FORMAT'
+    return None
+
+
+def validate_equipment(req_json):
+    """Return the error message for an equipment payload or None if it is valid"""
+    if not isinstance(req_json, dict):
+        return 'WRONG_FORMAT' if req_json else 'MISSING_PARAMETER'
+    if any(not req_json.get(field) for field in EQUIPMENT_FIELDS):
+        return 'MISSING_PARAMETER'
+    if any(type(req_json.get(field)) != str for field in EQUIPMENT_FIELDS):
+        return 'WRONG_FORMAT'
+    if any(len(req_json[field]) > getattr(equipment, field).type.length for field in ('code', 'name', 'location')):
+        return 'WRONG_FORMAT'
+    return None
+
+
+TRANSITION_OPERATIONS = ('activate', 'deactivate', 'relocate', 'change_location')
+# The field each operation needs besides the code
+TRANSITION_FIELDS = {'relocate':'vessel_code', 'change_location':'location'}
+
+
+def validate_transition(item):
+    """Return the error message for a transition of the transitions payload or None if it is valid"""
+    if not isinstance(item, dict):
+        return 'WRONG_FORMAT'
+    if not item.get('code') or not item.get('operation'):
+        return 'MISSING_PARAMETER'
+    if type(item['code']) != str or len(item['code']) > equipment.code.type.length:
+        return 'WRONG_FORMAT'
+    if item['operation'] not in TRANSITION_OPERATIONS:
+        return 'WRONG_FORMAT'
+
+    field = TRANSITION_FIELDS.get(item['operation'])
+    if field is None:
+        return None
+    if not item.get(field):
+        return 'MISSING_PARAMETER'
+    if type(item[field]) != str:
+        return 'WRONG_FORMAT'
+    if field == 'location' and len(item[field]) > equipment.location.type.length:
+        return 'WRONG_FORMAT'
+    return None
+
+
+def validate_status_codes(req_json):
+    """Return (error message, list of unique codes) for an update_equipment_status payload"""
+    if not isinstance(req_json, dict) or not req_json.get('code'):
+        return 'MISSING_PARAMETER', None
+
+    code = req_json['code']
+    if type(code) != str and type(code) != list:
+        return 'WRONG_FORMAT', None
+
+    if type(code) == str:
+        code = [code]
+
+    if any(type(item) != str for item in code):
+        return 'WRONG_FORMAT', None
+    return None, list(dict.fromkeys(code))
+
+
+def parse_active_equipments_args(req_args):
+    """Return (error message, vessel_code, limit, after_code, stream) for the active_equipments query string"""
+    if not req_args or not req_args.get('vessel_code'):
+        return 'MISSING_PARAMETER', None, None, None, False
+
+    limit = req_args.get('limit')
+    if limit is not None:
+        if not is_number(limit) or not int(limit):
+            return 'WRONG_FORMAT', None, None, None, False
+        limit = int(limit)
+
+    stream = req_args.get('stream', '').lower() in ('1', 'true')
+    return None, req_args.get('vessel_code'), limit, req_args.get('after_code'), stream
+
+
+SEARCH_DEFAULT_LIMIT = 100
+SEARCH_MAX_LIMIT = 1000
+# Text filters of the search and the column each one is matched against
+SEARCH_TEXT_FILTERS = {'code_prefix':'code', 'name':'name', 'name_prefix':'name', 'location':'location'}
+
+
+def parse_search_args(req_args):
+    """Return (error message, filters, limit, after_code) for the search query string
+
+    vessel_code can be repeated or hold a comma separated list, the filters hold the list as vessel_codes.
+    """
+    filters = {field:req_args.get(field) for field in SEARCH_TEXT_FILTERS if req_args.get(field)}
+    if any(len(value) > getattr(equipment, SEARCH_TEXT_FILTERS[field]).type.length for field, value in filters.items()):
+        return 'WRONG_FORMAT', None, None, None
+
+    vessel_codes = [code for value in req_args.getlist('vessel_code') for code in value.split(',') if code]
+    if vessel_codes:
+        filters['vessel_codes'] = list(dict.fromkeys(vessel_codes))
+
+    active = req_args.get('active')
+    if active is not None:
+        if active.lower() not in ('1', 'true', '0', 'false'):
+            return 'WRONG_FORMAT', None, None, None
+        filters['active'] = active.lower() in ('1', 'true')
+
+    limit = req_args.get('limit', str(SEARCH_DEFAULT_LIMIT))
+    if not is_number(limit) or not 0 < int(limit) <= SEARCH_MAX_LIMIT:
+        return 'WRONG_FORMAT', None, None, None
+    return None, filters, int(limit), req_args.get('after_code')
+
+
+def parse_changes_args(req_args):
+    """Return (error message, since) for the changes query string, since is 0 when not sent"""
+    since = req_args.get('since', '0')
+    if not is_number(since):
+        return 'WRONG_FORMAT', None
+    return None, int(since)
+
+
+HISTORY_DEFAULT_LIMIT = 1000
+HISTORY_MAX_LIMIT = 10000
+
+
+def parse_timestamp(value):
+    """Parse an ISO 8601 timestamp to a naive UTC datetime, the timestamps without offset are taken as UTC"""
+    try:
+        timestamp = datetime.fromisoformat(value[:-1] + '+00:00' if value.endswith('Z') else value)
+    except (TypeError, ValueError):
+        return None
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.astimezone(timezone.utc).replace(tzinfo=None)
+    return timestamp
+
+
+def parse_active_at_args(req_args):
+    """Return (error message, vessel_code, at) for the active_at query string"""
+    if not req_args.get('vessel_code') or not req_args.get('at'):
+        return 'MISSING_PARAMETER', None, None
+    at = parse_timestamp(req_args.get('at'))
+    if at is None:
+        return 'WRONG_FORMAT', None, None
+    return None, req_args.get('vessel_code'), at
+
+
+def parse_status_history_args(req_args):
+    """Return (error message, vessel_code, since, until, code, limit, after_id) for the status_history query string"""
+    if not req_args.get('vessel_code'):
+        return 'MISSING_PARAMETER', None, None, None, None, None, None
+
+    since, until = (parse_timestamp(req_args[field]) if req_args.get(field) else None for field in ('since', 'until'))
+    if (req_args.get('since') and since is None) or (req_args.get('until') and until is None):
+        return 'WRONG_FORMAT', None, None, None, None, None, None
+
+    limit = req_args.get('limit', str(HISTORY_DEFAULT_LIMIT))
+    after_id = req_args.get('after_id')
+    if not is_number(limit) or not 0 < int(limit) <= HISTORY_MAX_LIMIT or (after_id is not None and not is_number(after_id)):
+        return 'WRONG_FORMAT', None, None, None, None, None, None
+    return (None, req_args.get('vessel_code'), since, until, req_args.get('code'), int(limit),
+            int(after_id) if after_id is not None else None)
@@ -0,0 +1,168 @@
+import threading
+import time
+from collections import OrderedDict
+
+from flask import current_app
+from sqlalchemy import select
+from sqlalchemy.exc import SQLAlchemyError
+
+from apis.models.vessel import vessel
+from apis.models.model import db
+from apis.read_replicas import PRIMARY, primary, read_target
+
+
+VESSEL_CACHE_SIZE = 100000
+VESSEL_CACHE_NEGATIVE_TTL = 5.0
+
+MISSING = object()
+
+
+class VesselCache(object):
+    """Bounded LRU cache of vessel code -> vessel id
+
+    Unknown codes are cached as None for negative_ttl seconds so repeated lookups of a
+    vessel that is not in the system do not hit the database on every request.
+    """
+
+    def __init__(self, maxsize=VESSEL_CACHE_SIZE, negative_ttl=VESSEL_CACHE_NEGATIVE_TTL):
+        self.maxsize = maxsize
+        self.negative_ttl = negative_ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # Loaded with the vessels in the system at startup
+        self.warmed = False
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, code):
+        """Return the cached id of code, None for a known missing vessel or MISSING"""
+        with self._lock:
+            entry = self._entries.get(code)
+            if entry is None or (entry[1] is not None and entry[1] < time.monotonic()):
+                self.misses += 1
+                return MISSING
+            self._entries.move_to_end(code)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, code, vessel_id):
+        expires_at = None if vessel_id is not None else time.monotonic() + self.negative_ttl
+        with self._lock:
+            self._entries[code] = (vessel_id, expires_at)
+            self._entries.move_to_end(code)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, code):
+        with self._lock:
+            self._entries.pop(code, None)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {'size':len(self._entries), 'maxsize':self.maxsize, 'hits':self.hits,
+                    'misses':self.misses, 'evictions':self.evictions}
+
+
+def init_vessel_cache(app):
+    """Create the vessel cache of the app and warm it with the vessels in the system"""
+    cache = VesselCache(maxsize=app.config.get('VESSEL_CACHE_SIZE', VESSEL_CACHE_SIZE),
+                        negative_ttl=app.config.get('VESSEL_CACHE_NEGATIVE_TTL', VESSEL_CACHE_NEGATIVE_TTL))
+    app.extensions['vessel_cache'] = cache
+
+    if app.config.get('VESSEL_CACHE_WARM', True):
+        with app.app_context():
+            try:
+                vessel_query = db.session.query(vessel.code, vessel.id).order_by(vessel.id).limit(cache.maxsize)
+                for code, vessel_id in db.session.execute(vessel_query):
+                    cache.set(code, vessel_id)
+                cache.warmed = True
+            except SQLAlchemyError:
+                # The database may not be created yet (e.g. while running migrations)
+                pass
+            finally:
+                db.session.remove()
+    return cache
+
+
+def vessel_cache():
+    return current_app.extensions['vessel_cache']
+
+
+def lookup_vessel_id(connection, cache, code):
+    """Return the id of the vessel with code or None if it is not in the system, querying connection on a cache miss"""
+    vessel_id = cache.get(code)
+    if vessel_id is MISSING:
+        vessel_id = connection.execute(select(vessel.id).where(vessel.code==code)).scalar()
+        cache.set(code, vessel_id)
+    return vessel_id
+
+
+def lookup_vessel_ids(connection, cache, codes):
+    """Return a dict of code -> id for the codes that are in the system, querying connection for the uncached ones"""
+    vessel_ids = {}
+    uncached = []
+    for code in codes:
+        vessel_id = cache.get(code)
+        if vessel_id is MISSING:
+            uncached.append(code)
+        elif vessel_id is not None:
+            vessel_ids[code] = vessel_id
+
+    if uncached:
+        found = dict(connection.execute(select(vessel.code, vessel.id).where(vessel.code.in_(uncached))).all())
+        for code in uncached:
+            cache.set(code, found.get(code))
+        vessel_ids.update(found)
+    return vessel_ids
+
+
+def get_vessel_id(code):
+    """Return the id of the vessel with code or None if it is not in the system
+
+    A code missing from the replica of the request is looked up again on the primary before being
+    cached as missing, the replica may not have received the insert of the vessel yet.
+    """
+    cache = vessel_cache()
+    vessel_id = cache.get(code)
+    if vessel_id is MISSING:
+        vessel_query = select(vessel.id).where(vessel.code==code)
+        vessel_id = db.session.execute(vessel_query).scalar()
+        if vessel_id is None and read_target() != PRIMARY:
+            with primary():
+                vessel_id = db.session.execute(vessel_query).scalar()
+        cache.set(code, vessel_id)
+    return vessel_id
+
+
+def get_vessel_ids(codes):
+    """Return a dict of code -> id for the codes that are in the system, querying only the uncached ones"""
+    cache = vessel_cache()
+    vessel_ids = {}
+    uncached = []
+    for code in codes:
+        vessel_id = cache.get(code)
+        if vessel_id is MISSING:
+            uncached.append(code)
+        elif vessel_id is not None:
+            vessel_ids[code] = vessel_id
+
+    if uncached:
+        found = dict(db.session.execute(select(vessel.code, vessel.id).where(vessel.code.in_(uncached))).all())
+        missing = [code for code in uncached if code not in found]
+        if missing and read_target() != PRIMARY:
+            with primary():
+                found.update(db.session.execute(select(vessel.code, vessel.id).where(vessel.code.in_(missing))).all())
+        for code in uncached:
+            cache.set(code, found.get(code))
+        vessel_ids.update(found)
+    return vessel_ids
@@ -1,14 +1,20 @@
 from flask import Blueprint, request, jsonify
 from sqlalchemy import func, extract, and_
+from sqlalchemy.exc import IntegrityError
 
-from apis.models.vessel import vessel
 from apis.models.model import db
+from apis.idempotency import idempotent
+from apis.operations import bulk_vessel_result, insert_vessel_code, insert_vessel_codes, valid_vessel_codes
+from apis.utils import bulk_chunk_size, chunks
+from apis.validation import validate_vessel
+from apis.vessel_cache import vessel_cache
 
 
 vessels_blueprint = Blueprint('vessels', __name__)
 
 
 @vessels_blueprint.route('/insert_vessel', methods=['POST'])
+@idempotent
 def insert_vessel():
 
     """Insert a new vessel
@@ -18,6 +24,11 @@ def insert_vessel():
               in: body
               type: string
               required: true
+            - name: Idempotency-Key
+              in: header
+              type: string
+              required: false
+              description: unique key of the request, the retries sent with the same key and body get the response of the first one without inserting again
         responses:
           201:
             description: returns OK if the vessel was correctly inserted
@@ -27,23 +38,77 @@ def insert_vessel():
             description: returns WRONG_FORMAT if any parameter are sent in the wrong format
           409:
             description: returns FAIL if the vessel code is already in the system
+          409:
+            description: returns IN_PROGRESS if the request with the same Idempotency-Key is still running
+          422:
+            description: returns IDEMPOTENCY_KEY_REUSED if the Idempotency-Key was sent before with another body
     """
     req_json = request.get_json()
-    if not req_json or not req_json.get('code'):
-        return {'message':'MISSING_PARAMETER'}, 400
+    error = validate_vessel(req_json)
+    if error:
+        return {'message':error}, 400
     
     code = req_json.get('code')
-    
-    if type(code) != str:
-        return {'message':'WRONG_FORMAT'}, 400
-    
-    in_the_system = db.session.query(vessel.id).filter(vessel.code==code).count()
-    
-    if in_the_system:
-        return {'message':'FAIL'}, 409
 
-    vessel_obj = vessel(code=code)
-    db.session.add(vessel_obj)
-    db.session.commit()
+    try:
+        vessel_id = insert_vessel_code(db.session, code)
+        db.session.commit()
+    except IntegrityError:
+        # The unique constraint on the code replaces the check before the insert
+        db.session.rollback()
+        return {'message':'FAIL'}, 409
+    vessel_cache().set(code, vessel_id)
 
     return {'message':'OK'}, 201
+
+
+def _upsert_vessel_chunk(codes):
+    """Insert the codes that are not in the system yet and return the created ones"""
+    while True:
+        try:
+            created = insert_vessel_codes(db.session, codes)
+            db.session.commit()
+            break
+        except IntegrityError:
+            # A concurrent request inserted some of the codes after the read, classify the chunk again
+            db.session.rollback()
+    for code in created:
+        # Drop the cached misses, the ids are loaded on the first lookup
+        vessel_cache().invalidate(code)
+    return created
+
+@vessels_blueprint.route('/bulk_insert', methods=['POST'])
+def bulk_insert_vessel():
+
+    """Insert a list of vessels
+        ---
+        parameters:
+            - name: code
+              in: body
+              type: array
+              items:
+                type: string
+              required: true
+        responses:
+          201:
+            description: returns OK with the created and existing lists of codes and a results list holding, for each code in the order it was sent, the message insert_vessel would return (OK, FAIL or WRONG_FORMAT)
+          400:
+            description: returns MISSING_PARAMETER if the list of codes is not sent
+          400:
+            description: returns WRONG_FORMAT if the codes are not sent in a list
+    """
+    req_json = request.get_json(silent=True)
+    if isinstance(req_json, dict):
+        req_json = req_json.get('code')
+    if not req_json:
+        return {'message':'MISSING_PARAMETER'}, 400
+
+    if type(req_json) != list:
+        return {'message':'WRONG_FORMAT'}, 400
+
+    valid_codes = valid_vessel_codes(req_json)
+    created = set()
+    for chunk in chunks(valid_codes, bulk_chunk_size()):
+        created.update(_upsert_vessel_chunk(chunk))
+
+    return bulk_vessel_result(req_json, valid_codes, created), 201
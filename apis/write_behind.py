@@ -0,0 +1,290 @@
+import atexit
+import fcntl
+import hashlib
+import mmap
+import os
+import queue
+import struct
+import tempfile
+import threading
+import time
+import uuid
+
+from flask import current_app
+from sqlalchemy import select
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
+
+from apis.models.equipment import equipment
+from apis.load_control import LOCK_STRIPES
+from apis.models.model import db
+from apis.operations import insert_equipments
+from apis.response_cache import invalidate_active_equipments
+
+
+WRITE_BEHIND_MAX_ROWS = 500
+WRITE_BEHIND_MAX_WAIT_MS = 5
+WRITE_BEHIND_WAIT_TIMEOUT = 10.0
+WRITE_BEHIND_TICKET_SLOTS = 65536
+
+PENDING = 'PENDING'
+# Position of each status in a ticket slot, 0 marks an empty slot
+TICKET_STATUSES = (None, PENDING, 'OK', 'REPEATED_CODE', 'FAILED')
+# Queued by close to end the group commit thread
+STOP = object()
+
+
+class Ticket(object):
+    """Outcome of one queued insert, status is PENDING until its group is committed"""
+
+    __slots__ = ('id', 'row', 'status', 'done')
+
+    def __init__(self, ticket_id, row):
+        self.id = ticket_id
+        self.row = row
+        self.status = PENDING
+        self.done = threading.Event()
+
+    def finish(self, status):
+        self.status = status
+        self.done.set()
+
+
+class SharedTickets(object):
+    """Status of the queued inserts in a memory mapped file shared by the worker processes
+
+    The file holds a fixed table of slots (ticket id hash, status) addressed by the id hash and
+    locked like the SharedBuckets of apis.load_control, so insert_status answers for the tickets of
+    every worker of the host. A ticket whose slot is taken by a newer one is reported as unknown.
+    """
+    SLOT = struct.Struct('<QB')
+
+    def __init__(self, path, slots=WRITE_BEHIND_TICKET_SLOTS):
+        self.path = path
+        self.slots = slots
+        size = slots * self.SLOT.size
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        if os.fstat(self._fd).st_size < size:
+            os.ftruncate(self._fd, size)
+        self._map = mmap.mmap(self._fd, size)
+        self._locks = [threading.Lock() for _ in range(LOCK_STRIPES)]
+
+    def _locked(self, ticket_id, update):
+        # Zero marks an empty slot
+        digest = int.from_bytes(hashlib.blake2b(ticket_id.encode(), digest_size=8).digest(), 'little') or 1
+        slot = digest % self.slots
+        offset = slot * self.SLOT.size
+        with self._locks[slot % LOCK_STRIPES]:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX, self.SLOT.size, offset)
+            try:
+                return update(digest, offset)
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN, self.SLOT.size, offset)
+
+    def set(self, ticket_id, status):
+        self._locked(ticket_id, lambda digest, offset: self.SLOT.pack_into(self._map, offset, digest,
+                                                                           TICKET_STATUSES.index(status)))
+
+    def get(self, ticket_id):
+        """Return the status of the ticket or None if it is unknown or expired"""
+        def read(digest, offset):
+            stored, status = self.SLOT.unpack_from(self._map, offset)
+            return TICKET_STATUSES[status] if stored == digest else None
+        return self._locked(ticket_id, read)
+
+
+class InsertBatcher(object):
+    """Group commits single equipment inserts from a background thread
+
+    The inserts are queued by submit and written by one INSERT and one COMMIT per group, a group is
+    closed after max_rows rows or max_wait_ms milliseconds since its first row. The codes already in
+    the table are kept in memory so repeated codes are refused before they are queued, the unique
+    constraint still decides between workers that queued the same code. The ticket ids carry the
+    pid of the worker and the statuses are kept in tickets (SharedTickets), so any worker answers
+    insert_status.
+    """
+
+    def __init__(self, app, tickets, max_rows=WRITE_BEHIND_MAX_ROWS, max_wait_ms=WRITE_BEHIND_MAX_WAIT_MS):
+        self.app = app
+        self.tickets = tickets
+        self.max_rows = max_rows
+        self.max_wait = max_wait_ms / 1000
+        self.flushes = 0
+        self.rows = 0
+        self.max_group = 0
+        self._known_codes = set()
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+
+    def seed(self):
+        """Load the codes already in the table"""
+        with self.app.app_context():
+            try:
+                codes = {row[0] for row in db.session.execute(select(equipment.code))}
+            finally:
+                db.session.remove()
+        with self._lock:
+            self._known_codes.update(codes)
+
+    def remember(self, codes):
+        """Add codes inserted by other paths (e.g. bulk_insert) to the known ones"""
+        with self._lock:
+            self._known_codes.update(codes)
+
+    def submit(self, row):
+        """Queue the insert of row and return its Ticket, or None if its code is already known"""
+        with self._lock:
+            if row['code'] in self._known_codes:
+                return None
+            self._known_codes.add(row['code'])
+        ticket = Ticket(f'{os.getpid()}-{uuid.uuid4().hex}', row)
+        self.tickets.set(ticket.id, PENDING)
+        self._ensure_worker()
+        self._queue.put(ticket)
+        return ticket
+
+    def result(self, ticket_id):
+        """Return the status of the insert with ticket_id, queued by any worker, or None if it is unknown"""
+        return self.tickets.get(ticket_id)
+
+    def stats(self):
+        return {'queued':self._queue.qsize(), 'flushes':self.flushes, 'rows':self.rows, 'max_group':self.max_group}
+
+    def _ensure_worker(self):
+        # The thread is started on the first insert of each process, so it also runs in forked workers
+        if self._thread is not None and self._pid == os.getpid() and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is None or self._pid != os.getpid() or not self._thread.is_alive():
+                self._pid = os.getpid()
+                self._thread = threading.Thread(target=self._run, name='insert-batcher', daemon=True)
+                self._thread.start()
+
+    def _next_group(self):
+        """Return the next group and whether STOP was reached"""
+        group = []
+        deadline = None
+        while len(group) < self.max_rows:
+            try:
+                if deadline is None:
+                    ticket = self._queue.get()
+                    deadline = time.monotonic() + self.max_wait
+                else:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    ticket = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if ticket is STOP:
+                return group, True
+            group.append(ticket)
+        return group, False
+
+    def _run(self):
+        stopped = False
+        while not stopped:
+            group, stopped = self._next_group()
+            if not group:
+                continue
+            with self.app.app_context():
+                try:
+                    self.flush(group)
+                finally:
+                    db.session.remove()
+
+    def close(self):
+        """Stop the group commit thread after its current group, then commit what is still queued
+
+        Run at exit so fire and forget inserts are not lost on shutdown. The thread is joined before
+        the drain, a group is never committed by both at once.
+        """
+        thread = self._thread
+        if thread is not None and self._pid == os.getpid() and thread.is_alive():
+            self._queue.put(STOP)
+            thread.join()
+        self.drain()
+
+    def drain(self):
+        """Commit what is still queued, the group commit thread must not be running"""
+        group = []
+        while True:
+            try:
+                ticket = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if ticket is not STOP:
+                group.append(ticket)
+        if group:
+            with self.app.app_context():
+                try:
+                    self.flush(group)
+                finally:
+                    db.session.remove()
+
+    def flush(self, group):
+        """Insert and commit a group of tickets in one transaction, then finish each ticket"""
+        try:
+            statuses = self._insert(group)
+        except SQLAlchemyError:
+            db.session.rollback()
+            current_app.logger.exception('Group commit of %d equipments failed', len(group))
+            with self._lock:
+                self._known_codes.difference_update(ticket.row['code'] for ticket in group)
+            statuses = ['FAILED'] * len(group)
+
+        self.flushes += 1
+        self.rows += len(group)
+        self.max_group = max(self.max_group, len(group))
+        for ticket, status in zip(group, statuses):
+            self.tickets.set(ticket.id, status)
+            ticket.finish(status)
+
+    def _insert(self, group):
+        rows = [ticket.row for ticket in group]
+        try:
+            insert_equipments(db.session, rows)
+            db.session.commit()
+            statuses = ['OK'] * len(group)
+        except IntegrityError:
+            # Another worker inserted some of the codes, insert only the ones that are still free
+            db.session.rollback()
+            codes = [row['code'] for row in rows]
+            known_query = select(equipment.code).where(equipment.code.in_(codes))
+            existing = {row[0] for row in db.session.execute(known_query)}
+            rows = [row for row in rows if row['code'] not in existing]
+            if rows:
+                insert_equipments(db.session, rows)
+            db.session.commit()
+            statuses = ['REPEATED_CODE' if ticket.row['code'] in existing else 'OK' for ticket in group]
+
+        invalidate_active_equipments(row['vessel_id'] for row in rows)
+        return statuses
+
+
+def init_insert_batcher(app):
+    """Create the insert batcher of app when WRITE_BEHIND_MODE is wait or async"""
+    mode = app.config.get('WRITE_BEHIND_MODE')
+    if mode not in (None, '', 'wait', 'async'):
+        raise ValueError(f'Unknown WRITE_BEHIND_MODE {mode}')
+    if not mode:
+        app.extensions['insert_batcher'] = None
+        return None
+
+    path = app.config.get('WRITE_BEHIND_TICKETS_FILE') or os.path.join(tempfile.gettempdir(), 'vessels_write_behind_tickets')
+    tickets = SharedTickets(path, slots=app.config.get('WRITE_BEHIND_TICKET_SLOTS', WRITE_BEHIND_TICKET_SLOTS))
+    batcher = InsertBatcher(app, tickets, max_rows=app.config.get('WRITE_BEHIND_MAX_ROWS', WRITE_BEHIND_MAX_ROWS),
+                            max_wait_ms=app.config.get('WRITE_BEHIND_MAX_WAIT_MS', WRITE_BEHIND_MAX_WAIT_MS))
+    try:
+        batcher.seed()
+    except SQLAlchemyError:
+        # The database may not be created yet (e.g. while running migrations), the unique constraint still holds
+        pass
+    atexit.register(batcher.close)
+    app.extensions['insert_batcher'] = batcher
+    return batcher
+
+
+def insert_batcher():
+    return current_app.extensions.get('insert_batcher')
@@ -0,0 +1,59 @@
+import random
+
+from sqlalchemy import select, text
+
+from apis.models.model import db
+from apis.models.vessel import vessel
+from apis.models.equipment import equipment
+
+
+SEED_CHUNK_SIZE = 10000
+NAMES = ('compressor', 'main engine', 'ballast pump', 'fire pump', 'generator', 'winch', 'crane', 'radar',
+         'gps antenna', 'valve', 'electric panel', 'boiler', 'separator', 'thruster', 'steering gear')
+LOCATIONS = ('brazil', 'norway', 'usa', 'china', 'peru', 'singapore', 'netherlands', 'nigeria', 'mexico', 'angola')
+
+
+def vessel_code(number):
+    return f'V{number:07d}'
+
+
+def equipment_code(number):
+    return f'{number:08X}'
+
+
+def seed(engine, vessels, equipments, active_ratio=0.9):
+    """Recreate the tables with vessels and equipments spread evenly among them
+
+    Vessel and equipment codes are built by vessel_code and equipment_code from 0 up, the names cycle
+    through NAMES with a serial number ('winch 17') and the locations through LOCATIONS.
+    """
+    db.metadata.drop_all(engine)
+    db.metadata.create_all(engine)
+    with engine.begin() as connection:
+        connection.execute(vessel.__table__.insert(), [{'code':vessel_code(number)} for number in range(vessels)])
+        vessel_ids = dict(connection.execute(select(vessel.code, vessel.id)).all())
+        for start in range(0, equipments, SEED_CHUNK_SIZE):
+            rows = [{'vessel_id':vessel_ids[vessel_code(number % vessels)], 'code':equipment_code(number),
+                     'name':f'{NAMES[number % len(NAMES)]} {number // len(NAMES) % 1000}',
+                     'location':LOCATIONS[number // 7 % len(LOCATIONS)], 'active':random.random() < active_ratio}
+                    for number in range(start, min(start + SEED_CHUNK_SIZE, equipments))]
+            connection.execute(equipment.__table__.insert(), rows)
+    analyze(engine)
+
+
+def analyze(engine):
+    with engine.begin() as connection:
+        connection.execute(text('ANALYZE'))
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * fraction))]
+
+
+def summarize(latencies):
+    """p50/p95/p99 and max of a list of latencies in seconds, in milliseconds"""
+    latencies = sorted(latencies)
+    return {'p50_ms':percentile(latencies, 0.50) * 1000, 'p95_ms':percentile(latencies, 0.95) * 1000,
+            'p99_ms':percentile(latencies, 0.99) * 1000, 'max_ms':latencies[-1] * 1000}
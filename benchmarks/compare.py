@@ -0,0 +1,55 @@
+"""Compare two benchmarks.run reports and flag the regressions
+
+    python -m benchmarks.compare before.json after.json --threshold 0.1
+
+Exits with status 1 when throughput drops or latency grows by more than the threshold,
+or when any scenario issues more queries per request.
+"""
+import argparse
+import json
+import sys
+
+
+# metric -> True when a higher value is better
+METRICS = {'requests_per_second':True, 'p50_ms':False, 'p95_ms':False, 'p99_ms':False, 'queries_per_request':False}
+
+
+def compare(before, after, threshold):
+    """Yield (mode, scenario, metric, before, after, change, regression) for the results in both reports"""
+    for mode, scenarios in after['results'].items():
+        for scenario, result in scenarios.items():
+            previous = before['results'].get(mode, {}).get(scenario)
+            if previous is None:
+                continue
+            for metric, higher_is_better in METRICS.items():
+                old, new = previous[metric], result[metric]
+                change = (new - old) / old if old else 0.0
+                if metric == 'queries_per_request':
+                    regression = new > old
+                elif higher_is_better:
+                    regression = change < -threshold
+                else:
+                    regression = change > threshold
+                yield mode, scenario, metric, old, new, change, regression
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('before')
+    parser.add_argument('after')
+    parser.add_argument('--threshold', type=float, default=0.1, help='relative change tolerated before flagging a regression')
+    args = parser.parse_args()
+
+    with open(args.before) as before_file, open(args.after) as after_file:
+        before, after = json.load(before_file), json.load(after_file)
+
+    regressions = 0
+    for mode, scenario, metric, old, new, change, regression in compare(before, after, args.threshold):
+        regressions += regression
+        print(f"{'REGRESSION' if regression else '':<10} {mode:<7} {scenario:<24} {metric:<20} {old:10.2f} -> {new:10.2f} ({change:+.1%})")
+
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == '__main__':
+    main()
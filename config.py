@@ -8,8 +8,60 @@ class RunConfig(object):
     pghost = os.environ.get('PGHOST', 'db')
     pgport = os.environ.get('PGPORT', '5432')
     pgdb = os.environ.get('PGDATABASE', 'vessels_db')
-    SQLALCHEMY_DATABASE_URI = f'postgresql://{pguser}:{pgpass}@{pghost}:{pgport}/{pgdb}'
+    SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL', f'postgresql://{pguser}:{pgpass}@{pghost}:{pgport}/{pgdb}')
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    # Comma separated urls of read replicas, the GET requests are balanced across them and the writes go to the primary
+    SQLALCHEMY_REPLICA_URIS = [uri for uri in os.environ.get('DATABASE_REPLICA_URLS', '').split(',') if uri]
+    # Seconds a client that wrote keeps reading from the primary, longer than the replication lag
+    READ_YOUR_WRITES_SECONDS = float(os.environ.get('READ_YOUR_WRITES_SECONDS', 5))
+    # memory, file (shared by the workers through RESPONSE_CACHE_DIR) or None to disable
+    RESPONSE_CACHE_BACKEND = os.environ.get('RESPONSE_CACHE_BACKEND', 'memory')
+    RESPONSE_CACHE_DIR = os.environ.get('RESPONSE_CACHE_DIR')
+    # Seconds the memory backend keeps an entry, it does not see the writes of the other processes (0 keeps them)
+    RESPONSE_CACHE_TTL_SECONDS = float(os.environ.get('RESPONSE_CACHE_TTL_SECONDS', 60))
+    # Concurrent identical active_equipments requests of a worker share one query and serialization
+    SINGLE_FLIGHT = os.environ.get('SINGLE_FLIGHT', '1') == '1'
+    # Sent in X-Admin-Key to the maintenance routes (/equipment/statistics/check and rebuild), unset disables them
+    ADMIN_API_KEY = os.environ.get('ADMIN_API_KEY')
+    # Seconds the database probe of /ready is reused, however many times the load balancer asks
+    READINESS_PROBE_INTERVAL = float(os.environ.get('READINESS_PROBE_INTERVAL', 2))
+    # Server-Timing headers and the request histograms of /metrics
+    INSTRUMENTATION_ENABLED = os.environ.get('INSTRUMENTATION_ENABLED', '1') == '1'
+    # File mapped by the workers of the host holding the histograms, unset keeps them per worker
+    METRICS_FILE = os.environ.get('METRICS_FILE')
+    # Connection pool of the ASGI app (apis/asgi.py)
+    ASYNC_POOL_SIZE = int(os.environ.get('ASYNC_POOL_SIZE', 20))
+    ASYNC_MAX_OVERFLOW = int(os.environ.get('ASYNC_MAX_OVERFLOW', 30))
+    # Build the swagger documentation on the first request to /apidocs instead of at startup
+    LAZY_SWAGGER = os.environ.get('LAZY_SWAGGER', '0') == '1'
+    # Equipment responses of at least this many bytes are sent gzip/brotli compressed when accepted, 0 compresses all
+    COMPRESSION_MIN_SIZE = int(os.environ.get('COMPRESSION_MIN_SIZE', 1024))
+    # Seconds the responses of the requests sent with an Idempotency-Key are replayed to their retries
+    IDEMPOTENCY_TTL_SECONDS = int(os.environ.get('IDEMPOTENCY_TTL_SECONDS', 86400))
+    # Token bucket of each client (X-API-Key header or address) per route: memory, shared (a file mapped by the workers
+    # of the host, RATE_LIMIT_FILE) or None to disable. RATE_LIMITS maps an endpoint to (requests per second, burst)
+    RATE_LIMIT_BACKEND = os.environ.get('RATE_LIMIT_BACKEND') or None
+    # Proxies in front of the app whose X-Forwarded-* headers are trusted for the client address, 0 when it is exposed
+    # directly (a client could otherwise pick its own address and bucket)
+    PROXY_FIX_HOPS = int(os.environ.get('PROXY_FIX_HOPS', 0))
+    RATE_LIMIT_FILE = os.environ.get('RATE_LIMIT_FILE')
+    RATE_LIMIT_DEFAULT = (float(os.environ.get('RATE_LIMIT_RATE', 50)), int(os.environ.get('RATE_LIMIT_BURST', 100)))
+    RATE_LIMITS = {
+        'equipments.active_equipment':(20.0, 40),
+        'equipments.search_equipment':(10.0, 20),
+        'equipments.bulk_insert_equipment':(2.0, 5),
+        'equipments.equipment_transitions':(2.0, 5),
+        'vessels.bulk_insert_vessel':(2.0, 5),
+    }
+    # 503 with Retry-After while a worker has this many requests in flight or its pool checkouts wait this long on average
+    LOAD_SHED_MAX_IN_FLIGHT = int(os.environ.get('LOAD_SHED_MAX_IN_FLIGHT', 0)) or None
+    LOAD_SHED_MAX_POOL_WAIT_MS = float(os.environ.get('LOAD_SHED_MAX_POOL_WAIT_MS', 0)) or None
+    # Group commit the single equipment inserts: wait (answer after the commit), async (answer 202) or None
+    WRITE_BEHIND_MODE = os.environ.get('WRITE_BEHIND_MODE') or None
+    WRITE_BEHIND_MAX_ROWS = int(os.environ.get('WRITE_BEHIND_MAX_ROWS', 500))
+    WRITE_BEHIND_MAX_WAIT_MS = int(os.environ.get('WRITE_BEHIND_MAX_WAIT_MS', 5))
+    # File mapped by the workers of the host holding the status of the queued inserts, unset uses one in the temp dir
+    WRITE_BEHIND_TICKETS_FILE = os.environ.get('WRITE_BEHIND_TICKETS_FILE')
 
 
 class TestConfig(object):
@@ -21,4 +73,39 @@ class TestConfig(object):
     pgdb = os.environ.get('PGDATABASETEST', 'vessels_db_test')
     SQLALCHEMY_DATABASE_URI = f'postgresql://{pguser}:{pgpass}@{pghost}:{pgport}/{pgdb}'
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    # The tests write to the tables directly, bypassing the cache invalidation
+    RESPONSE_CACHE_BACKEND = None
+    ADMIN_API_KEY = 'test-admin-key'
+    PROXY_FIX_HOPS = 1
+    INSTRUMENTATION_ENABLED = True
+
+
 
+class ProductionConfig(RunConfig):
+    DEBUG = False
+    pool_size = int(os.environ.get('DB_POOL_SIZE', 10))
+    max_overflow = int(os.environ.get('DB_MAX_OVERFLOW', 10))
+    pool_recycle = int(os.environ.get('DB_POOL_RECYCLE', 1800))
+    pool_timeout = int(os.environ.get('DB_POOL_TIMEOUT', 10))
+    statement_timeout = int(os.environ.get('DB_STATEMENT_TIMEOUT_MS', 5000))
+    # The workers are separate processes, the response cache must be shared to be invalidated by all of them
+    RESPONSE_CACHE_BACKEND = os.environ.get('RESPONSE_CACHE_BACKEND', 'file')
+    RESPONSE_CACHE_DIR = os.environ.get('RESPONSE_CACHE_DIR', '/dev/shm/vessels_response_cache' if os.path.isdir('/dev/shm') else None)
+    LAZY_SWAGGER = os.environ.get('LAZY_SWAGGER', '1') == '1'
+    RATE_LIMIT_FILE = os.environ.get('RATE_LIMIT_FILE', '/dev/shm/vessels_rate_limits' if os.path.isdir('/dev/shm') else None)
+    METRICS_FILE = os.environ.get('METRICS_FILE', '/dev/shm/vessels_metrics' if os.path.isdir('/dev/shm') else None)
+    WRITE_BEHIND_TICKETS_FILE = os.environ.get('WRITE_BEHIND_TICKETS_FILE', '/dev/shm/vessels_write_behind_tickets'
+                                               if os.path.isdir('/dev/shm') else None)
+    # Served behind the load balancer
+    PROXY_FIX_HOPS = int(os.environ.get('PROXY_FIX_HOPS', 1))
+    if RunConfig.SQLALCHEMY_DATABASE_URI.startswith('postgresql'):
+        SQLALCHEMY_ENGINE_OPTIONS = {
+            'pool_size':pool_size,
+            'max_overflow':max_overflow,
+            'pool_recycle':pool_recycle,
+            'pool_timeout':pool_timeout,
+            'pool_pre_ping':True,
+            'connect_args':{'options':f'-c statement_timeout={statement_timeout}'},
+        }
+    else:
+        SQLALCHEMY_ENGINE_OPTIONS = {'pool_pre_ping':True}
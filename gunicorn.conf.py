@@ -0,0 +1,25 @@
+import multiprocessing
+import os
+
+from apis.models.model import db
+
+
+bind = os.environ.get('BIND', '0.0.0.0:5000')
+workers = int(os.environ.get('WEB_WORKERS', multiprocessing.cpu_count() * 2 + 1))
+threads = int(os.environ.get('WEB_THREADS', 4))
+worker_class = 'gthread'
+# Import the app once in the master so the workers are forked ready to serve
+preload_app = True
+timeout = int(os.environ.get('WEB_TIMEOUT', 30))
+graceful_timeout = 30
+keepalive = 5
+max_requests = int(os.environ.get('WEB_MAX_REQUESTS', 10000))
+max_requests_jitter = max_requests // 10
+accesslog = '-' if os.environ.get('WEB_ACCESS_LOG') == '1' else None
+
+
+def post_fork(server, worker):
+    # The connections opened by the master (e.g. warming the caches) can not be shared with the workers
+    from wsgi import app
+    with app.app_context():
+        db.engine.dispose()
@@ -2,9 +2,13 @@ from flask_migrate import Migrate
 
 from apis.app import create_app
 from apis.models.model import db
+from apis.fleet_io import export_snapshot_command, import_equipments_command, import_vessels_command
 
 app = create_app()
 migrate = Migrate(app, db)
+app.cli.add_command(import_vessels_command)
+app.cli.add_command(import_equipments_command)
+app.cli.add_command(export_snapshot_command)
 
 @app.shell_context_processor
 def make_shell_context():
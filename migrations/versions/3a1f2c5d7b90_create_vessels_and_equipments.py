@@ -0,0 +1,42 @@
+"""create vessels and equipments
+
+Revision ID: 3a1f2c5d7b90
+Revises: 
+Create Date: 2026-10-17 11:45:12.381205
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3a1f2c5d7b90'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # SQLite only autoincrements an INTEGER PRIMARY KEY, as in the models
+    op.create_table('vessels',
+    sa.Column('id', sa.BigInteger().with_variant(sa.Integer(), 'sqlite'), nullable=False),
+    sa.Column('code', sa.String(length=8), nullable=True),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('code')
+    )
+    op.create_table('equipments',
+    sa.Column('id', sa.BigInteger().with_variant(sa.Integer(), 'sqlite'), nullable=False),
+    sa.Column('vessel_id', sa.BigInteger(), nullable=True),
+    sa.Column('name', sa.String(length=256), nullable=True),
+    sa.Column('code', sa.String(length=8), nullable=True),
+    sa.Column('location', sa.String(length=256), nullable=True),
+    sa.Column('active', sa.Boolean(), nullable=True),
+    sa.ForeignKeyConstraint(['vessel_id'], ['vessels.id'], ),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('code')
+    )
+
+
+def downgrade():
+    op.drop_table('equipments')
+    op.drop_table('vessels')
@@ -0,0 +1,37 @@
+"""equipment status events
+
+Revision ID: a4d2f6b8c017
+Revises: f3c8e2a1d4b6
+Create Date: 2026-10-17 19:40:11.207683
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a4d2f6b8c017'
+down_revision = 'f3c8e2a1d4b6'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # The history starts empty: the equipments already in the system count as unchanged since before any timestamp
+    op.create_table('equipment_status_events',
+    sa.Column('id', sa.BigInteger().with_variant(sa.Integer(), 'sqlite'), nullable=False),
+    sa.Column('vessel_id', sa.BigInteger(), nullable=False),
+    sa.Column('code', sa.String(length=8), nullable=False),
+    sa.Column('active', sa.Boolean(), nullable=True),
+    sa.Column('previous_active', sa.Boolean(), nullable=True),
+    sa.Column('changed_at', sa.DateTime(), nullable=False),
+    sa.ForeignKeyConstraint(['vessel_id'], ['vessels.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_equipment_status_events_vessel_id_changed_at', 'equipment_status_events',
+                    ['vessel_id', 'changed_at'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_equipment_status_events_vessel_id_changed_at', table_name='equipment_status_events')
+    op.drop_table('equipment_status_events')
@@ -0,0 +1,32 @@
+"""index equipments by vessel
+
+Revision ID: b7e4d2a9c861
+Revises: 3a1f2c5d7b90
+Create Date: 2026-10-17 11:52:40.118734
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b7e4d2a9c861'
+down_revision = '3a1f2c5d7b90'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Built concurrently so a large equipments table stays writable while the indexes are created
+    with op.get_context().autocommit_block():
+        op.create_index(op.f('ix_equipments_vessel_id'), 'equipments', ['vessel_id'], unique=False,
+                        postgresql_concurrently=True)
+        op.create_index('ix_equipments_active_vessel_id_code', 'equipments', ['vessel_id', 'code'], unique=False,
+                        postgresql_where=sa.text('active'), sqlite_where=sa.text('active'),
+                        postgresql_concurrently=True)
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        op.drop_index('ix_equipments_active_vessel_id_code', table_name='equipments', postgresql_concurrently=True)
+        op.drop_index(op.f('ix_equipments_vessel_id'), table_name='equipments', postgresql_concurrently=True)
@@ -0,0 +1,35 @@
+"""search equipments indexes
+
+Revision ID: c5d91e3f4a27
+Revises: b7e4d2a9c861
+Create Date: 2026-10-17 14:08:12.503921
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = 'c5d91e3f4a27'
+down_revision = 'b7e4d2a9c861'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    if op.get_bind().dialect.name == 'postgresql':
+        op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    # Built concurrently so a large equipments table stays writable while the indexes are created
+    with op.get_context().autocommit_block():
+        op.create_index('ix_equipments_code_pattern', 'equipments', ['code'], unique=False,
+                        postgresql_ops={'code':'varchar_pattern_ops'}, postgresql_concurrently=True)
+        op.create_index('ix_equipments_name_trgm', 'equipments', ['name'], unique=False,
+                        postgresql_using='gin', postgresql_ops={'name':'gin_trgm_ops'}, postgresql_concurrently=True)
+        op.create_index('ix_equipments_location_code', 'equipments', ['location', 'code'], unique=False,
+                        postgresql_concurrently=True)
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        op.drop_index('ix_equipments_location_code', table_name='equipments', postgresql_concurrently=True)
+        op.drop_index('ix_equipments_name_trgm', table_name='equipments', postgresql_concurrently=True)
+        op.drop_index('ix_equipments_code_pattern', table_name='equipments', postgresql_concurrently=True)
@@ -0,0 +1,30 @@
+"""equipments change version
+
+Revision ID: d8a3b6f0c152
+Revises: c5d91e3f4a27
+Create Date: 2026-10-17 15:21:47.662310
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd8a3b6f0c152'
+down_revision = 'c5d91e3f4a27'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('equipments', sa.Column('version', sa.BigInteger(), nullable=True))
+    # The rows written before the change feed existed all come in the first sync (since=0)
+    op.execute('UPDATE equipments SET version = 1')
+    with op.get_context().autocommit_block():
+        op.create_index('ix_equipments_version', 'equipments', ['version'], unique=False, postgresql_concurrently=True)
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        op.drop_index('ix_equipments_version', table_name='equipments', postgresql_concurrently=True)
+    op.drop_column('equipments', 'version')
@@ -0,0 +1,39 @@
+"""equipment counters
+
+Revision ID: e1f7a4c9b803
+Revises: d8a3b6f0c152
+Create Date: 2026-10-17 16:02:33.917254
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e1f7a4c9b803'
+down_revision = 'd8a3b6f0c152'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('equipment_counters',
+    sa.Column('vessel_id', sa.BigInteger(), nullable=False),
+    sa.Column('location', sa.String(length=256), nullable=False),
+    sa.Column('active_count', sa.BigInteger(), nullable=False),
+    sa.Column('inactive_count', sa.BigInteger(), nullable=False),
+    sa.ForeignKeyConstraint(['vessel_id'], ['vessels.id'], ),
+    sa.PrimaryKeyConstraint('vessel_id', 'location')
+    )
+    # Start the counters from the equipments already in the system
+    op.execute("""
+        INSERT INTO equipment_counters (vessel_id, location, active_count, inactive_count)
+        SELECT vessel_id, location, SUM(CASE WHEN active THEN 1 ELSE 0 END), SUM(CASE WHEN active THEN 0 ELSE 1 END)
+        FROM equipments
+        WHERE vessel_id IS NOT NULL AND location IS NOT NULL
+        GROUP BY vessel_id, location
+    """)
+
+
+def downgrade():
+    op.drop_table('equipment_counters')
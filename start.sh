@@ -26,13 +26,13 @@ fi
 export FLASK_APP="manage.py"
 export FLASK_DEBUG=1
 
-echo db init
-flask db init
-echo db migrate
-flask db migrate
 echo db upgrade
 flask db upgrade
 
+if [[ "$SERVER_MODE" == "production" ]]; then
+  exec gunicorn -c gunicorn.conf.py wsgi:app
+fi
+
 pytest -v
 
 flask run -h 0.0.0.0 -p 5000
@@ -0,0 +1,208 @@
+import pytest
+from flask_migrate import Migrate
+from starlette.testclient import TestClient
+
+import sys
+import os
+sys.path.append(os.path.join(os.path.dirname(__file__),'../'))
+
+from apis.app import create_app
+from apis.asgi import async_database_url, create_asgi_app
+from apis.models.model import db
+from apis.models.vessel import vessel
+from apis.models.equipment import equipment
+from apis.models.equipment_status_event import equipment_status_event
+from apis.fleet_stats import check_counters
+from apis.load_control import create_rate_limiter
+from apis.idempotency import create_idempotency_store
+
+
+@pytest.fixture(scope="module")
+def app():
+    app = create_app(test_config=True)
+    
+    with app.app_context():
+        db.create_all()
+        Migrate(app, db)
+        db.session.add(vessel(code='MV102'))
+        db.session.commit()
+
+    yield app
+
+    with app.app_context():
+        db.session.remove()
+        db.drop_all()
+
+@pytest.fixture(scope="module")
+def client(app):
+    with TestClient(create_asgi_app(test_config=True)) as client:
+        yield client
+
+def test_async_database_url():
+    assert async_database_url('postgresql://postgres:postgres@db:5432/vessels_db') == 'postgresql+asyncpg://postgres:postgres@db:5432/vessels_db'
+    assert async_database_url('sqlite:////tmp/vessels.db') == 'sqlite+aiosqlite:////tmp/vessels.db'
+
+def test_heath_check(client):
+    result = client.get('/')
+    assert result.status_code == 200
+
+def test_insert_vessel(client):
+    result = client.post('/vessel/insert_vessel', json={'code':'MV101'})
+    assert result.json().get('message') == 'OK'
+    assert result.status_code == 201
+
+def test_insert_vessel_replicated(client):
+    result = client.post('/vessel/insert_vessel', json={'code':'MV101'})
+    assert result.json().get('message') == 'FAIL'
+    assert result.status_code == 409
+
+def test_insert_vessel_wrong_format(client):
+    result = client.post('/vessel/insert_vessel', json={'code':1})
+    assert result.json().get('message') == 'WRONG_FORMAT'
+    assert result.status_code == 400
+
+def test_insert_equipment(app, client):
+    result = client.post('/equipment/insert_equipment', json={'vessel_code':'MV101', 'code':'5310B9D7', 'location':'brazil', 'name':'compressor'})
+    assert result.json().get('message') == 'OK'
+    assert result.status_code == 201
+    with app.app_context():
+        query = db.session.query(equipment)
+        query_results = db.session.execute(query).all()
+        assert len(query_results) == 1
+        assert query_results[0][0].vessel_id == 2
+        assert query_results[0][0].active
+
+def test_insert_equipment_replicated(client):
+    result = client.post('/equipment/insert_equipment', json={'vessel_code':'MV102', 'code':'5310B9D7', 'location':'brazil', 'name':'compressor'})
+    assert result.json().get('message') == 'REPEATED_CODE'
+    assert result.status_code == 409
+
+def test_insert_equipment_no_vessel(client):
+    result = client.post('/equipment/insert_equipment', json={'vessel_code':'MV109', 'code':'5310B9D8', 'location':'brazil', 'name':'compressor'})
+    assert result.json().get('message') == 'NO_VESSEL'
+    assert result.status_code == 409
+
+def test_insert_equipment_missing_parameter(client):
+    result = client.post('/equipment/insert_equipment', json={'vessel_code':'MV101', 'code':'5310B9D8', 'name':'compressor'})
+    assert result.json().get('message') == 'MISSING_PARAMETER'
+    assert result.status_code == 400
+
+def test_active_equipments(client):
+    client.post('/equipment/insert_equipment', json={'vessel_code':'MV101', 'code':'5310B9D8', 'location':'usa', 'name':'motor'})
+    result = client.get('/equipment/active_equipments?vessel_code=MV101')
+    assert result.status_code == 200
+    assert result.json().get('equipments') == [{'code':'5310B9D7', 'name':'compressor', 'location':'brazil'},
+                                               {'code':'5310B9D8', 'name':'motor', 'location':'usa'}]
+
+def test_active_equipments_paginated(client):
+    result = client.get('/equipment/active_equipments?vessel_code=MV101&limit=1')
+    assert [item.get('code') for item in result.json().get('equipments')] == ['5310B9D7']
+    assert result.json().get('next_after_code') == '5310B9D7'
+
+def test_active_equipments_streamed(client):
+    result = client.get('/equipment/active_equipments?vessel_code=MV101&stream=true')
+    assert [item.get('code') for item in result.json().get('equipments')] == ['5310B9D7', '5310B9D8']
+
+def test_active_equipments_no_vessel(client):
+    result = client.get('/equipment/active_equipments?vessel_code=MV105')
+    assert result.json().get('message') == 'NO_VESSEL'
+    assert result.status_code == 409
+
+def test_update_equipment_status(client):
+    result = client.put('/equipment/update_equipment_status', json={'code':['5310B9D7', '5312B9D5']})
+    assert result.json().get('message') == 'OK'
+    assert result.status_code == 201
+    assert result.json().get('deactivated') == ['5310B9D7']
+    assert result.json().get('unknown') == ['5312B9D5']
+    result = client.get('/equipment/active_equipments?vessel_code=MV101')
+    assert [item.get('code') for item in result.json().get('equipments')] == ['5310B9D8']
+
+def test_update_equipment_status_no_code(client):
+    result = client.put('/equipment/update_equipment_status', json={'code':'5312B9D5'})
+    assert result.json().get('message') == 'NO_CODE'
+    assert result.status_code == 409
+
+def test_active_equipments_columnar(client):
+    result = client.get('/equipment/active_equipments?vessel_code=MV101', headers={'Accept':'application/vnd.vessels.columnar+json'})
+    assert result.headers.get('content-type').startswith('application/vnd.vessels.columnar+json')
+    assert result.json().get('equipments').get('code') == ['5310B9D8']
+
+def test_writes_keep_counters_and_history(app, client):
+    with app.app_context():
+        assert check_counters() == []
+        events = db.session.query(equipment_status_event.code, equipment_status_event.active) \
+            .order_by(equipment_status_event.id).all()
+        assert [tuple(event) for event in events] == [('5310B9D7', True), ('5310B9D8', True), ('5310B9D7', False)]
+
+def test_rate_limited(client):
+    client.app.state.rate_limiter = create_rate_limiter({'RATE_LIMIT_BACKEND':'memory',
+                                                          'RATE_LIMITS':{'equipments.active_equipment':(0.001, 1)}})
+    try:
+        assert client.get('/equipment/active_equipments?vessel_code=MV101').status_code == 200
+        result = client.get('/equipment/active_equipments?vessel_code=MV101')
+    finally:
+        client.app.state.rate_limiter = None
+    assert result.json().get('message') == 'RATE_LIMITED'
+    assert result.status_code == 429
+    assert int(result.headers.get('Retry-After')) > 0
+
+def test_idempotency_key_replayed(client):
+    headers = {'Idempotency-Key':'asgi-vessel-1'}
+    first = client.post('/vessel/insert_vessel', json={'code':'MV103'}, headers=headers)
+    assert first.status_code == 201
+    retry = client.post('/vessel/insert_vessel', json={'code':'MV103'}, headers=headers)
+    assert retry.status_code == 201
+    assert retry.headers.get('Idempotent-Replayed') == 'true'
+    reused = client.post('/vessel/insert_vessel', json={'code':'MV104'}, headers=headers)
+    assert reused.json().get('message') == 'IDEMPOTENCY_KEY_REUSED'
+    assert reused.status_code == 422
+
+def test_idempotency_key_replayed_from_database(client):
+    headers = {'Idempotency-Key':'asgi-equipment-1'}
+    body = {'vessel_code':'MV103', 'code':'5310B9E1', 'name':'compressor', 'location':'brazil'}
+    assert client.post('/equipment/insert_equipment', json=body, headers=headers).status_code == 201
+    # Another worker only finds the stored response in the idempotency_keys table
+    client.app.state.idempotency_store = create_idempotency_store({})
+    retry = client.post('/equipment/insert_equipment', json=body, headers=headers)
+    assert retry.json().get('message') == 'OK'
+    assert retry.status_code == 201
+    assert retry.headers.get('Idempotent-Replayed') == 'true'
+    assert client.post('/equipment/insert_equipment', json=body).json().get('message') == 'REPEATED_CODE'
+
+def test_bulk_insert_vessel(client):
+    result = client.post('/vessel/bulk_insert', json=['MV130', 'MV102', 'MV130', 1])
+    assert result.status_code == 201
+    assert result.json().get('created') == ['MV130']
+    assert result.json().get('existing') == ['MV102']
+    assert [item.get('message') for item in result.json().get('results')] == ['OK', 'FAIL', 'FAIL', 'WRONG_FORMAT']
+
+def test_bulk_insert_vessel_missing_parameter(client):
+    result = client.post('/vessel/bulk_insert', json={'code':[]})
+    assert result.json().get('message') == 'MISSING_PARAMETER'
+    assert result.status_code == 400
+
+def test_bulk_insert_equipment(app, client):
+    result = client.post('/equipment/bulk_insert', json={'equipments':[
+        {'vessel_code':'MV130', 'code':'5310C001', 'name':'compressor', 'location':'brazil'},
+        {'vessel_code':'MV130', 'code':'5310C001', 'name':'compressor', 'location':'brazil'},
+        {'vessel_code':'MV139', 'code':'5310C002', 'name':'compressor', 'location':'brazil'},
+        {'vessel_code':'MV130', 'code':'5310C003', 'name':'compressor'}]})
+    assert result.status_code == 201
+    assert result.json().get('inserted') == 1
+    assert [item.get('message') for item in result.json().get('results')] == ['OK', 'REPEATED_CODE', 'NO_VESSEL',
+                                                                              'MISSING_PARAMETER']
+    result = client.get('/equipment/active_equipments?vessel_code=MV130')
+    assert [item.get('code') for item in result.json().get('equipments')] == ['5310C001']
+    with app.app_context():
+        assert check_counters() == []
+
+def test_bulk_insert_equipment_ndjson(client):
+    body = '{"vessel_code":"MV130","code":"5310C004","name":"motor","location":"usa"}\nnot json\n'
+    result = client.post('/equipment/bulk_insert', data=body, headers={'Content-Type':'application/x-ndjson'})
+    assert result.status_code == 201
+    assert [item.get('message') for item in result.json().get('results')] == ['OK', 'WRONG_FORMAT']
+
+def test_bulk_insert_equipment_wrong_format(client):
+    result = client.post('/equipment/bulk_insert', json={'equipments':'5310C005'})
+    assert result.json().get('message') == 'WRONG_FORMAT'
+    assert result.status_code == 400
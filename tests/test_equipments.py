@@ -3,15 +3,20 @@ from flask_migrate import Migrate
 
 import sys
 import os
+import gzip
+import json
 sys.path.append(os.path.join(os.path.dirname(__file__),'../'))
 
 from apis.app import create_app
 from apis.models.model import db
 from apis.models.vessel import vessel
 from apis.models.equipment import equipment
-from sqlalchemy import func, or_
+from apis.operations import insert_equipments
+from sqlalchemy import event, func, or_
 
 
+ADMIN = {'X-Admin-Key':'test-admin-key'}
+
 @pytest.fixture(scope="module")
 def app():
     app = create_app(test_config=True)
@@ -258,3 +263,297 @@ def test_get_list_no_active_equipment_vessel(app):
     assert len(result.get_json().get('equipments')) == 0
     assert result.status_code == 200
 
+def test_bulk_insert(app):
+    equipments = [{'vessel_code':'MV101', 'code':'5310C001', 'location':'brazil', 'name':'pump'},
+                  {'vessel_code':'MV109', 'code':'5310C002', 'location':'brazil', 'name':'pump'},
+                  {'vessel_code':'MV101', 'code':'5310B9D7', 'location':'brazil', 'name':'pump'},
+                  {'vessel_code':'MV101', 'code':'5310C001', 'location':'chile', 'name':'valve'},
+                  {'vessel_code':'MV101', 'code':1, 'location':'brazil', 'name':'pump'},
+                  {'vessel_code':'MV101', 'location':'brazil', 'name':'pump'},
+                  {'vessel_code':'MV103', 'code':'5310C003', 'location':'peru', 'name':'valve'}]
+    result = app.test_client().post('/equipment/bulk_insert', json=equipments)
+    assert result.status_code == 201
+    assert result.get_json().get('inserted') == 2
+    messages = [item.get('message') for item in result.get_json().get('results')]
+    assert messages == ['OK', 'NO_VESSEL', 'REPEATED_CODE', 'REPEATED_CODE', 'WRONG_FORMAT', 'MISSING_PARAMETER', 'OK']
+    with app.app_context():
+        query = db.session.query(equipment).filter(or_(equipment.code=='5310C001', equipment.code=='5310C003')).order_by(equipment.code)
+        query_results = db.session.execute(query).all()
+        assert len(query_results) == 2
+        assert query_results[0][0].vessel_id == 2
+        assert query_results[0][0].location == 'brazil'
+        assert query_results[0][0].active
+        assert query_results[1][0].vessel_id == 3
+        assert query_results[1][0].name == 'valve'
+
+def test_bulk_insert_ndjson(app):
+    body = '{"vessel_code":"MV102", "code":"5310C004", "location":"usa", "name":"motor"}\n' \
+           'not json\n' \
+           '{"vessel_code":"MV102", "code":"5310C001", "location":"usa", "name":"motor"}\n'
+    result = app.test_client().post('/equipment/bulk_insert', data=body, content_type='application/x-ndjson')
+    assert result.status_code == 201
+    messages = [item.get('message') for item in result.get_json().get('results')]
+    assert messages == ['OK', 'WRONG_FORMAT', 'REPEATED_CODE']
+    with app.app_context():
+        query = db.session.query(equipment).filter(equipment.code=='5310C004')
+        query_results = db.session.execute(query).all()
+        assert query_results[0][0].vessel_id == 1
+
+def test_bulk_insert_wrong_format(app):
+    result = app.test_client().post('/equipment/bulk_insert', json={'code':'5310C005'})
+    assert result.get_json().get('message') == 'WRONG_FORMAT'
+    assert result.status_code == 400
+
+def test_bulk_insert_concurrent_inserts(app):
+    assert app.test_client().post('/vessel/insert_vessel', json={'code':'MV120'}).status_code == 201
+    with app.app_context():
+        vessel_id = db.session.query(vessel.id).filter(vessel.code=='MV120').scalar()
+    concurrent = ['5310F001', '5310F002']
+
+    def insert_concurrently(conn, cursor, statement, parameters, context, executemany):
+        # Other requests insert one of the codes right before each insert of the chunk
+        if concurrent and statement.startswith('INSERT INTO equipments ') and not conn.info.get('concurrent'):
+            code = concurrent.pop(0)
+            with db.engine.begin() as connection:
+                connection.info['concurrent'] = True
+                insert_equipments(connection, [{'vessel_id':vessel_id, 'code':code, 'name':'pump', 'location':'peru', 'active':True}])
+                connection.info.pop('concurrent')
+
+    equipments = [{'vessel_code':'MV120', 'code':code, 'location':'brazil', 'name':'pump'}
+                  for code in ('5310F001', '5310F002', '5310F003')]
+    with app.app_context():
+        event.listen(db.engine, 'before_cursor_execute', insert_concurrently)
+        try:
+            result = app.test_client().post('/equipment/bulk_insert', json=equipments)
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', insert_concurrently)
+    assert result.status_code == 201
+    assert [item.get('message') for item in result.get_json().get('results')] == ['REPEATED_CODE', 'REPEATED_CODE', 'OK']
+
+def test_bulk_insert_empty(app):
+    result = app.test_client().post('/equipment/bulk_insert', json=[])
+    assert result.get_json().get('message') == 'MISSING_PARAMETER'
+    assert result.status_code == 400
+
+def test_get_list_of_active_equipment_paginated(app):
+    result = app.test_client().get('/equipment/active_equipments?vessel_code=MV103&limit=2')
+    assert result.status_code == 200
+    assert [item.get('code') for item in result.get_json().get('equipments')] == ['5310B9D1', '5310B9D2']
+    assert result.get_json().get('next_after_code') == '5310B9D2'
+    result = app.test_client().get('/equipment/active_equipments?vessel_code=MV103&limit=2&after_code=5310B9D2')
+    assert result.status_code == 200
+    assert [item.get('code') for item in result.get_json().get('equipments')] == ['5310C003']
+    assert result.get_json().get('next_after_code') is None
+
+def test_get_list_of_active_equipment_wrong_limit(app):
+    result = app.test_client().get('/equipment/active_equipments?vessel_code=MV103&limit=two')
+    assert result.get_json().get('message') == 'WRONG_FORMAT'
+    assert result.status_code == 400
+    # A digit for str.isdigit that int() does not parse
+    result = app.test_client().get('/equipment/active_equipments', query_string={'vessel_code':'MV103', 'limit':'²'})
+    assert result.get_json().get('message') == 'WRONG_FORMAT'
+    assert result.status_code == 400
+
+def test_get_list_of_active_equipment_streamed(app):
+    result = app.test_client().get('/equipment/active_equipments?vessel_code=MV103&stream=true')
+    assert result.status_code == 200
+    equipments = result.get_json().get('equipments')
+    assert [item.get('code') for item in equipments] == ['5310B9D1', '5310B9D2', '5310C003']
+    assert equipments[2].get('name') == 'valve'
+    assert equipments[2].get('location') == 'peru'
+
+def test_get_list_of_active_equipment_streamed_empty(app):
+    result = app.test_client().get('/equipment/active_equipments?vessel_code=MV102&stream=true&after_code=5310C004')
+    assert result.status_code == 200
+    assert result.get_json().get('equipments') == []
+
+def test_update_reports_each_code(app):
+    result = app.test_client().put('/equipment/update_equipment_status', json={'code':['5310C003', '5310B9D7', '5312B9D5', '5310C003']})
+    assert result.get_json().get('message') == 'OK'
+    assert result.status_code == 201
+    assert result.get_json().get('deactivated') == ['5310C003']
+    assert result.get_json().get('already_inactive') == ['5310B9D7']
+    assert result.get_json().get('unknown') == ['5312B9D5']
+    with app.app_context():
+        query = db.session.query(equipment).filter(equipment.code=='5310C003')
+        query_results = db.session.execute(query).all()
+        assert not query_results[0][0].active
+
+def test_update_an_list_with_wrong_format(app):
+    result = app.test_client().put('/equipment/update_equipment_status', json={'code':['5310B9D1', 1]})
+    assert result.get_json().get('message') == 'WRONG_FORMAT'
+    assert result.status_code == 400
+    with app.app_context():
+        query = db.session.query(equipment).filter(equipment.code=='5310B9D1')
+        query_results = db.session.execute(query).all()
+        assert query_results[0][0].active
+
+
+def test_get_list_of_active_equipment_columnar(app):
+    result = app.test_client().get('/equipment/active_equipments?vessel_code=MV103',
+                                   headers={'Accept':'application/vnd.vessels.columnar+json'})
+    assert result.status_code == 200
+    assert result.mimetype == 'application/vnd.vessels.columnar+json'
+    assert json.loads(result.data) == {'equipments':{'code':['5310B9D1', '5310B9D2'], 'name':['compressor', 'motor'],
+                                                     'location':['brazil', 'china']}}
+
+def test_get_list_of_active_equipment_msgpack_paginated(app):
+    msgpack = pytest.importorskip('msgpack')
+    result = app.test_client().get('/equipment/active_equipments?vessel_code=MV103&limit=1',
+                                   headers={'Accept':'application/x-msgpack'})
+    assert result.status_code == 200
+    assert result.mimetype == 'application/msgpack'
+    assert msgpack.unpackb(result.data) == {'equipments':[{'code':'5310B9D1', 'name':'compressor', 'location':'brazil'}],
+                                            'next_after_code':'5310B9D1'}
+
+def test_get_list_of_active_equipment_unknown_accept(app):
+    result = app.test_client().get('/equipment/active_equipments?vessel_code=MV103', headers={'Accept':'text/html'})
+    assert result.status_code == 200
+    assert [item.get('code') for item in result.get_json().get('equipments')] == ['5310B9D1', '5310B9D2']
+
+def test_get_list_of_active_equipment_compressed(app):
+    app.config['COMPRESSION_MIN_SIZE'] = 0
+    try:
+        result = app.test_client().get('/equipment/active_equipments?vessel_code=MV103', headers={'Accept-Encoding':'gzip'})
+        uncompressed = app.test_client().get('/equipment/active_equipments?vessel_code=MV103')
+    finally:
+        app.config['COMPRESSION_MIN_SIZE'] = 1024
+    assert result.status_code == 200
+    assert result.headers.get('Content-Encoding') == 'gzip'
+    assert 'Accept-Encoding' in result.headers.get('Vary')
+    assert json.loads(gzip.decompress(result.data)) == uncompressed.get_json()
+    assert uncompressed.headers.get('Content-Encoding') is None
+
+def test_get_list_of_active_equipment_small_not_compressed(app):
+    result = app.test_client().get('/equipment/active_equipments?vessel_code=MV103', headers={'Accept-Encoding':'gzip, br'})
+    assert result.status_code == 200
+    assert result.headers.get('Content-Encoding') is None
+
+def test_search_by_name(app):
+    result = app.test_client().get('/equipment/search?name=compress')
+    assert result.status_code == 200
+    assert [item.get('code') for item in result.get_json().get('equipments')] == ['5310B9D1', '5310B9D7', '5310B9D9']
+    assert result.get_json().get('next_after_code') is None
+
+def test_search_by_name_prefix(app):
+    result = app.test_client().get('/equipment/search?name_prefix=MO')
+    assert [item.get('code') for item in result.get_json().get('equipments')] == ['5310B9D2', '5310C004']
+
+def test_search_escapes_wildcards(app):
+    result = app.test_client().get('/equipment/search?name=_')
+    assert [item.get('name') for item in result.get_json().get('equipments')] == ['electric_panel']
+
+def test_search_by_vessels_and_active(app):
+    result = app.test_client().get('/equipment/search?vessel_code=MV101,MV103&active=true')
+    assert [item.get('code') for item in result.get_json().get('equipments')] == ['5310B9D1', '5310B9D2', '5310C001']
+    result = app.test_client().get('/equipment/search?vessel_code=MV101&vessel_code=MV103&active=false')
+    assert [item.get('code') for item in result.get_json().get('equipments')] == ['5310B9D9', '5310C003']
+
+def test_search_by_code_prefix_and_location(app):
+    result = app.test_client().get('/equipment/search?code_prefix=5310C&location=usa')
+    assert result.get_json().get('equipments') == [{'vessel_code':'MV102', 'code':'5310C004', 'name':'motor',
+                                                    'location':'usa', 'active':True}]
+
+def test_search_paginated(app):
+    result = app.test_client().get('/equipment/search?code_prefix=5310B9D&limit=2')
+    assert [item.get('code') for item in result.get_json().get('equipments')] == ['5310B9D1', '5310B9D2']
+    assert result.get_json().get('next_after_code') == '5310B9D2'
+    result = app.test_client().get('/equipment/search?code_prefix=5310B9D&limit=2&after_code=5310B9D2')
+    assert [item.get('code') for item in result.get_json().get('equipments')] == ['5310B9D7', '5310B9D8']
+
+def test_search_wrong_format(app):
+    for query in ('active=maybe', 'limit=5000', 'limit=0', 'limit=%C2%B2', 'code_prefix=5310B9D10'):
+        result = app.test_client().get('/equipment/search?' + query)
+        assert result.get_json().get('message') == 'WRONG_FORMAT'
+        assert result.status_code == 400
+
+def test_search_no_vessel_in_system(app):
+    result = app.test_client().get('/equipment/search?vessel_code=MV109')
+    assert result.get_json().get('message') == 'NO_VESSEL'
+    assert result.status_code == 409
+
+def test_changes_since_start(app):
+    result = app.test_client().get('/equipment/changes')
+    assert result.status_code == 200
+    changes = result.get_json().get('changes')
+    with app.app_context():
+        assert len(changes) == db.session.query(equipment).count()
+    versions = [item.get('version') for item in changes]
+    assert versions == sorted(versions)
+    assert result.get_json().get('next_since') == max(versions)
+
+def test_changes_after_insert_and_update(app):
+    since = app.test_client().get('/equipment/changes').get_json().get('next_since')
+    assert app.test_client().get(f'/equipment/changes?since={since}').get_json().get('changes') == []
+
+    app.test_client().post('/equipment/insert_equipment', json={'vessel_code':'MV101', 'code':'5310E001', 'location':'chile', 'name':'crane'})
+    app.test_client().put('/equipment/update_equipment_status', json={'code':'5310B9D2'})
+    result = app.test_client().get(f'/equipment/changes?since={since}')
+    changes = result.get_json().get('changes')
+    assert [(item.get('code'), item.get('active')) for item in changes] == [('5310E001', True), ('5310B9D2', False)]
+    assert changes[0].get('vessel_code') == 'MV101'
+    assert result.get_json().get('next_since') == changes[-1].get('version')
+
+def test_changes_wrong_format(app):
+    for since in ('-1', '²'):
+        result = app.test_client().get('/equipment/changes', query_string={'since':since})
+        assert result.get_json().get('message') == 'WRONG_FORMAT'
+        assert result.status_code == 400
+
+def test_statistics_maintenance_requires_admin_key(app):
+    result = app.test_client().get('/equipment/statistics/check')
+    assert result.get_json().get('message') == 'FORBIDDEN'
+    assert result.status_code == 403
+    result = app.test_client().put('/equipment/statistics/rebuild', headers={'X-Admin-Key':'wrong'})
+    assert result.get_json().get('message') == 'FORBIDDEN'
+    assert result.status_code == 403
+
+def test_statistics_check_reports_drift(app):
+    # The tests above insert equipments directly in the table, without the counters
+    result = app.test_client().get('/equipment/statistics/check', headers=ADMIN)
+    assert result.status_code == 200
+    assert len(result.get_json().get('drift')) > 0
+
+def test_statistics_rebuild(app):
+    result = app.test_client().put('/equipment/statistics/rebuild', headers=ADMIN)
+    assert result.get_json().get('message') == 'OK'
+    assert result.status_code == 200
+    assert app.test_client().get('/equipment/statistics/check', headers=ADMIN).get_json().get('drift') == []
+
+def test_statistics_counts(app):
+    result = app.test_client().get('/equipment/statistics')
+    assert result.status_code == 200
+    with app.app_context():
+        active = db.session.query(equipment).filter(equipment.active==True).count()
+        inactive = db.session.query(equipment).filter(equipment.active==False).count()
+        mv101_active = db.session.query(equipment).filter(equipment.vessel_id==2, equipment.active==True).count()
+    assert result.get_json().get('total') == {'active':active, 'inactive':inactive}
+    vessels = {item.get('vessel_code'):item for item in result.get_json().get('vessels')}
+    assert vessels['MV101'].get('active') == mv101_active
+    assert sum(item.get('active') for item in result.get_json().get('locations')) == active
+
+def test_statistics_maintained_by_writes(app):
+    before = app.test_client().get('/equipment/statistics?vessel_code=MV102').get_json()
+    app.test_client().post('/equipment/insert_equipment', json={'vessel_code':'MV102', 'code':'5310E002', 'location':'chile', 'name':'winch'})
+    app.test_client().post('/equipment/bulk_insert', json=[{'vessel_code':'MV102', 'code':'5310E003', 'location':'chile', 'name':'radar'}])
+    app.test_client().put('/equipment/update_equipment_status', json={'code':['5310E002', '5310C004']})
+    result = app.test_client().get('/equipment/statistics?vessel_code=MV102').get_json()
+    assert result.get('vessels')[0].get('active') == before.get('vessels')[0].get('active')
+    assert result.get('vessels')[0].get('inactive') == before.get('vessels')[0].get('inactive') + 2
+    assert {'location':'chile', 'active':1, 'inactive':1} in result.get('locations')
+    assert app.test_client().get('/equipment/statistics/check', headers=ADMIN).get_json().get('drift') == []
+
+def test_statistics_no_vessel_in_system(app):
+    result = app.test_client().get('/equipment/statistics?vessel_code=MV109')
+    assert result.get_json().get('message') == 'NO_VESSEL'
+    assert result.status_code == 409
+
+def test_check_statistics_command(app):
+    with app.app_context():
+        db.session.add(equipment(vessel_id=1, code='5310E004', location='chile', name='crane', active=True))
+        db.session.commit()
+    result = app.test_cli_runner().invoke(args=['check-statistics'])
+    assert '1 counters drifted' in result.output
+    result = app.test_cli_runner().invoke(args=['check-statistics', '--repair'])
+    assert 'rebuilt' in result.output
+    assert app.test_client().get('/equipment/statistics/check', headers=ADMIN).get_json().get('drift') == []
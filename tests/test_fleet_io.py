@@ -0,0 +1,120 @@
+import pytest
+from flask_migrate import Migrate
+
+import sys
+import os
+sys.path.append(os.path.join(os.path.dirname(__file__),'../'))
+
+pandas = pytest.importorskip('pandas')
+
+from apis.app import create_app
+from apis.models.model import db
+from apis.models.vessel import vessel
+from apis.models.equipment import equipment
+from apis.models.equipment_status_event import equipment_status_event
+from apis.fleet_io import export_snapshot_command, import_equipments_command, import_vessels_command
+
+
+@pytest.fixture(scope="module")
+def app():
+    app = create_app(test_config=True)
+
+    with app.app_context():
+        db.create_all()
+        Migrate(app, db)
+
+    yield app
+
+    with app.app_context():
+        db.session.remove()
+        db.drop_all()
+
+def test_import_vessels(app, tmp_path):
+    path = tmp_path / 'vessels.csv'
+    path.write_text('code\nMV101\nMV102\nMV101\nMV102TOOLONG\n')
+    result = app.test_cli_runner().invoke(import_vessels_command, [str(path)])
+    assert result.exit_code == 0
+    assert 'read 4, rejected 1, inserted 2' in result.output
+    with app.app_context():
+        assert sorted(row[0] for row in db.session.query(vessel.code).all()) == ['MV101', 'MV102']
+
+def test_import_vessels_again(app, tmp_path):
+    path = tmp_path / 'vessels.csv'
+    path.write_text('code\nMV101\nMV103\n')
+    result = app.test_cli_runner().invoke(import_vessels_command, [str(path)])
+    assert 'read 2, rejected 0, inserted 1' in result.output
+
+def test_import_equipments_csv(app, tmp_path):
+    path = tmp_path / 'equipments.csv'
+    rejects = tmp_path / 'rejects.csv'
+    path.write_text('vessel_code,code,name,location,active\n'
+                    'MV101,5310B9D1,compressor,brazil,true\n'
+                    'MV101,5310B9D2,motor,brazil,false\n'
+                    'MV102,5310B9D3,valve,peru,1\n'
+                    'MV109,5310B9D4,pump,chile,true\n'
+                    'MV102,5310B9D30,valve,peru,true\n'
+                    'MV102,5310B9D3,valve,peru,true\n'
+                    'MV102,5310B9D5,,peru,true\n'
+                    'MV102,5310B9D6,winch,peru,maybe\n')
+    result = app.test_cli_runner().invoke(import_equipments_command, [str(path), '--chunk-size', '3', '--rejects', str(rejects)])
+    assert result.exit_code == 0
+    assert 'read 8, rejected 3, no_vessel 1, repeated_code 1, inserted 3' in result.output
+
+    rejected = pandas.read_csv(rejects, dtype=str)
+    assert rejected['row'].tolist() == ['5', '7', '8']
+    assert rejected['message'].tolist() == ['WRONG_FORMAT code', 'WRONG_FORMAT name', 'WRONG_FORMAT active']
+    with app.app_context():
+        rows = db.session.query(equipment.code, equipment.active).order_by(equipment.code).all()
+        assert [tuple(row) for row in rows] == [('5310B9D1', True), ('5310B9D2', False), ('5310B9D3', True)]
+
+def test_import_records_status_events(app):
+    with app.app_context():
+        rows = db.session.query(equipment_status_event.code, equipment_status_event.active,
+                                equipment_status_event.previous_active).order_by(equipment_status_event.code).all()
+        assert [tuple(row) for row in rows] == [('5310B9D1', True, None), ('5310B9D2', False, None), ('5310B9D3', True, None)]
+
+def test_import_keeps_statistics(app):
+    result = app.test_client().get('/equipment/statistics')
+    assert result.get_json().get('total') == {'active':2, 'inactive':1}
+    assert app.test_client().get('/equipment/statistics/check', headers={'X-Admin-Key':'test-admin-key'}).get_json().get('drift') == []
+
+def test_import_equipments_parquet(app, tmp_path):
+    pytest.importorskip('pyarrow')
+    path = tmp_path / 'equipments.parquet'
+    pandas.DataFrame({'vessel_code':['MV103', 'MV103'], 'code':['5310C001', '5310B9D1'], 'name':['crane', 'crane'],
+                      'location':['usa', 'usa']}).to_parquet(path)
+    result = app.test_cli_runner().invoke(import_equipments_command, [str(path)])
+    assert result.exit_code == 0
+    assert 'inserted 1' in result.output
+    result = app.test_client().get('/equipment/active_equipments?vessel_code=MV103')
+    assert [item.get('code') for item in result.get_json().get('equipments')] == ['5310C001']
+
+def test_import_missing_columns(app, tmp_path):
+    path = tmp_path / 'equipments.csv'
+    path.write_text('vessel_code,code\nMV101,5310C002\n')
+    result = app.test_cli_runner().invoke(import_equipments_command, [str(path)])
+    assert result.exit_code != 0
+    assert 'missing columns: name, location' in result.output
+
+def test_export_snapshot_csv(app, tmp_path):
+    path = tmp_path / 'snapshot.csv'
+    result = app.test_cli_runner().invoke(export_snapshot_command, [str(path), '--chunk-size', '2'])
+    assert '4 equipments exported' in result.output
+    since = int(result.output.rsplit('since=', 1)[1])
+    # The mirror resumes where /equipment/changes would end now
+    assert since == app.test_client().get('/equipment/changes').get_json().get('next_since')
+    snapshot = pandas.read_csv(path, dtype=str)
+    assert snapshot.columns.tolist() == ['vessel_code', 'code', 'name', 'location', 'active', 'version']
+    assert sorted(snapshot['code']) == ['5310B9D1', '5310B9D2', '5310B9D3', '5310C001']
+
+def test_export_snapshot_parquet_active_only(app, tmp_path):
+    pyarrow = pytest.importorskip('pyarrow')
+    import pyarrow.parquet
+    path = tmp_path / 'snapshot.parquet'
+    result = app.test_cli_runner().invoke(export_snapshot_command, [str(path), '--active-only'])
+    assert '3 equipments exported' in result.output
+    snapshot = pandas.read_parquet(path)
+    assert sorted(snapshot['code']) == ['5310B9D1', '5310B9D3', '5310C001']
+    assert snapshot['active'].all()
+    metadata = pyarrow.parquet.read_schema(path).metadata
+    assert int(metadata[b'next_since']) == int(result.output.rsplit('since=', 1)[1])
@@ -28,3 +28,68 @@ def test_heath_check(app):
     result = app.test_client().get('/')
     assert result.status_code == 200
 
+
+def test_cache_stats(app):
+    app.test_client().get('/equipment/active_equipments?vessel_code=MV101')
+    app.test_client().get('/equipment/active_equipments?vessel_code=MV101')
+    result = app.test_client().get('/cache_stats')
+    assert result.status_code == 200
+    stats = result.get_json().get('vessel_cache')
+    assert stats.get('misses') == 1
+    assert stats.get('hits') == 1
+    assert stats.get('evictions') == 0
+
+def test_lazy_swagger(monkeypatch):
+    import config
+    monkeypatch.setattr(config.TestConfig, 'LAZY_SWAGGER', True, raising=False)
+    lazy_app = create_app(test_config=True)
+    result = lazy_app.test_client().get('/apispec_1.json')
+    assert result.status_code == 200
+    assert '/equipment/insert_equipment' in result.get_json().get('paths')
+    result = lazy_app.test_client().get('/apidocs/')
+    assert result.status_code == 200
+
+def test_startup_timings(app):
+    timings = app.extensions['startup_timings']
+    assert set(timings) >= {'config', 'swagger', 'blueprints', 'database', 'vessel_cache'}
+
+def test_liveness(app):
+    result = app.test_client().get('/live')
+    assert result.status_code == 200
+    assert result.get_json().get('message') == 'OK'
+
+def test_readiness(app):
+    result = app.test_client().get('/ready')
+    assert result.status_code == 200
+    assert result.get_json().get('message') == 'OK'
+    primary = result.get_json().get('databases').get('primary')
+    assert primary.get('probe').get('ok') is True
+    assert primary.get('probe').get('latency_ms') >= 0
+    assert primary.get('pool').get('exhausted') is False
+    assert 'checked_out' in primary.get('pool')
+    # The tables are created after the app, there was nothing to warm the vessel cache with
+    assert result.get_json().get('caches').get('vessel_cache').get('warm') is False
+
+def test_readiness_probe_reused(app):
+    for _ in range(20):
+        app.test_client().get('/ready')
+    with app.app_context():
+        from apis.readiness import readiness_probes
+        assert readiness_probes().probe('primary').probes == 1
+
+def test_readiness_pool_exhausted(app, monkeypatch):
+    import apis.healthcheck
+    monkeypatch.setattr(apis.healthcheck, 'pool_status', lambda engine: {'exhausted':True})
+    result = app.test_client().get('/ready')
+    assert result.status_code == 503
+    assert result.get_json().get('message') == 'NOT_READY'
+
+def test_database_probe_failure(tmp_path):
+    from sqlalchemy import create_engine
+    from apis.readiness import DatabaseProbe
+    probe = DatabaseProbe(interval=0)
+    result = probe.check(create_engine(f'sqlite:///{tmp_path}/missing/vessels.db'))
+    assert result.get('ok') is False
+    assert result.get('error') == 'OperationalError'
+    assert result.get('last_success_seconds_ago') is None
+    assert probe.check(create_engine(f'sqlite:///{tmp_path}/vessels.db')).get('ok') is True
@@ -0,0 +1,104 @@
+import pytest
+from datetime import datetime, timedelta
+from flask_migrate import Migrate
+
+import sys
+import os
+sys.path.append(os.path.join(os.path.dirname(__file__),'../'))
+
+from apis.app import create_app
+from apis.models.model import db
+from apis.models.vessel import vessel
+from apis.models.equipment import equipment
+from apis.models.idempotency_key import idempotency_key
+from apis.idempotency import init_idempotency
+
+
+@pytest.fixture(scope="module")
+def app():
+    app = create_app(test_config=True)
+
+    with app.app_context():
+        db.create_all()
+        Migrate(app, db)
+
+    yield app
+
+    with app.app_context():
+        db.session.remove()
+        db.drop_all()
+
+def insert_vessel(app, code, key):
+    return app.test_client().post('/vessel/insert_vessel', json={'code':code}, headers={'Idempotency-Key':key})
+
+def insert_equipment(app, code, key):
+    return app.test_client().post('/equipment/insert_equipment', json={'vessel_code':'MV102', 'code':code, 'location':'brazil',
+                                                                       'name':'compressor'}, headers={'Idempotency-Key':key})
+
+def test_retry_gets_stored_response(app):
+    result = insert_vessel(app, 'MV102', 'key-1')
+    assert result.status_code == 201
+    assert 'Idempotent-Replayed' not in result.headers
+    result = insert_vessel(app, 'MV102', 'key-1')
+    assert result.status_code == 201
+    assert result.get_json().get('message') == 'OK'
+    assert result.headers.get('Idempotent-Replayed') == 'true'
+    with app.app_context():
+        assert db.session.query(vessel).filter(vessel.code=='MV102').count() == 1
+
+def test_new_key_runs_again(app):
+    result = insert_vessel(app, 'MV102', 'key-2')
+    assert result.get_json().get('message') == 'FAIL'
+    assert result.status_code == 409
+
+def test_key_reused_with_other_body(app):
+    result = insert_vessel(app, 'MV103', 'key-1')
+    assert result.get_json().get('message') == 'IDEMPOTENCY_KEY_REUSED'
+    assert result.status_code == 422
+
+def test_keys_scoped_by_endpoint(app):
+    result = insert_equipment(app, '5310B9D1', 'key-1')
+    assert result.get_json().get('message') == 'OK'
+    assert result.status_code == 201
+
+def test_retry_replayed_from_database(app):
+    # A retry reaching another worker only finds the response in the table
+    with app.app_context():
+        init_idempotency(app)
+    result = insert_equipment(app, '5310B9D1', 'key-1')
+    assert result.status_code == 201
+    assert result.headers.get('Idempotent-Replayed') == 'true'
+    with app.app_context():
+        assert db.session.query(equipment).filter(equipment.code=='5310B9D1').count() == 1
+        assert app.extensions['idempotency_store'].stats().get('replays') == 1
+
+def test_retry_while_running(app):
+    with app.app_context():
+        db.session.add(idempotency_key(key='equipments.insert_equipment:key-3', fingerprint='', created_at=datetime.utcnow(),
+                                       expires_at=datetime.utcnow() + timedelta(days=1)))
+        db.session.commit()
+    result = insert_equipment(app, '5310B9D2', 'key-3')
+    assert result.get_json().get('message') == 'IN_PROGRESS'
+    assert result.status_code == 409
+    assert result.headers.get('Retry-After') == '1'
+
+def test_lost_and_expired_keys_taken_over(app):
+    with app.app_context():
+        db.session.add(idempotency_key(key='equipments.insert_equipment:key-4', fingerprint='',
+                                       created_at=datetime.utcnow() - timedelta(hours=1),
+                                       expires_at=datetime.utcnow() + timedelta(days=1)))
+        db.session.add(idempotency_key(key='equipments.insert_equipment:key-5', fingerprint='', status_code=201, response='{}',
+                                       created_at=datetime.utcnow() - timedelta(days=2),
+                                       expires_at=datetime.utcnow() - timedelta(days=1)))
+        db.session.commit()
+    assert insert_equipment(app, '5310B9D4', 'key-4').status_code == 201
+    result = insert_equipment(app, '5310B9D5', 'key-5')
+    assert result.status_code == 201
+    assert 'Idempotent-Replayed' not in result.headers
+    with app.app_context():
+        assert db.session.query(equipment).filter(equipment.code.in_(['5310B9D4', '5310B9D5'])).count() == 2
+
+def test_invalid_key(app):
+    result = insert_vessel(app, 'MV104', 'k' * 256)
+    assert result.get_json().get('message') == 'WRONG_FORMAT'
+    assert result.status_code == 400
@@ -0,0 +1,121 @@
+import pytest
+import multiprocessing
+import time
+from flask_migrate import Migrate
+
+import sys
+import os
+sys.path.append(os.path.join(os.path.dirname(__file__),'../'))
+
+from apis.app import create_app
+from apis.models.model import db
+from apis.models.vessel import vessel
+from apis.load_control import LoadShedder, MemoryBuckets, SharedBuckets, init_load_control, load_shedder
+
+
+@pytest.fixture(scope="module")
+def app():
+    app = create_app(test_config=True)
+    app.config['RATE_LIMIT_BACKEND'] = 'memory'
+    app.config['RATE_LIMITS'] = {'equipments.active_equipment':(1.0, 3)}
+    app.config['RATE_LIMIT_DEFAULT'] = None
+    app.config['LOAD_SHED_MAX_IN_FLIGHT'] = 10
+    init_load_control(app)
+
+    with app.app_context():
+        db.create_all()
+        Migrate(app, db)
+        db.session.add(vessel(code='MV102'))
+        db.session.commit()
+
+    yield app
+
+    with app.app_context():
+        db.session.remove()
+        db.drop_all()
+
+def active_equipments(app, api_key):
+    return app.test_client().get('/equipment/active_equipments?vessel_code=MV102', headers={'X-API-Key':api_key})
+
+def test_client_limited_after_burst(app):
+    assert [active_equipments(app, 'looping').status_code for _ in range(3)] == [200, 200, 200]
+    result = active_equipments(app, 'looping')
+    assert result.status_code == 429
+    assert result.get_json().get('message') == 'RATE_LIMITED'
+    assert result.headers.get('Retry-After') == '1'
+
+def test_other_clients_and_routes_not_limited(app):
+    assert active_equipments(app, 'other').status_code == 200
+    assert app.test_client().get('/equipment/search?location=brazil', headers={'X-API-Key':'looping'}).status_code == 200
+    assert app.test_client().get('/ready', headers={'X-API-Key':'looping'}).status_code == 200
+
+def test_shed_when_too_many_in_flight(app):
+    with app.app_context():
+        shedder = load_shedder()
+    shedder.in_flight += 10
+    try:
+        result = active_equipments(app, 'shed')
+    finally:
+        shedder.in_flight -= 10
+    assert result.status_code == 503
+    assert result.get_json().get('message') == 'OVERLOADED'
+    assert result.headers.get('Retry-After') == '1'
+    assert shedder.stats().get('in_flight') == 0
+    assert active_equipments(app, 'shed').status_code == 200
+
+def test_counters_in_metrics(app):
+    result = app.test_client().get('/metrics').get_data(as_text=True)
+    assert 'rate_limited_total{endpoint="equipments.active_equipment"} 1' in result
+    assert 'load_shed_total{reason="in_flight"} 1' in result
+    assert 'in_flight_requests 0' in result
+
+def test_bucket_refills():
+    buckets = MemoryBuckets()
+    assert buckets.take('client', 10.0, 1, 100.0) == (True, 0.0)
+    allowed, retry_after = buckets.take('client', 10.0, 1, 100.05)
+    assert not allowed
+    assert retry_after == pytest.approx(0.05)
+    assert buckets.take('client', 10.0, 1, 100.2)[0]
+
+def test_memory_buckets_bounded():
+    buckets = MemoryBuckets(maxsize=10)
+    for number in range(100):
+        buckets.take(f'client-{number}', 1.0, 1, 100.0)
+    assert len(buckets._buckets) <= 10
+
+def test_memory_buckets_evict_least_recently_used():
+    buckets = MemoryBuckets(maxsize=10)
+    for number in range(100):
+        buckets.take('active', 1000.0, 1000, 100.0)
+        buckets.take(f'client-{number}', 1.0, 1, 100.0)
+    assert 'active' in buckets._buckets
+    assert 'client-0' not in buckets._buckets
+
+def test_clients_behind_proxy_limited_apart(app):
+    def from_address(address):
+        return app.test_client().get('/equipment/active_equipments?vessel_code=MV102', headers={'X-Forwarded-For':address})
+    assert [from_address('203.0.113.1').status_code for _ in range(4)] == [200, 200, 200, 429]
+    assert from_address('203.0.113.2').status_code == 200
+
+def _take_all(path, results):
+    buckets = SharedBuckets(path, slots=64)
+    results.put(sum(buckets.take('client', 0.001, 10, time.time())[0] for _ in range(10)))
+
+def test_shared_buckets_across_processes(tmp_path):
+    path = str(tmp_path / 'rate_limits')
+    context = multiprocessing.get_context('fork')
+    results = context.Queue()
+    processes = [context.Process(target=_take_all, args=(path, results)) for _ in range(3)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    assert sum(results.get() for _ in processes) == 10
+
+def test_shedding_follows_pool_wait():
+    shedder = LoadShedder(max_pool_wait_ms=50, half_life=0.05)
+    shedder.observe_pool_wait(0.5)
+    assert shedder.enter() == 'pool_wait'
+    time.sleep(0.2)
+    assert shedder.enter() is None
+    assert shedder.stats().get('shed') == {'pool_wait':1}
@@ -0,0 +1,99 @@
+import pytest
+import multiprocessing
+from flask_migrate import Migrate
+from sqlalchemy import text
+from sqlalchemy.exc import OperationalError
+
+import sys
+import os
+sys.path.append(os.path.join(os.path.dirname(__file__),'../'))
+
+from apis.app import create_app
+from apis.models.model import db
+from apis.models.vessel import vessel
+from apis.instrumentation import RequestMetrics, SharedSeries, _start_timer
+
+
+@pytest.fixture(scope="module")
+def app():
+    app = create_app(test_config=True)
+    
+    with app.app_context():
+        db.create_all()
+        Migrate(app, db)
+        db.session.add(vessel(code='MV102'))
+        db.session.commit()
+
+    yield app
+
+    with app.app_context():
+        db.session.remove()
+        db.drop_all()
+
+def test_server_timing_header(app):
+    result = app.test_client().get('/equipment/active_equipments?vessel_code=MV102')
+    assert result.status_code == 200
+    server_timing = result.headers.get('Server-Timing')
+    assert 'db;dur=' in server_timing
+    assert 'desc="2 queries"' in server_timing
+    assert 'ser;dur=' in server_timing
+    assert 'total;dur=' in server_timing
+
+def test_metrics(app):
+    app.test_client().get('/equipment/active_equipments?vessel_code=MV102')
+    result = app.test_client().get('/metrics')
+    assert result.status_code == 200
+    assert result.mimetype == 'text/plain'
+    lines = result.get_data(as_text=True).splitlines()
+    assert 'http_request_duration_seconds_count{endpoint="equipments.active_equipment"} 2' in lines
+    assert 'http_request_db_queries_bucket{endpoint="equipments.active_equipment",le="0"} 0' in lines
+    assert 'http_request_db_queries_bucket{endpoint="equipments.active_equipment",le="1"} 1' in lines
+    assert 'http_request_db_queries_count{endpoint="equipments.active_equipment"} 2' in lines
+    assert 'cache_hits_total{cache="vessel"} 1' in lines
+    assert 'cache_misses_total{cache="vessel"} 1' in lines
+
+
+def metric_value(app, line_start):
+    # Read without a request, another request of the thread would share the app context of the open stream
+    lines = app.extensions['request_metrics'].render()
+    return float(next((line.split()[-1] for line in lines if line.startswith(line_start)), 0))
+
+def test_streamed_response_timed_when_closed(app):
+    count = 'http_request_duration_seconds_count{endpoint="equipments.active_equipment"}'
+    queries = 'http_request_db_queries_sum{endpoint="equipments.active_equipment"}'
+    before = metric_value(app, count), metric_value(app, queries)
+    result = app.test_client().get('/equipment/active_equipments?vessel_code=MV102&stream=true')
+    assert 'Server-Timing' not in result.headers
+    assert metric_value(app, count) == before[0]
+    assert result.get_json() == {'equipments':[]}
+    result.close()
+    assert metric_value(app, count) == before[0] + 1
+    # The query of the stream runs after the view returned
+    assert metric_value(app, queries) == before[1] + 1
+
+def test_failed_statement_start_popped(app):
+    with app.test_request_context():
+        _start_timer()
+        connection = db.session.connection()
+        with pytest.raises(OperationalError):
+            connection.execute(text('SELECT * FROM missing_table'))
+        assert not connection.info.get('query_start')
+        db.session.rollback()
+
+def _observe(path):
+    metrics = RequestMetrics(SharedSeries(path, slots=64))
+    for _ in range(10):
+        metrics.observe('equipments.active_equipment', 0.002, 0.001, 0.0005, 2)
+
+def test_shared_histograms_across_processes(tmp_path):
+    path = str(tmp_path / 'metrics')
+    context = multiprocessing.get_context('fork')
+    processes = [context.Process(target=_observe, args=(path,)) for _ in range(3)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    lines = RequestMetrics(SharedSeries(path, slots=64)).render()
+    assert 'http_request_duration_seconds_count{endpoint="equipments.active_equipment"} 30' in lines
+    assert 'http_request_db_queries_bucket{endpoint="equipments.active_equipment",le="1"} 0' in lines
+    assert 'http_request_db_queries_bucket{endpoint="equipments.active_equipment",le="2"} 30' in lines
@@ -0,0 +1,106 @@
+import pytest
+import time
+from flask_migrate import Migrate
+
+import sys
+import os
+sys.path.append(os.path.join(os.path.dirname(__file__),'../'))
+
+from apis.app import create_app
+from apis.models.model import db
+from apis.models.vessel import vessel
+from apis.models.equipment import equipment
+from apis.read_replicas import PRIMARY_COOKIE, init_read_replicas, read_replicas
+from apis.vessel_cache import vessel_cache
+
+
+@pytest.fixture(scope="module")
+def app(tmp_path_factory):
+    app = create_app(test_config=True)
+    directory = tmp_path_factory.mktemp('replicas')
+    app.config['SQLALCHEMY_REPLICA_URIS'] = [f'sqlite:///{directory}/replica_0.db', f'sqlite:///{directory}/replica_1.db']
+    init_read_replicas(app)
+
+    with app.app_context():
+        db.create_all()
+        Migrate(app, db)
+        # The replicas hold the fleet as it was before the writes of the tests, as if they lagged behind
+        for bind in ('replica_0', 'replica_1', None):
+            engine = db.get_engine(app, bind=bind)
+            db.metadata.create_all(engine)
+            with engine.begin() as connection:
+                connection.execute(vessel.__table__.insert(), [{'code':'MV102'}])
+                connection.execute(equipment.__table__.insert(), [{'vessel_id':1, 'code':'5310B9D0', 'location':'brazil',
+                                                                   'name':'compressor', 'active':True, 'version':1}])
+
+    yield app
+
+    with app.app_context():
+        db.session.remove()
+        db.drop_all()
+
+def active_codes(client, api_key='reader'):
+    result = client.get('/equipment/active_equipments?vessel_code=MV102', headers={'X-API-Key':api_key})
+    return [item.get('code') for item in result.get_json().get('equipments')]
+
+def test_reads_balanced_across_replicas(app):
+    with app.app_context():
+        before = read_replicas().stats()
+    for _ in range(4):
+        assert active_codes(app.test_client()) == ['5310B9D0']
+    with app.app_context():
+        after = read_replicas().stats()
+    assert after['replica_0'] - before['replica_0'] == 2
+    assert after['replica_1'] - before['replica_1'] == 2
+
+def test_writer_reads_own_writes(app):
+    client = app.test_client()
+    result = client.post('/equipment/insert_equipment', json={'vessel_code':'MV102', 'code':'5310B9D1',
+                                                               'location':'brazil', 'name':'motor'},
+                         headers={'X-API-Key':'writer'})
+    assert result.status_code == 201
+    assert PRIMARY_COOKIE in result.headers.get('Set-Cookie')
+    assert active_codes(client, 'writer') == ['5310B9D0', '5310B9D1']
+    # Other clients read the replicas, which have not received the insert
+    assert active_codes(app.test_client()) == ['5310B9D0']
+
+def test_writer_without_cookie_reads_own_writes(app):
+    # A client that drops the cookie is still recognized by its api key
+    assert active_codes(app.test_client(), 'writer') == ['5310B9D0', '5310B9D1']
+
+def test_vessel_missing_from_replica_found_on_primary(app):
+    client = app.test_client()
+    assert client.post('/vessel/insert_vessel', json={'code':'MV110'}, headers={'X-API-Key':'fleet'}).status_code == 201
+    with app.app_context():
+        # As in a worker that did not take the insert
+        vessel_cache().invalidate('MV110')
+    result = app.test_client().get('/equipment/active_equipments?vessel_code=MV110', headers={'X-API-Key':'reader'})
+    assert result.status_code == 200
+    assert result.get_json().get('equipments') == []
+
+def test_stickiness_expires(app):
+    client = app.test_client()
+    client.set_cookie('localhost', PRIMARY_COOKIE, f'{time.time() - 1:.3f}')
+    assert active_codes(client) == ['5310B9D0']
+    client.set_cookie('localhost', PRIMARY_COOKIE, 'invalid')
+    assert active_codes(client) == ['5310B9D0']
+
+def test_failed_write_not_sticky(app):
+    result = app.test_client().post('/equipment/insert_equipment', json={'vessel_code':'MV109', 'code':'5310B9D2',
+                                                                         'location':'brazil', 'name':'motor'},
+                                    headers={'X-API-Key':'failed'})
+    assert result.status_code == 409
+    assert 'Set-Cookie' not in result.headers
+    assert active_codes(app.test_client(), 'failed') == ['5310B9D0']
+
+def test_writes_go_to_primary(app):
+    with app.app_context():
+        assert db.session.query(equipment).filter(equipment.code=='5310B9D1').count() == 1
+        for bind in ('replica_0', 'replica_1'):
+            with db.get_engine(app, bind=bind).connect() as connection:
+                assert connection.execute(equipment.__table__.select().where(equipment.code=='5310B9D1')).first() is None
+
+def test_reads_in_metrics(app):
+    result = app.test_client().get('/metrics').get_data(as_text=True)
+    assert 'db_reads_total{target="replica_0"}' in result
+    assert 'db_reads_total{target="primary"}' in result
@@ -0,0 +1,183 @@
+import gzip
+import json
+import multiprocessing
+import pytest
+import tempfile
+import time
+from flask_migrate import Migrate
+
+import sys
+import os
+sys.path.append(os.path.join(os.path.dirname(__file__),'../'))
+
+from apis.app import create_app
+from apis.models.model import db
+from apis.models.vessel import vessel
+from apis.response_cache import FileBackend, MemoryBackend, init_response_cache, response_cache
+
+
+@pytest.fixture(scope="module")
+def app():
+    app = create_app(test_config=True)
+    app.config['RESPONSE_CACHE_BACKEND'] = 'memory'
+    init_response_cache(app)
+    
+    with app.app_context():
+        db.create_all()
+        Migrate(app, db)
+        db.session.add(vessel(code='MV102'))
+        db.session.add(vessel(code='MV101'))
+        db.session.commit()
+
+    yield app
+
+    with app.app_context():
+        db.session.remove()
+        db.drop_all()
+
+@pytest.fixture(scope="module")
+def file_cache_apps(app):
+    directory = tempfile.mkdtemp()
+    apps = []
+    for _ in range(2):
+        worker_app = create_app(test_config=True)
+        worker_app.config['RESPONSE_CACHE_BACKEND'] = 'file'
+        worker_app.config['RESPONSE_CACHE_DIR'] = directory
+        init_response_cache(worker_app)
+        apps.append(worker_app)
+    return apps
+
+def test_cached_list(app):
+    first = app.test_client().get('/equipment/active_equipments?vessel_code=MV102')
+    second = app.test_client().get('/equipment/active_equipments?vessel_code=MV102')
+    assert first.status_code == 200
+    assert second.status_code == 200
+    assert first.get_json().get('equipments') == []
+    assert first.headers.get('ETag') == second.headers.get('ETag')
+    with app.app_context():
+        stats = response_cache().stats()
+        assert stats.get('misses') == 1
+        assert stats.get('hits') == 1
+
+def test_not_modified(app):
+    first = app.test_client().get('/equipment/active_equipments?vessel_code=MV102')
+    result = app.test_client().get('/equipment/active_equipments?vessel_code=MV102', headers={'If-None-Match':first.headers.get('ETag')})
+    assert result.status_code == 304
+    assert result.headers.get('ETag') == first.headers.get('ETag')
+
+def test_insert_invalidates(app):
+    first = app.test_client().get('/equipment/active_equipments?vessel_code=MV102')
+    app.test_client().post('/equipment/insert_equipment', json={'vessel_code':'MV102', 'code':'5310B9D7', 'location':'brazil', 'name':'compressor'})
+    result = app.test_client().get('/equipment/active_equipments?vessel_code=MV102', headers={'If-None-Match':first.headers.get('ETag')})
+    assert result.status_code == 200
+    assert [item.get('code') for item in result.get_json().get('equipments')] == ['5310B9D7']
+
+def test_bulk_insert_invalidates(app):
+    app.test_client().get('/equipment/active_equipments?vessel_code=MV101')
+    app.test_client().post('/equipment/bulk_insert', json=[{'vessel_code':'MV101', 'code':'5310B9D8', 'location':'usa', 'name':'motor'}])
+    result = app.test_client().get('/equipment/active_equipments?vessel_code=MV101')
+    assert [item.get('code') for item in result.get_json().get('equipments')] == ['5310B9D8']
+
+def test_update_invalidates(app):
+    app.test_client().get('/equipment/active_equipments?vessel_code=MV102')
+    app.test_client().put('/equipment/update_equipment_status', json={'code':'5310B9D7'})
+    result = app.test_client().get('/equipment/active_equipments?vessel_code=MV102')
+    assert result.get_json().get('equipments') == []
+
+def test_other_vessel_still_cached(app):
+    with app.app_context():
+        hits = response_cache().stats().get('hits')
+    app.test_client().get('/equipment/active_equipments?vessel_code=MV101')
+    with app.app_context():
+        assert response_cache().stats().get('hits') == hits + 1
+
+def test_cached_per_encoding(app):
+    columnar = {'Accept':'application/vnd.vessels.columnar+json'}
+    app.test_client().get('/equipment/active_equipments?vessel_code=MV101', headers=columnar)
+    first = app.test_client().get('/equipment/active_equipments?vessel_code=MV101', headers=columnar)
+    assert first.mimetype == 'application/vnd.vessels.columnar+json'
+    assert first.headers.get('ETag') != app.test_client().get('/equipment/active_equipments?vessel_code=MV101').headers.get('ETag')
+    app.test_client().post('/equipment/insert_equipment', json={'vessel_code':'MV101', 'code':'5310B9DA', 'location':'chile', 'name':'pump'})
+    result = app.test_client().get('/equipment/active_equipments?vessel_code=MV101', headers=columnar)
+    assert result.get_json(force=True).get('equipments').get('code') == ['5310B9D8', '5310B9DA']
+
+def test_compressed_not_modified(app):
+    app.config['COMPRESSION_MIN_SIZE'] = 0
+    try:
+        first = app.test_client().get('/equipment/active_equipments?vessel_code=MV101', headers={'Accept-Encoding':'gzip'})
+        result = app.test_client().get('/equipment/active_equipments?vessel_code=MV101',
+                                       headers={'Accept-Encoding':'gzip', 'If-None-Match':first.headers.get('ETag')})
+    finally:
+        app.config['COMPRESSION_MIN_SIZE'] = 1024
+    assert first.headers.get('ETag').startswith('W/')
+    assert result.status_code == 304
+
+def compressions(app):
+    with app.app_context():
+        return response_cache().stats().get('compressions')
+
+def test_compressed_once_per_version(app):
+    gzipped = {'Accept-Encoding':'gzip'}
+    app.config['COMPRESSION_MIN_SIZE'] = 0
+    try:
+        first = app.test_client().get('/equipment/active_equipments?vessel_code=MV102', headers=gzipped)
+        compressed = compressions(app)
+        second = app.test_client().get('/equipment/active_equipments?vessel_code=MV102', headers=gzipped)
+        assert compressions(app) == compressed
+        app.test_client().post('/equipment/insert_equipment', json={'vessel_code':'MV102', 'code':'5310B9DC', 'location':'chile', 'name':'pump'})
+        third = app.test_client().get('/equipment/active_equipments?vessel_code=MV102', headers=gzipped)
+        assert compressions(app) == compressed + 1
+    finally:
+        app.config['COMPRESSION_MIN_SIZE'] = 1024
+    assert first.headers.get('Content-Encoding') == 'gzip'
+    assert first.data == second.data
+    assert '5310B9DC' in [item.get('code') for item in json.loads(gzip.decompress(third.data)).get('equipments')]
+
+def test_file_cache_shared_between_workers(file_cache_apps):
+    first_worker, second_worker = file_cache_apps
+    first = first_worker.test_client().get('/equipment/active_equipments?vessel_code=MV101')
+    second = second_worker.test_client().get('/equipment/active_equipments?vessel_code=MV101')
+    assert first.headers.get('ETag') == second.headers.get('ETag')
+    with second_worker.app_context():
+        assert response_cache().stats().get('hits') == 1
+
+def test_file_cache_invalidated_by_other_worker(file_cache_apps):
+    first_worker, second_worker = file_cache_apps
+    first_worker.test_client().get('/equipment/active_equipments?vessel_code=MV101')
+    second_worker.test_client().post('/equipment/insert_equipment', json={'vessel_code':'MV101', 'code':'5310B9D9', 'location':'china', 'name':'compressor'})
+    result = first_worker.test_client().get('/equipment/active_equipments?vessel_code=MV101')
+    assert sorted(item.get('code') for item in result.get_json().get('equipments')) == ['5310B9D8', '5310B9D9', '5310B9DA']
+
+def test_file_cache_invalidated_by_import(file_cache_apps, tmp_path):
+    pytest.importorskip('pandas')
+    from apis.fleet_io import import_equipments_command
+
+    first_worker, second_worker = file_cache_apps
+    first_worker.test_client().get('/equipment/active_equipments?vessel_code=MV102')
+    path = tmp_path / 'equipments.csv'
+    path.write_text('vessel_code,code,name,location\nMV102,5310B9DB,valve,peru\n')
+    result = second_worker.test_cli_runner().invoke(import_equipments_command, [str(path)])
+    assert 'inserted 1' in result.output
+    result = first_worker.test_client().get('/equipment/active_equipments?vessel_code=MV102')
+    assert '5310B9DB' in [item.get('code') for item in result.get_json().get('equipments')]
+
+def test_memory_entries_expire():
+    backend = MemoryBackend(ttl=0.01)
+    backend.set('key', (0, 'etag', b'body'))
+    assert backend.get('key') == (0, 'etag', b'body')
+    time.sleep(0.02)
+    assert backend.get('key') is None
+
+def _bump_many(directory):
+    backend = FileBackend(directory)
+    for _ in range(50):
+        backend.bump('active_equipments-1-json')
+
+def test_file_generation_bumps_not_lost(tmp_path):
+    context = multiprocessing.get_context('fork')
+    processes = [context.Process(target=_bump_many, args=(str(tmp_path),)) for _ in range(4)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    assert FileBackend(str(tmp_path)).generation('active_equipments-1-json') == 200
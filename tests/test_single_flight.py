@@ -0,0 +1,114 @@
+import pytest
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from flask_migrate import Migrate
+
+import sys
+import os
+sys.path.append(os.path.join(os.path.dirname(__file__),'../'))
+
+from apis.app import create_app
+from apis.models.model import db
+from apis.models.vessel import vessel
+from apis.models.equipment import equipment
+from apis.single_flight import SingleFlight, single_flight
+
+
+@pytest.fixture(scope="module")
+def app():
+    app = create_app(test_config=True)
+
+    with app.app_context():
+        db.create_all()
+        Migrate(app, db)
+        db.session.add(vessel(code='MV102'))
+        db.session.add(equipment(vessel_id=1, code='5310B9D0', location='brazil', name='compressor', active=True))
+        db.session.commit()
+
+    yield app
+
+    with app.app_context():
+        db.session.remove()
+        db.drop_all()
+
+def wait_until(condition):
+    for _ in range(500):
+        if condition():
+            return
+        time.sleep(0.01)
+    raise AssertionError('condition not met')
+
+def test_requests_arriving_during_a_read_share_the_next_one():
+    flights = SingleFlight()
+    release = threading.Event()
+    reads = []
+
+    def read():
+        reads.append(len(reads))
+        release.wait()
+        return len(reads)
+
+    with ThreadPoolExecutor(max_workers=11) as executor:
+        first = executor.submit(flights.do, 'vessel', read)
+        wait_until(lambda: reads)
+        others = [executor.submit(flights.do, 'vessel', read) for _ in range(10)]
+        wait_until(lambda: flights.stats()['coalesced'] == 9)
+        # The first read started before the others arrived, none of them may use it
+        assert len(reads) == 1
+        release.set()
+        assert first.result() == 1
+        assert [other.result() for other in others] == [2] * 10
+    assert flights.stats() == {'flights':2, 'coalesced':9, 'in_flight':0}
+
+def test_different_keys_are_not_coalesced():
+    flights = SingleFlight()
+    assert flights.do('a', lambda: 1) == 1
+    assert flights.do('b', lambda: 2) == 2
+    assert flights.stats().get('coalesced') == 0
+
+def test_error_raised_to_every_waiting_request():
+    flights = SingleFlight()
+    release = threading.Event()
+    started = threading.Event()
+
+    def read():
+        started.set()
+        release.wait()
+        return 'first'
+
+    def failing_read():
+        raise ValueError('read failed')
+
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        first = executor.submit(flights.do, 'vessel', read)
+        started.wait()
+        others = [executor.submit(flights.do, 'vessel', failing_read) for _ in range(2)]
+        wait_until(lambda: flights.stats()['coalesced'] == 1)
+        release.set()
+        assert first.result() == 'first'
+        for other in others:
+            with pytest.raises(ValueError):
+                other.result()
+    assert flights.stats().get('in_flight') == 0
+    assert flights.do('vessel', lambda: 'recovered') == 'recovered'
+
+def test_concurrent_active_equipments(app):
+    with ThreadPoolExecutor(max_workers=20) as executor:
+        results = list(executor.map(lambda _: app.test_client().get('/equipment/active_equipments?vessel_code=MV102'), range(20)))
+    assert all(result.status_code == 200 for result in results)
+    assert all(result.get_json().get('equipments')[0].get('code') == '5310B9D0' for result in results)
+    with app.app_context():
+        stats = single_flight().stats()
+    assert stats.get('flights') + stats.get('coalesced') == 20
+    assert stats.get('in_flight') == 0
+
+def test_write_seen_by_the_next_request(app):
+    app.test_client().put('/equipment/update_equipment_status', json={'code':'5310B9D0'})
+    result = app.test_client().get('/equipment/active_equipments?vessel_code=MV102')
+    assert result.get_json().get('equipments') == []
+
+def test_stats_exposed(app):
+    result = app.test_client().get('/cache_stats')
+    assert result.get_json().get('single_flight').get('flights') > 0
+    assert 'single_flight_coalesced_total' in app.test_client().get('/metrics').get_data(as_text=True)
@@ -0,0 +1,139 @@
+import pytest
+import time
+from datetime import datetime
+from flask_migrate import Migrate
+
+import sys
+import os
+sys.path.append(os.path.join(os.path.dirname(__file__),'../'))
+
+from apis.app import create_app
+from apis.models.model import db
+from apis.models.vessel import vessel
+from apis.models.equipment_status_event import equipment_status_event
+
+
+@pytest.fixture(scope="module")
+def app():
+    app = create_app(test_config=True)
+
+    with app.app_context():
+        db.create_all()
+        Migrate(app, db)
+        db.session.add(vessel(code='MV102'))
+        db.session.add(vessel(code='MV101'))
+        db.session.commit()
+
+    yield app
+
+    with app.app_context():
+        db.session.remove()
+        db.drop_all()
+
+# Times taken between the writes of the first test, for the range queries of the next ones
+moments = {}
+
+def now():
+    # Leaves a gap so the events written before and after the returned time never share a timestamp
+    time.sleep(0.01)
+    moment = datetime.utcnow().isoformat() + 'Z'
+    time.sleep(0.01)
+    return moment
+
+def active_at(app, at, vessel_code='MV102'):
+    result = app.test_client().get('/equipment/active_at', query_string={'vessel_code':vessel_code, 'at':at})
+    assert result.status_code == 200
+    return [item['code'] for item in result.get_json()['equipments']]
+
+def test_history_of_inserts_and_deactivations(app):
+    before_inserts = now()
+    client = app.test_client()
+    client.post('/equipment/insert_equipment', json={'vessel_code':'MV102', 'code':'5310B9D1', 'location':'brazil', 'name':'compressor'})
+    client.post('/equipment/bulk_insert', json=[{'vessel_code':'MV102', 'code':'5310B9D2', 'location':'brazil', 'name':'motor'},
+                                                {'vessel_code':'MV101', 'code':'5310B9D3', 'location':'peru', 'name':'valve'}])
+    after_inserts = now()
+    result = client.put('/equipment/update_equipment_status', json={'code':['5310B9D1', '5310B9D3']})
+    assert result.status_code == 201
+    after_deactivation = now()
+
+    assert active_at(app, before_inserts) == []
+    assert active_at(app, after_inserts) == ['5310B9D1', '5310B9D2']
+    assert active_at(app, after_deactivation) == ['5310B9D2']
+    assert active_at(app, after_inserts, 'MV101') == ['5310B9D3']
+    assert active_at(app, after_deactivation, 'MV101') == []
+    moments['after_inserts'] = after_inserts
+
+def test_deactivating_again_records_nothing(app):
+    with app.app_context():
+        events = db.session.query(equipment_status_event).count()
+    app.test_client().put('/equipment/update_equipment_status', json={'code':'5310B9D1'})
+    with app.app_context():
+        assert db.session.query(equipment_status_event).count() == events
+
+def test_active_at_with_offset(app):
+    assert active_at(app, '2000-01-01T03:00:00+03:00') == []
+
+def test_active_at_missing_parameter(app):
+    result = app.test_client().get('/equipment/active_at', query_string={'vessel_code':'MV102'})
+    assert result.get_json().get('message') == 'MISSING_PARAMETER'
+    assert result.status_code == 400
+
+def test_active_at_wrong_format(app):
+    result = app.test_client().get('/equipment/active_at', query_string={'vessel_code':'MV102', 'at':'yesterday'})
+    assert result.get_json().get('message') == 'WRONG_FORMAT'
+    assert result.status_code == 400
+
+def test_active_at_no_vessel(app):
+    result = app.test_client().get('/equipment/active_at', query_string={'vessel_code':'MV109', 'at':'2021-01-01T00:00:00Z'})
+    assert result.get_json().get('message') == 'NO_VESSEL'
+    assert result.status_code == 409
+
+def test_status_history(app):
+    result = app.test_client().get('/equipment/status_history', query_string={'vessel_code':'MV102'})
+    assert result.status_code == 200
+    transitions = result.get_json()['transitions']
+    assert [(item['code'], item['active'], item['previous_active']) for item in transitions] == [
+        ('5310B9D1', True, None), ('5310B9D2', True, None), ('5310B9D1', False, True)]
+    assert result.get_json()['next_after_id'] is None
+
+def test_status_history_of_a_code_since(app):
+    after_inserts = moments['after_inserts']
+    result = app.test_client().get('/equipment/status_history', query_string={'vessel_code':'MV102', 'code':'5310B9D1',
+                                                                              'since':after_inserts})
+    assert [(item['code'], item['active']) for item in result.get_json()['transitions']] == [('5310B9D1', False)]
+    result = app.test_client().get('/equipment/status_history', query_string={'vessel_code':'MV102', 'until':after_inserts})
+    assert len(result.get_json()['transitions']) == 2
+
+def test_status_history_pages(app):
+    client = app.test_client()
+    pages = []
+    query_string = {'vessel_code':'MV102', 'limit':2}
+    while True:
+        result = client.get('/equipment/status_history', query_string=query_string).get_json()
+        pages.append([item['code'] for item in result['transitions']])
+        if result['next_after_id'] is None:
+            break
+        query_string['after_id'] = result['next_after_id']
+    assert pages == [['5310B9D1', '5310B9D2'], ['5310B9D1']]
+
+def test_status_history_after_id_of_another_vessel(app):
+    with app.app_context():
+        other_id = db.session.query(equipment_status_event.id).filter(equipment_status_event.code=='5310B9D3').first()[0]
+    result = app.test_client().get('/equipment/status_history', query_string={'vessel_code':'MV102', 'after_id':other_id})
+    assert result.get_json().get('message') == 'WRONG_FORMAT'
+    assert result.status_code == 400
+
+def test_status_history_wrong_limit(app):
+    result = app.test_client().get('/equipment/status_history', query_string={'vessel_code':'MV102', 'limit':0})
+    assert result.get_json().get('message') == 'WRONG_FORMAT'
+    assert result.status_code == 400
+    result = app.test_client().get('/equipment/status_history', query_string={'vessel_code':'MV102', 'limit':10001})
+    assert result.status_code == 400
+    result = app.test_client().get('/equipment/status_history', query_string={'vessel_code':'MV102', 'after_id':'²'})
+    assert result.get_json().get('message') == 'WRONG_FORMAT'
+    assert result.status_code == 400
+
+def test_status_history_missing_parameter(app):
+    result = app.test_client().get('/equipment/status_history')
+    assert result.get_json().get('message') == 'MISSING_PARAMETER'
+    assert result.status_code == 400
@@ -0,0 +1,119 @@
+import pytest
+import time
+from datetime import datetime
+from flask_migrate import Migrate
+
+import sys
+import os
+sys.path.append(os.path.join(os.path.dirname(__file__),'../'))
+
+from apis.app import create_app
+from apis.models.model import db
+from apis.models.vessel import vessel
+from apis.models.equipment import equipment
+from apis.models.equipment_status_event import equipment_status_event
+
+
+@pytest.fixture(scope="module")
+def app():
+    app = create_app(test_config=True)
+
+    with app.app_context():
+        db.create_all()
+        Migrate(app, db)
+        db.session.add(vessel(code='MV102'))
+        db.session.add(vessel(code='MV101'))
+        db.session.commit()
+
+    client = app.test_client()
+    client.post('/equipment/bulk_insert', json=[
+        {'vessel_code':'MV102', 'code':'5310B9D1', 'location':'brazil', 'name':'compressor'},
+        {'vessel_code':'MV102', 'code':'5310B9D2', 'location':'brazil', 'name':'motor'},
+        {'vessel_code':'MV102', 'code':'5310B9D3', 'location':'peru', 'name':'valve'},
+        {'vessel_code':'MV101', 'code':'5310B9D4', 'location':'chile', 'name':'pump'}])
+    client.put('/equipment/update_equipment_status', json={'code':'5310B9D2'})
+
+    yield app
+
+    with app.app_context():
+        db.session.remove()
+        db.drop_all()
+
+def active_codes(app, vessel_code):
+    result = app.test_client().get('/equipment/active_equipments', query_string={'vessel_code':vessel_code})
+    return [item['code'] for item in result.get_json()['equipments']]
+
+def test_mixed_transitions(app):
+    # Cached before the transitions, they must be invalidated on both vessels
+    assert active_codes(app, 'MV102') == ['5310B9D1', '5310B9D3']
+    assert active_codes(app, 'MV101') == ['5310B9D4']
+    time.sleep(0.01)
+    before = datetime.utcnow().isoformat() + 'Z'
+
+    result = app.test_client().put('/equipment/transitions', json={'transitions':[
+        {'code':'5310B9D2', 'operation':'activate'},
+        {'code':'5310B9D1', 'operation':'relocate', 'vessel_code':'MV101'},
+        {'code':'5310B9D4', 'operation':'deactivate'},
+        {'code':'5310B9D3', 'operation':'change_location', 'location':'chile'}]})
+    assert result.status_code == 201
+    assert result.get_json().get('applied') == 4
+    assert [item['message'] for item in result.get_json()['results']] == ['OK'] * 4
+
+    with app.app_context():
+        rows = db.session.query(equipment.code, equipment.vessel_id, equipment.location, equipment.active) \
+            .order_by(equipment.code).all()
+        assert [tuple(row) for row in rows] == [('5310B9D1', 2, 'brazil', True), ('5310B9D2', 1, 'brazil', True),
+                                                ('5310B9D3', 1, 'chile', True), ('5310B9D4', 2, 'chile', False)]
+    assert active_codes(app, 'MV102') == ['5310B9D2', '5310B9D3']
+    assert active_codes(app, 'MV101') == ['5310B9D1']
+    assert app.test_client().get('/equipment/statistics/check', headers={'X-Admin-Key':'test-admin-key'}).get_json().get('drift') == []
+
+    result = app.test_client().get('/equipment/active_at', query_string={'vessel_code':'MV102', 'at':before})
+    assert [item['code'] for item in result.get_json()['equipments']] == ['5310B9D1', '5310B9D3']
+
+def test_relocation_events(app):
+    with app.app_context():
+        rows = db.session.query(equipment_status_event.vessel_id, equipment_status_event.active,
+                                equipment_status_event.previous_active) \
+            .filter(equipment_status_event.code=='5310B9D1').order_by(equipment_status_event.id).all()
+        assert [tuple(row) for row in rows] == [(1, True, None), (1, None, True), (2, True, None)]
+
+def test_transitions_outcomes(app):
+    result = app.test_client().put('/equipment/transitions', json=[
+        {'code':'5310B9D2', 'operation':'activate'},
+        {'code':'5310B9D9', 'operation':'deactivate'},
+        {'code':'5310B9D3', 'operation':'relocate', 'vessel_code':'MV109'},
+        {'code':'5310B9D3', 'operation':'relocate'},
+        {'code':'5310B9D3', 'operation':'repaint'},
+        {'code':'5310B9D4', 'operation':'change_location', 'location':'chile'},
+        {'code':'5310B9D3', 'operation':'deactivate'},
+        'activate'])
+    assert result.status_code == 201
+    assert result.get_json().get('applied') == 0
+    assert [item['message'] for item in result.get_json()['results']] == [
+        'UNCHANGED', 'NO_CODE', 'NO_VESSEL', 'MISSING_PARAMETER', 'WRONG_FORMAT', 'UNCHANGED', 'REPEATED_CODE',
+        'WRONG_FORMAT']
+    with app.app_context():
+        assert db.session.query(equipment.active).filter(equipment.code=='5310B9D3').scalar() is True
+
+def test_transitions_in_chunks(app):
+    app.config['UPDATE_CHUNK_SIZE'] = 1
+    try:
+        result = app.test_client().put('/equipment/transitions', json=[
+            {'code':'5310B9D1', 'operation':'deactivate'},
+            {'code':'5310B9D2', 'operation':'relocate', 'vessel_code':'MV101'}])
+    finally:
+        app.config.pop('UPDATE_CHUNK_SIZE')
+    assert result.get_json().get('applied') == 2
+    assert active_codes(app, 'MV101') == ['5310B9D2']
+    assert app.test_client().get('/equipment/statistics/check', headers={'X-Admin-Key':'test-admin-key'}).get_json().get('drift') == []
+
+def test_transitions_missing_parameter(app):
+    result = app.test_client().put('/equipment/transitions', json=[])
+    assert result.get_json().get('message') == 'MISSING_PARAMETER'
+    assert result.status_code == 400
+
+def test_transitions_wrong_format(app):
+    result = app.test_client().put('/equipment/transitions', json={'code':'5310B9D1'})
+    assert result.get_json().get('message') == 'WRONG_FORMAT'
+    assert result.status_code == 400
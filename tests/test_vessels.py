@@ -8,7 +8,7 @@ sys.path.append(os.path.join(os.path.dirname(__file__),'../'))
 from apis.app import create_app
 from apis.models.model import db
 from apis.models.vessel import vessel
-from sqlalchemy import func
+from sqlalchemy import event, func
 
 
 @pytest.fixture(scope="module")
@@ -76,3 +76,70 @@ def test_insert_second_code(app):
         assert query_results_ids[0][0] == 'MV102'
         assert query_results_ids[1][0] == 'MV101'
 
+
+def test_bulk_insert(app):
+    result = app.test_client().post('/vessel/bulk_insert', json={'code':['MV103', 'MV101', 'MV104', 1, 'MV103', 'MV1000000']})
+    assert result.get_json().get('message') == 'OK'
+    assert result.status_code == 201
+    assert result.get_json().get('created') == ['MV103', 'MV104']
+    assert result.get_json().get('existing') == ['MV101']
+    messages = [item.get('message') for item in result.get_json().get('results')]
+    assert messages == ['OK', 'FAIL', 'OK', 'WRONG_FORMAT', 'FAIL', 'WRONG_FORMAT']
+    with app.app_context():
+        query = db.session.query(func.count(vessel.code))
+        query_results = db.session.execute(query).all()
+        assert query_results[0][0] == 4
+
+def test_bulk_insert_list_body(app):
+    result = app.test_client().post('/vessel/bulk_insert', json=['MV105', 'MV102'])
+    assert result.status_code == 201
+    assert result.get_json().get('created') == ['MV105']
+    assert result.get_json().get('existing') == ['MV102']
+
+def test_bulk_insert_wrong_format(app):
+    result = app.test_client().post('/vessel/bulk_insert', json={'code':'MV106'})
+    assert result.get_json().get('message') == 'WRONG_FORMAT'
+    assert result.status_code == 400
+
+def test_bulk_insert_without_code(app):
+    result = app.test_client().post('/vessel/bulk_insert', json={'code':[]})
+    assert result.get_json().get('message') == 'MISSING_PARAMETER'
+    assert result.status_code == 400
+
+def test_insert_after_vessel_lookup(app):
+    result = app.test_client().get('/equipment/active_equipments?vessel_code=MV107')
+    assert result.get_json().get('message') == 'NO_VESSEL'
+    result = app.test_client().post('/vessel/insert_vessel', json={'code':'MV107'})
+    assert result.status_code == 201
+    result = app.test_client().get('/equipment/active_equipments?vessel_code=MV107')
+    assert result.get_json().get('equipments') == []
+    assert result.status_code == 200
+
+def test_bulk_insert_after_vessel_lookup(app):
+    result = app.test_client().get('/equipment/active_equipments?vessel_code=MV108')
+    assert result.get_json().get('message') == 'NO_VESSEL'
+    result = app.test_client().post('/vessel/bulk_insert', json={'code':['MV108']})
+    assert result.get_json().get('created') == ['MV108']
+    result = app.test_client().get('/equipment/active_equipments?vessel_code=MV108')
+    assert result.get_json().get('equipments') == []
+    assert result.status_code == 200
+
+def test_bulk_insert_concurrent_insert(app):
+    inserted = []
+
+    def insert_concurrently(conn, cursor, statement, parameters, context, executemany):
+        # Another request inserts MV110 between the read of the existing codes and the insert
+        if not inserted and statement.startswith('SELECT vessels.code'):
+            inserted.append(True)
+            with db.engine.begin() as connection:
+                connection.execute(vessel.__table__.insert().values(code='MV110'))
+
+    with app.app_context():
+        event.listen(db.engine, 'after_cursor_execute', insert_concurrently)
+        try:
+            result = app.test_client().post('/vessel/bulk_insert', json={'code':['MV109', 'MV110']})
+        finally:
+            event.remove(db.engine, 'after_cursor_execute', insert_concurrently)
+    assert result.status_code == 201
+    assert result.get_json().get('created') == ['MV109']
+    assert result.get_json().get('existing') == ['MV110']
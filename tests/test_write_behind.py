@@ -0,0 +1,151 @@
+import pytest
+import multiprocessing
+import time
+from concurrent.futures import ThreadPoolExecutor
+from flask_migrate import Migrate
+
+import sys
+import os
+sys.path.append(os.path.join(os.path.dirname(__file__),'../'))
+
+from apis.app import create_app
+from apis.models.model import db
+from apis.models.vessel import vessel
+from apis.models.equipment import equipment
+from apis.write_behind import InsertBatcher, SharedTickets, init_insert_batcher, insert_batcher
+
+
+@pytest.fixture(scope="module")
+def app():
+    app = create_app(test_config=True)
+
+    with app.app_context():
+        db.create_all()
+        Migrate(app, db)
+        db.session.add(vessel(code='MV102'))
+        db.session.add(equipment(vessel_id=1, code='5310B9D0', location='brazil', name='compressor', active=True))
+        db.session.commit()
+
+    app.config['WRITE_BEHIND_MODE'] = 'wait'
+    app.config['WRITE_BEHIND_MAX_WAIT_MS'] = 50
+    init_insert_batcher(app)
+
+    yield app
+
+    with app.app_context():
+        db.session.remove()
+        db.drop_all()
+
+def insert(app, code):
+    return app.test_client().post('/equipment/insert_equipment', json={'vessel_code':'MV102', 'code':code,
+                                                                       'location':'brazil', 'name':'compressor'})
+
+def insert_batcher_status(app, ticket_id):
+    return app.test_client().get(f'/equipment/insert_status?id={ticket_id}').get_json().get('message')
+
+def test_insert_after_group_commit(app):
+    result = insert(app, '5310B9D1')
+    assert result.get_json().get('message') == 'OK'
+    assert result.status_code == 201
+    with app.app_context():
+        assert db.session.query(equipment).filter(equipment.code=='5310B9D1').count() == 1
+
+def test_insert_known_code_refused_before_queue(app):
+    with app.app_context():
+        flushes = insert_batcher().stats().get('flushes')
+    result = insert(app, '5310B9D0')
+    assert result.get_json().get('message') == 'REPEATED_CODE'
+    assert result.status_code == 409
+    with app.app_context():
+        assert insert_batcher().stats().get('flushes') == flushes
+
+def test_insert_no_vessel(app):
+    result = app.test_client().post('/equipment/insert_equipment', json={'vessel_code':'MV109', 'code':'5310B9D2',
+                                                                         'location':'brazil', 'name':'compressor'})
+    assert result.get_json().get('message') == 'NO_VESSEL'
+    assert result.status_code == 409
+
+def test_burst_grouped_in_few_commits(app):
+    with app.app_context():
+        flushes = insert_batcher().stats().get('flushes')
+    codes = [f'5310C{number:03d}' for number in range(40)]
+    with ThreadPoolExecutor(max_workers=40) as executor:
+        results = list(executor.map(lambda code: insert(app, code), codes))
+    assert all(result.status_code == 201 for result in results)
+    with app.app_context():
+        assert db.session.query(equipment).filter(equipment.code.in_(codes)).count() == 40
+        assert insert_batcher().stats().get('flushes') - flushes < 40
+        assert insert_batcher().stats().get('max_group') > 1
+
+def test_code_inserted_by_other_worker(app):
+    with app.app_context():
+        db.session.add(equipment(vessel_id=1, code='5310D001', location='china', name='motor', active=True))
+        db.session.commit()
+    result = insert(app, '5310D001')
+    assert result.get_json().get('message') == 'REPEATED_CODE'
+    assert result.status_code == 409
+
+def test_async_mode_status_lookup(app):
+    app.config['WRITE_BEHIND_MODE'] = 'async'
+    try:
+        result = insert(app, '5310D002')
+    finally:
+        app.config['WRITE_BEHIND_MODE'] = 'wait'
+    assert result.get_json().get('message') == 'ACCEPTED'
+    assert result.status_code == 202
+
+    ticket_id = result.get_json().get('id')
+    for _ in range(100):
+        status = app.test_client().get(f'/equipment/insert_status?id={ticket_id}').get_json().get('message')
+        if status != 'PENDING':
+            break
+        time.sleep(0.01)
+    assert status == 'OK'
+
+def test_async_mode_status_lookup_from_other_worker(app):
+    app.config['WRITE_BEHIND_MODE'] = 'async'
+    try:
+        result = insert(app, '5310D004')
+    finally:
+        app.config['WRITE_BEHIND_MODE'] = 'wait'
+    ticket_id = result.get_json().get('id')
+    assert ticket_id.startswith(f'{os.getpid()}-')
+    with app.app_context():
+        path = insert_batcher().tickets.path
+    for _ in range(100):
+        if insert_batcher_status(app, ticket_id) != 'PENDING':
+            break
+        time.sleep(0.01)
+
+    # A worker maps the tickets file on its own and reads the status of the tickets of the others
+    context = multiprocessing.get_context('fork')
+    statuses = context.Queue()
+    worker = context.Process(target=lambda: statuses.put(SharedTickets(path).get(ticket_id)))
+    worker.start()
+    worker.join()
+    assert statuses.get(timeout=5) == 'OK'
+
+def test_close_stops_thread_before_drain(app, tmp_path):
+    batcher = InsertBatcher(app, SharedTickets(str(tmp_path / 'tickets'), slots=64), max_wait_ms=200)
+    tickets = [batcher.submit({'vessel_id':1, 'code':f'5310E00{number}', 'name':'motor', 'location':'usa', 'active':True})
+               for number in range(3)]
+    batcher.close()
+    assert not batcher._thread.is_alive()
+    assert [ticket.status for ticket in tickets] == ['OK', 'OK', 'OK']
+    assert batcher.rows == 3
+    with app.app_context():
+        assert db.session.query(equipment).filter(equipment.code.like('5310E00%')).count() == 3
+
+def test_status_lookup_unknown_id(app):
+    result = app.test_client().get('/equipment/insert_status?id=unknown')
+    assert result.get_json().get('message') == 'NO_INSERT'
+    assert result.status_code == 404
+
+def test_bulk_insert_codes_are_known(app):
+    app.test_client().post('/equipment/bulk_insert', json=[{'vessel_code':'MV102', 'code':'5310D003', 'location':'usa', 'name':'motor'}])
+    with app.app_context():
+        flushes = insert_batcher().stats().get('flushes')
+    result = insert(app, '5310D003')
+    assert result.status_code == 409
+    with app.app_context():
+        assert insert_batcher().stats().get('flushes') == flushes
@@ -0,0 +1,4 @@
+from apis.app import create_app
+
+# Entry point of the production server, see gunicorn.conf.py
+app = create_app(production_conf=True)